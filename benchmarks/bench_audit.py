@@ -0,0 +1,136 @@
+"""Benchmark serialising audit query results.
+
+Usage::
+
+    python -m benchmarks.bench_audit [--rows 100000] [--page-size 1000] \\
+        [CONNECTION_STRING ...]
+
+If no connection strings are given, a temporary SQLite database is used.
+The audit table is filled with ``--rows`` records for a single user, which
+are then read back a page at a time and serialised both by decoding and
+re-encoding every record and by splicing their JSON text into the output.
+The fetch time and the serialisation rate in rows per second are reported.
+"""
+
+from datetime import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from aludel.database import get_engine
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import usage
+
+from unique_code_service.api import format_audit_record, audit_record_json
+from unique_code_service.models import UniqueCodePool, iter_batches
+
+from .bench_import import drop_tables
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["rows", "n", 100000, "Number of audit records", int],
+        ["page-size", "p", 1000, "Number of records per query", int],
+    ]
+
+    def parseArgs(self, *connection_strings):
+        self['connection-strings'] = list(connection_strings)
+
+
+def audit_rows(pool, count):
+    now = datetime.utcnow()
+    for i in xrange(count):
+        row = pool._audit_row(
+            {
+                'request_id': 'req-%s' % (i,),
+                'transaction_id': 'tx-%s' % (i,),
+                'user_id': 'bench-user',
+            },
+            {'candidate_code': 'flavour%s-code%s' % (i % 10, i)},
+            {
+                'id': i,
+                'unique_code': 'flavour%s-code%s' % (i % 10, i),
+                'flavour': 'flavour%s' % (i % 10,),
+                'used': True,
+                'reason': 'redeemed',
+            },
+            'flavour%s-code%s' % (i % 10, i))
+        row['created_at'] = now
+        yield row
+
+
+def serialise_decoded(records):
+    return [json.dumps(format_audit_record(record)) for record in records]
+
+
+def serialise_spliced(records):
+    return [audit_record_json(record).encode('utf-8') for record in records]
+
+
+@inlineCallbacks
+def fetch_pages(pool, page_size):
+    pages = []
+    cursor = None
+    while True:
+        records, cursor = yield pool.query_audit(
+            'user_id', 'bench-user', page_size, cursor)
+        pages.append(records)
+        if cursor is None:
+            returnValue(pages)
+
+
+@inlineCallbacks
+def bench_audit(engine, rows, page_size):
+    drop_tables(engine)
+    conn = yield engine.connect()
+    try:
+        pool = UniqueCodePool('benchpool', conn)
+        yield pool.create_tables()
+        for batch in iter_batches(audit_rows(pool, rows), 5000):
+            yield pool.execute_query(pool.audit.insert(), batch)
+
+        for name, serialise in [('decode', serialise_decoded),
+                                ('splice', serialise_spliced)]:
+            start = time.time()
+            pages = yield fetch_pages(pool, page_size)
+            fetched = time.time()
+            for records in pages:
+                serialise(records)
+            done = time.time()
+            print '%-12s %-8s %9d rows fetch %6.2fs serialise %6.2fs' \
+                ' %10.0f rows/sec' % (
+                    engine.dialect.name, name, rows, fetched - start,
+                    done - fetched, rows / (done - fetched))
+    finally:
+        yield conn.close()
+    drop_tables(engine)
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    tempdir = None
+    connection_strings = options['connection-strings']
+    if not connection_strings:
+        tempdir = tempfile.mkdtemp()
+        connection_strings = [
+            'sqlite:///%s' % (os.path.join(tempdir, 'bench.db'),)]
+        # SQLite doesn't like being used from more than one thread.
+        reactor.suggestThreadPoolSize(1)
+
+    try:
+        for connection_string in connection_strings:
+            engine = get_engine(connection_string, reactor)
+            yield bench_audit(engine, options['rows'], options['page-size'])
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,146 @@
+"""Benchmark how much space audit records take and how fast they're inserted.
+
+Usage::
+
+    python -m benchmarks.bench_audit_storage [--rows 100000] \\
+        [--batch-size 1] [CONNECTION_STRING ...]
+
+If no connection strings are given, a temporary SQLite database is used.
+``--rows`` redeem audit records, one in five of them for a failed redeem,
+are inserted ``--batch-size`` at a time with the request and response data
+stored as plain JSON, as it used to be, and then stored compactly. The
+average size of the stored data and of the whole record, and the rate in
+rows per second of encoding and inserting them, are reported for both.
+"""
+
+from datetime import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from aludel.database import get_engine
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import usage
+
+from unique_code_service.models import UniqueCodePool, iter_batches
+
+from .bench_import import drop_tables
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["rows", "n", 100000, "Number of audit records", int],
+        ["batch-size", "b", 1, "Number of records per insert", int],
+    ]
+
+    def parseArgs(self, *connection_strings):
+        self['connection-strings'] = list(connection_strings)
+
+
+def redeem_audits(count):
+    """Yield ``(audit_params, req_data, resp_data, unique_code, error)`` for
+    redeems like the ones we see in production.
+    """
+    for i in xrange(count):
+        unique_code = 'flavour%scode%s' % (i % 10, i)
+        audit_params = {
+            'request_id': 'req-%s' % (i,),
+            'transaction_id': 'tx-%s' % (i,),
+            'user_id': 'user-%s' % (i % 1000,),
+        }
+        req_data = {'candidate_code': unique_code}
+        if i % 5 == 4:
+            resp_data = {'reason': 'used', 'unique_code': unique_code}
+            yield audit_params, req_data, resp_data, unique_code, True
+        else:
+            resp_data = {
+                'id': i,
+                'unique_code': unique_code,
+                'flavour': 'flavour%s' % (i % 10,),
+                'used': True,
+                'reason': 'redeemed',
+            }
+            yield audit_params, req_data, resp_data, unique_code, False
+
+
+def json_audit_row(audit_params, req_data, resp_data, unique_code, error):
+    """Make an audit row the way we did before audit data was compact."""
+    return {
+        'request_id': audit_params['request_id'],
+        'transaction_id': audit_params['transaction_id'],
+        'user_id': audit_params['user_id'],
+        'request_data': json.dumps(req_data),
+        'response_data': json.dumps(resp_data),
+        'error': error,
+        'created_at': datetime.utcnow(),
+        'unique_code': unique_code,
+    }
+
+
+def audit_rows(pool, count, compact):
+    audit_row = pool._audit_row if compact else json_audit_row
+    for audit in redeem_audits(count):
+        yield audit_row(*audit)
+
+
+def row_bytes(row):
+    return sum(len(value) for value in row.values()
+               if isinstance(value, basestring))
+
+
+@inlineCallbacks
+def bench_audit_storage(engine, rows, batch_size):
+    for name, compact in [('json', False), ('compact', True)]:
+        drop_tables(engine)
+        conn = yield engine.connect()
+        try:
+            pool = UniqueCodePool('benchpool', conn)
+            yield pool.create_tables()
+            data_bytes = total_bytes = 0
+            for row in audit_rows(pool, rows, compact):
+                data_bytes += (
+                    len(row['request_data']) + len(row['response_data']))
+                total_bytes += row_bytes(row)
+            start = time.time()
+            for batch in iter_batches(
+                    audit_rows(pool, rows, compact), batch_size):
+                yield pool._insert_audit(batch)
+            elapsed = time.time() - start
+        finally:
+            yield conn.close()
+        print '%-12s %-8s %9d rows %6.1f data bytes/row %6.1f bytes/row' \
+            ' %8.2fs %10.0f rows/sec' % (
+                engine.dialect.name, name, rows, float(data_bytes) / rows,
+                float(total_bytes) / rows, elapsed, rows / elapsed)
+    drop_tables(engine)
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    tempdir = None
+    connection_strings = options['connection-strings']
+    if not connection_strings:
+        tempdir = tempfile.mkdtemp()
+        connection_strings = [
+            'sqlite:///%s' % (os.path.join(tempdir, 'bench.db'),)]
+        # SQLite doesn't like being used from more than one thread.
+        reactor.suggestThreadPoolSize(1)
+
+    try:
+        for connection_string in connection_strings:
+            engine = get_engine(connection_string, reactor)
+            yield bench_audit_storage(
+                engine, options['rows'], options['batch-size'])
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
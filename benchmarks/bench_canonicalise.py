@@ -0,0 +1,70 @@
+"""Benchmark canonicalising unique codes.
+
+Usage::
+
+    python -m benchmarks.bench_canonicalise [--codes 1000000]
+
+Canonicalises ``--codes`` generated codes, as both byte strings and unicode
+strings, with the original character-by-character implementation, one at a
+time with ``canonicalise_unique_code()`` and in a batch with
+``canonicalise_unique_codes()``. The rate in codes per second is reported.
+"""
+
+import sys
+import time
+
+from twisted.python import usage
+
+from unique_code_service.models import UniqueCodePool
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["codes", "n", 1000000, "Number of unique codes", int],
+    ]
+
+
+def mk_codes(count):
+    # Codes as people type them, with some case and separators to clean up.
+    return ['Code-%s-%06d' % ('ABCDEFGHIJ'[i % 10], i)
+            for i in xrange(count)]
+
+
+def original(unique_codes):
+    allowed = UniqueCodePool.UNIQUE_CODE_ALLOWED_CHARS
+    return [''.join(c for c in unique_code.lower() if c in allowed)
+            for unique_code in unique_codes]
+
+
+def one_at_a_time(unique_codes):
+    canonicalise = UniqueCodePool.canonicalise_unique_code
+    return [canonicalise(unique_code) for unique_code in unique_codes]
+
+
+def batch(unique_codes):
+    return list(UniqueCodePool.canonicalise_unique_codes(unique_codes))
+
+
+def main(argv):
+    options = Options()
+    options.parseOptions(argv)
+    count = options['codes']
+    codes = mk_codes(count)
+    unicode_codes = [unique_code.decode('ascii') for unique_code in codes]
+    for kind, unique_codes in [('str', codes), ('unicode', unicode_codes)]:
+        expected = None
+        for name, canonicalise in [('original', original),
+                                   ('one-at-a-time', one_at_a_time),
+                                   ('batch', batch)]:
+            start = time.time()
+            canonical_codes = canonicalise(unique_codes)
+            elapsed = time.time() - start
+            if expected is None:
+                expected = canonical_codes
+            assert canonical_codes == expected
+            print '%-8s %-14s %9d codes %8.2fs %12.0f codes/sec' % (
+                kind, name, count, elapsed, count / elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
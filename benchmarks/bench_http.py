@@ -0,0 +1,304 @@
+"""Load test the HTTP API with concurrent clients.
+
+Usage::
+
+    python -m benchmarks.bench_http [--codes 20000] [--requests 2000] \\
+        [--clients 1,8,32] [--scenarios redeem,counts,audit_query,import] \\
+        [--import-size 100] [--output results.json] [CONNECTION_STRING ...]
+
+If no connection strings are given, a temporary SQLite database is used.
+For each database and number of clients, the service is started on a local
+port with a fresh pool of ``--codes`` unique codes, and then ``--requests``
+requests are made for each scenario by that many concurrent HTTP clients.
+The scenarios run in the order given, so ``audit_query`` finds the records
+written by ``redeem`` if it runs after it.
+
+The results are written as JSON, with the throughput and latency percentiles
+of every run, so that they can be compared across releases. The clients run
+in the same process as the service, so the numbers are only comparable with
+other runs on the same machine.
+"""
+
+from hashlib import md5
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+from urllib import urlencode
+from uuid import uuid4
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.python import usage
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, FileBodyProducer, readBody)
+from twisted.web.http_headers import Headers
+from twisted.web.server import Site
+
+from unique_code_service.api import UniqueCodeServiceApp
+from unique_code_service.models import UniqueCodePool
+
+from .bench_import import drop_tables, unique_code_dicts
+
+
+DEFAULT_SCENARIOS = 'redeem,counts,audit_query,import'
+PERCENTILES = [50, 90, 95, 99]
+# Spread the audit records over this many transactions, so that each audit
+# query finds a handful of them.
+AUDIT_TRANSACTIONS = 100
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["codes", "n", 20000, "Number of unique codes in the pool", int],
+        ["requests", "r", 2000, "Number of requests per scenario", int],
+        ["clients", "c", "1,8,32",
+         "Comma-separated numbers of concurrent clients"],
+        ["scenarios", "s", DEFAULT_SCENARIOS,
+         "Comma-separated scenarios to run, in order"],
+        ["import-size", None, 100, "Number of unique codes per import", int],
+        ["output", "o", None, "File to write the results to"
+         " (default: stdout)"],
+    ]
+
+    def parseArgs(self, *connection_strings):
+        self['connection-strings'] = list(connection_strings)
+
+    def postOptions(self):
+        if self['requests'] < 1:
+            raise usage.UsageError("--requests must be at least 1.")
+        self['clients'] = [int(c) for c in self['clients'].split(',')]
+        if min(self['clients']) < 1:
+            raise usage.UsageError("--clients must all be at least 1.")
+        self['scenarios'] = self['scenarios'].split(',')
+        for scenario in self['scenarios']:
+            if scenario not in SCENARIOS:
+                raise usage.UsageError("Unknown scenario: %s" % (scenario,))
+        if 'redeem' in self['scenarios'] and (
+                self['requests'] > self['codes']):
+            raise usage.UsageError(
+                "--codes must be at least --requests to redeem codes.")
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of a sorted list of values."""
+    if not sorted_values:
+        return None
+    rank = int(round(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def to_ms(seconds):
+    """Convert a latency to milliseconds, passing ``None`` through."""
+    return None if seconds is None else seconds * 1000
+
+
+def format_ms(ms):
+    if ms is None:
+        return '%9s' % ('-',)
+    return '%7.2fms' % (ms,)
+
+
+def redeem_request(i):
+    body = json.dumps({
+        'transaction_id': 'tx-%s' % (i % AUDIT_TRANSACTIONS,),
+        'user_id': 'bench-user',
+        'unique_code': 'c%s' % (i,),
+    })
+    return ('PUT', 'benchpool/redeem/redeem-%s' % (i,),
+            {'Content-Type': ['application/json']}, body, 200)
+
+
+def counts_request(i):
+    query = urlencode({'request_id': 'counts-%s' % (i,)})
+    return ('GET', 'benchpool/unique_code_counts?%s' % (query,), {}, None,
+            200)
+
+
+def audit_query_request(i):
+    query = urlencode({
+        'request_id': 'audit-%s' % (i,),
+        'field': 'transaction_id',
+        'value': 'tx-%s' % (i % AUDIT_TRANSACTIONS,),
+    })
+    return ('GET', 'benchpool/audit_query?%s' % (query,), {}, None, 200)
+
+
+def import_request(i, import_size):
+    content = 'flavour,unique_code\r\n' + ''.join(
+        'flavour%s,import-%s-%s\r\n' % (j % 10, i, j)
+        for j in xrange(import_size))
+    headers = {
+        'Content-Type': ['text/csv'],
+        'Content-MD5': [md5(content).hexdigest()],
+    }
+    return ('PUT', 'benchpool/import/import-%s' % (i,), headers, content,
+            201)
+
+
+SCENARIOS = {
+    'redeem': lambda i, options: redeem_request(i),
+    'counts': lambda i, options: counts_request(i),
+    'audit_query': lambda i, options: audit_query_request(i),
+    'import': lambda i, options: import_request(i, options['import-size']),
+}
+
+
+@inlineCallbacks
+def http_client(agent, base_url, make_request, progress, latencies):
+    while progress['next'] < progress['total']:
+        i = progress['next']
+        progress['next'] += 1
+        method, path, headers, body, expected_code = make_request(i)
+        if body is not None:
+            body = FileBodyProducer(StringIO(body))
+        start = time.time()
+        try:
+            response = yield agent.request(
+                method, '%s/%s' % (base_url, path), Headers(headers), body)
+            yield readBody(response)
+        except Exception:
+            # Requests that fail outright have no latency worth recording.
+            progress['errors'] += 1
+            continue
+        latencies.append(time.time() - start)
+        if response.code != expected_code:
+            progress['errors'] += 1
+
+
+@inlineCallbacks
+def run_scenario(reactor, base_url, scenario, clients, options):
+    conn_pool = HTTPConnectionPool(reactor)
+    conn_pool.maxPersistentPerHost = clients
+    agent = Agent(reactor, pool=conn_pool)
+    make_request = lambda i: SCENARIOS[scenario](i, options)
+    progress = {'next': 0, 'total': options['requests'], 'errors': 0}
+    latencies = []
+    start = time.time()
+    try:
+        yield gatherResults([
+            http_client(agent, base_url, make_request, progress, latencies)
+            for _ in range(clients)], consumeErrors=True)
+    finally:
+        yield conn_pool.closeCachedConnections()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    result = {
+        'scenario': scenario,
+        'clients': clients,
+        'requests': len(latencies),
+        'errors': progress['errors'],
+        'seconds': elapsed,
+        'requests_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': dict(
+            ('p%s' % (p,), to_ms(percentile(latencies, p)))
+            for p in PERCENTILES),
+    }
+    # Every request may have failed, in which case there are no latencies.
+    result['latency_ms']['max'] = to_ms(latencies[-1] if latencies else None)
+    returnValue(result)
+
+
+@inlineCallbacks
+def bench_http(reactor, connection_string, clients, options):
+    if connection_string.startswith('sqlite'):
+        # We only have one thread for SQLite, and a second connection waiting
+        # on a lock held by the first would block it, so the requests queue
+        # for a single connection instead.
+        db_connections = 1
+    else:
+        db_connections = clients
+    app = UniqueCodeServiceApp(
+        connection_string, reactor, max_connections=db_connections)
+    engine = app.engine
+
+    drop_tables(engine)
+    conn = yield engine.connect()
+    try:
+        pool = UniqueCodePool('benchpool', conn)
+        yield pool.create_tables()
+        yield pool.import_unique_codes(
+            str(uuid4()), 'md5', unique_code_dicts(options['codes']))
+    finally:
+        yield conn.close()
+
+    listener = reactor.listenTCP(
+        0, Site(app.app.resource()), interface='localhost')
+    base_url = 'http://localhost:%s' % (listener.getHost().port,)
+    results = []
+    try:
+        for scenario in options['scenarios']:
+            result = yield run_scenario(
+                reactor, base_url, scenario, clients, options)
+            result.update({
+                'database': engine.dialect.name,
+                'db_connections': db_connections,
+                'codes': options['codes'],
+            })
+            results.append(result)
+            print >> sys.stderr, (
+                '%-12s %-12s %3d clients %6d requests %5d errors'
+                ' %8.0f req/sec p50 %s p99 %s' % (
+                    engine.dialect.name, scenario, clients,
+                    result['requests'], result['errors'],
+                    result['requests_per_sec'],
+                    format_ms(result['latency_ms']['p50']),
+                    format_ms(result['latency_ms']['p99'])))
+    finally:
+        yield listener.stopListening()
+        yield app.conn_pool.close()
+    drop_tables(engine)
+    returnValue(results)
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    tempdir = None
+    connection_strings = options['connection-strings']
+    if not connection_strings:
+        tempdir = tempfile.mkdtemp()
+        connection_strings = [
+            'sqlite:///%s' % (os.path.join(tempdir, 'bench.db'),)]
+
+    if all(cs.startswith('sqlite') for cs in connection_strings):
+        # SQLite doesn't like being used from more than one thread.
+        reactor.suggestThreadPoolSize(1)
+    else:
+        # Every database connection needs a thread of its own.
+        reactor.suggestThreadPoolSize(max(options['clients']) + 2)
+
+    results = []
+    try:
+        for connection_string in connection_strings:
+            for clients in options['clients']:
+                run_results = yield bench_http(
+                    reactor, connection_string, clients, options)
+                results.extend(run_results)
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+
+    report = json.dumps({
+        'python': sys.version.split()[0],
+        'options': {
+            'codes': options['codes'],
+            'requests': options['requests'],
+            'import_size': options['import-size'],
+        },
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if options['output'] is None:
+        print report
+    else:
+        with open(options['output'], 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
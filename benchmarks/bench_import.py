@@ -0,0 +1,118 @@
+"""Benchmark unique code imports with each applicable bulk inserter.
+
+Usage::
+
+    python -m benchmarks.bench_import [--sizes 10000,100000,1000000] \\
+        [CONNECTION_STRING ...]
+
+If no connection strings are given, a temporary SQLite database is used.
+Every size is imported into a fresh pool for every inserter that works with
+the database's dialect, and the rate in rows per second is reported.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+from aludel.database import get_engine, MetaData
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import usage
+
+from unique_code_service.bulk_insert import (
+    BulkInserter, MultiValuesInserter, get_bulk_inserter,
+)
+from unique_code_service.models import UniqueCodePool
+
+
+DEFAULT_SIZES = '10000,100000,1000000'
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["sizes", "s", DEFAULT_SIZES,
+         "Comma-separated numbers of unique codes to import"],
+    ]
+
+    def parseArgs(self, *connection_strings):
+        self['connection-strings'] = list(connection_strings)
+
+    def postOptions(self):
+        self['sizes'] = [int(size) for size in self['sizes'].split(',')]
+
+
+def unique_code_dicts(size):
+    for i in xrange(size):
+        yield {'flavour': 'flavour%s' % (i % 10,), 'unique_code': 'c%s' % (i,)}
+
+
+def inserters_for(dialect):
+    """Return the fallback inserter and anything better for ``dialect``."""
+    inserters = [BulkInserter()]
+    if dialect.supports_multivalues_insert:
+        inserters.append(MultiValuesInserter())
+    best = get_bulk_inserter(dialect)
+    if type(best) not in [type(i) for i in inserters]:
+        inserters.append(best)
+    return inserters
+
+
+def drop_tables(engine):
+    # NOTE: This is a blocking operation!
+    md = MetaData(bind=engine._engine)
+    md.reflect()
+    md.drop_all()
+
+
+@inlineCallbacks
+def bench_import(engine, inserter, size):
+    drop_tables(engine)
+    conn = yield engine.connect()
+    try:
+        pool = UniqueCodePool('benchpool', conn)
+        pool.get_bulk_inserter = lambda: inserter
+        yield pool.create_tables()
+        start = time.time()
+        yield pool.import_unique_codes(
+            str(uuid4()), 'md5', unique_code_dicts(size))
+        elapsed = time.time() - start
+    finally:
+        yield conn.close()
+    drop_tables(engine)
+    print '%-12s %-22s %9d rows %8.2fs %10.0f rows/sec' % (
+        engine.dialect.name, type(inserter).__name__, size, elapsed,
+        size / elapsed)
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    tempdir = None
+    connection_strings = options['connection-strings']
+    if not connection_strings:
+        tempdir = tempfile.mkdtemp()
+        connection_strings = [
+            'sqlite:///%s' % (os.path.join(tempdir, 'bench.db'),)]
+        # SQLite doesn't like being used from more than one thread.
+        reactor.suggestThreadPoolSize(1)
+
+    try:
+        for connection_string in connection_strings:
+            engine = get_engine(connection_string, reactor)
+            # Make sure the dialect has been initialised.
+            conn = yield engine.connect()
+            yield conn.close()
+            for size in options['sizes']:
+                for inserter in inserters_for(engine.dialect):
+                    yield bench_import(engine, inserter, size)
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,132 @@
+"""Benchmark issuing unique codes with concurrent clients.
+
+Usage::
+
+    python -m benchmarks.bench_issue [--codes 10000] [--issues 2000] \\
+        [--clients 1,4,16] [CONNECTION_STRING ...]
+
+If no connection strings are given, a temporary SQLite database is used.
+For each number of clients, a fresh pool is filled with ``--codes`` unique
+codes and then ``--issues`` codes are issued by that many concurrent clients,
+each using its own connection. The rate in issues per second is reported.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+from aludel.database import get_engine
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.python import usage
+
+from unique_code_service.connection_pool import ConnectionPool
+from unique_code_service.models import UniqueCodePool
+
+from .bench_import import drop_tables, unique_code_dicts
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["codes", "n", 10000, "Number of unique codes in the pool", int],
+        ["issues", "i", 2000, "Number of unique codes to issue", int],
+        ["clients", "c", "1,4,16",
+         "Comma-separated numbers of concurrent clients"],
+    ]
+
+    def parseArgs(self, *connection_strings):
+        self['connection-strings'] = list(connection_strings)
+
+    def postOptions(self):
+        self['clients'] = [int(c) for c in self['clients'].split(',')]
+
+
+@inlineCallbacks
+def issue_client(conn_pool, issue_counts):
+    while issue_counts['remaining'] > 0:
+        issue_counts['remaining'] -= 1
+        conn = yield conn_pool.acquire()
+        try:
+            pool = UniqueCodePool('benchpool', conn)
+            yield pool.issue_unique_code('flavour%s' % (
+                issue_counts['remaining'] % 10,), {
+                    'request_id': str(uuid4()),
+                    'transaction_id': 'bench',
+                    'user_id': 'bench',
+                })
+        finally:
+            yield conn_pool.release(conn)
+
+
+@inlineCallbacks
+def bench_issue(reactor, engine, codes, issues, clients):
+    drop_tables(engine)
+    conn = yield engine.connect()
+    try:
+        pool = UniqueCodePool('benchpool', conn)
+        yield pool.create_tables()
+        yield pool.import_unique_codes(
+            str(uuid4()), 'md5', unique_code_dicts(codes))
+    finally:
+        yield conn.close()
+
+    conn_pool = ConnectionPool(
+        engine, reactor, min_size=clients, max_size=clients)
+    issue_counts = {'remaining': issues}
+    start = time.time()
+    try:
+        yield gatherResults([
+            issue_client(conn_pool, issue_counts) for _ in range(clients)],
+            consumeErrors=True)
+    finally:
+        yield conn_pool.close()
+    elapsed = time.time() - start
+    drop_tables(engine)
+    print '%-12s %3d clients %7d issues %8.2fs %10.0f issues/sec' % (
+        engine.dialect.name, clients, issues, elapsed, issues / elapsed)
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    tempdir = None
+    connection_strings = options['connection-strings']
+    if not connection_strings:
+        tempdir = tempfile.mkdtemp()
+        connection_strings = [
+            'sqlite:///%s' % (os.path.join(tempdir, 'bench.db'),)]
+
+    if all(cs.startswith('sqlite') for cs in connection_strings):
+        # SQLite doesn't like being used from more than one thread.
+        reactor.suggestThreadPoolSize(1)
+    else:
+        # Every client needs a thread of its own, otherwise the clients can
+        # deadlock on row locks.
+        reactor.suggestThreadPoolSize(max(options['clients']) + 2)
+
+    try:
+        for connection_string in connection_strings:
+            engine = get_engine(connection_string, reactor)
+            conn = yield engine.connect()
+            yield conn.close()
+            for clients in options['clients']:
+                if engine.dialect.name == 'sqlite' and clients > 1:
+                    # SQLite locks the whole database for writes and we only
+                    # have one thread for it, so more clients would just
+                    # block each other.
+                    print 'sqlite: skipping %d clients' % (clients,)
+                    continue
+                yield bench_issue(
+                    reactor, engine, options['codes'], options['issues'],
+                    clients)
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
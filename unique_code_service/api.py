@@ -1,28 +1,429 @@
-from StringIO import StringIO
 import csv
+from datetime import datetime
+import errno
+from functools import wraps
 from hashlib import md5
+from itertools import islice
+import json
+import os
+import re
+import tempfile
 
 from aludel.database import get_engine
 from aludel.service import (
     service, handler, get_url_params, get_json_params, set_request_id,
-    APIError, BadRequestParams,
+    get_request_id, format_error, APIError, BadRequestParams,
 )
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, DeferredList)
+from twisted.python import log
+from twisted.python.failure import Failure
 
+from .bloom import UniqueCodeFilter
+from .cache import ResponseCache
+from .connection_pool import ConnectionPool, ConnectionPoolTimeout
+from .group_commit import RedeemGroupCommitter
+from .metrics import Metrics
 from .models import (
-    UniqueCodePool, CannotRedeemUniqueCode, NoUniqueCodePool, AuditMismatch,
+    CannotRedeemUniqueCode, CannotIssueUniqueCode, IssueContention,
+    ImportConflict, NoUniqueCodePool, NoImportJob, ImportJobTakenOver,
+    ImportInProgress, AuditMismatch, UniqueCodePool,
 )
+from .registry import UniqueCodePoolRegistry
+from .replica import ReadReplica
 
 
+READ_CHUNK_SIZE = 64 * 1024
+
+# This keeps the IN clauses in batch redeems inside SQLite's parameter limit.
+MAX_REDEEM_BATCH_SIZE = 500
+
+# The biggest page of audit records we return, and the default page size.
+MAX_AUDIT_QUERY_LIMIT = 1000
+
+# Streamed audit queries fetch this many records from the database at a time.
+AUDIT_STREAM_PAGE_SIZE = 1000
+
+# Names of the files made by spool_file(), with the process id that made them.
+SPOOL_FILE_RE = re.compile(r'^import-(\d+)-.*\.csv$')
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Asynchronous imports commit this many rows at a time, so that they never
+# hold a transaction or a database connection for long.
+IMPORT_JOB_BATCH_SIZE = 1000
+
+
+def timed(endpoint):
+    """Decorator that records how long a request handler takes.
+
+    The handler gets a :class:`StageTimer` for the endpoint and pool as its
+    ``timer`` keyword argument, to time the stages of the request with.
+    Requests for pools we don't know exist are recorded without the pool's
+    name, see :meth:`UniqueCodeServiceApp.pool_known`.
+    """
+    def deco(func):
+        @wraps(func)
+        def wrapper(self, request, *args, **kw):
+            name = kw['unique_code_pool']
+            timer = self.metrics.timer(
+                endpoint, name, pool_known=lambda: self.pool_known(name))
+            d = maybeDeferred(func, self, request, *args, timer=timer, **kw)
+            return d.addBoth(timer.finish)
+        return wrapper
+    return deco
+
+
+def stream_handler(*args, **kw):
+    """Decorator for HTTP request handlers that write their own responses.
+
+    This takes the same parameters as aludel's ``handler()`` decorator, but
+    the handler writes its response body to the request itself instead of
+    returning a dict. Errors raised before anything has been written get the
+    usual JSON error response. Handlers are only registered on classes that
+    are also decorated with :func:`streaming_service`.
+    """
+    def deco(func):
+        func._stream_handler_args = (args, kw)
+        return func
+    return deco
+
+
+def streaming_service(service_class):
+    """Register a :func:`service` class's :func:`stream_handler` methods.
+
+    This must be applied after (that is, above) aludel's ``service()``.
+    """
+    for attr in dir(service_class):
+        meth = getattr(service_class, attr)
+        if hasattr(meth, '_stream_handler_args'):
+            args, kw = meth._stream_handler_args
+            route = service_class.app.route(*args, **kw)
+            route(_make_stream_handler(meth.im_func))
+    return service_class
+
+
+def _make_stream_handler(func):
+    @wraps(func)
+    def wrapper(self, request, *args, **kw):
+        d = maybeDeferred(func, self, request, *args, **kw)
+        d.addErrback(self.handle_api_error, request)
+        d.addErrback(_handle_stream_error, request)
+        return d
+    return wrapper
+
+
+def _handle_stream_error(failure, request):
+    if request.startedWriting:
+        # It's too late for an error response, so we drop the connection to
+        # let the client know that what it got is incomplete.
+        log.err(failure)
+        request.channel.transport.abortConnection()
+        return None
+    error = failure.value
+    if not failure.check(APIError):
+        log.err(failure)
+        error = APIError('Internal server error.')
+    return format_error(error, request)
+
+
+@streaming_service
 @service
 class UniqueCodeServiceApp(object):
-    def __init__(self, conn_str, reactor):
+    def __init__(self, conn_str, reactor, min_connections=1,
+                 max_connections=10, acquire_timeout=30, idle_timeout=300,
+                 pool_cache_ttl=60, import_spool_dir=None, bloom_filter=False,
+                 bloom_filter_error_rate=0.01, bloom_filter_max_bytes=None,
+                 bloom_filter_max_staleness=1.0, group_commit=False,
+                 group_commit_interval=0.005,
+                 group_commit_max_batch_size=100, read_conn_str=None,
+                 read_max_lag=5.0, counts_cache_max_staleness=1.0):
+        self.reactor = reactor
         self.engine = get_engine(conn_str, reactor)
+        # Uploads for asynchronous imports are kept here until they've been
+        # imported. None means the system's temporary directory.
+        self.import_spool_dir = import_spool_dir
+        if import_spool_dir is not None:
+            # Other programs' files are in the system's temporary directory,
+            # so we only clean up a directory of our own.
+            remove_orphaned_spool_files(import_spool_dir)
+        # Deferreds for the asynchronous imports this process is running,
+        # keyed by pool name and request_id. See :meth:`stop_import_jobs`.
+        self.running_import_jobs = {}
+        self.stopping_import_jobs = False
+        self.pools = UniqueCodePoolRegistry(reactor, ttl=pool_cache_ttl)
+        self.conn_pool = ConnectionPool(
+            self.engine, reactor, min_size=min_connections,
+            max_size=max_connections, acquire_timeout=acquire_timeout,
+            idle_timeout=idle_timeout)
+        self.metrics = Metrics()
+        add_conn_pool_metrics(
+            self.metrics, 'unique_code_service_db_pool',
+            'Database connection pool', self.conn_pool)
+
+        # Unique code counts responses for each pool. Writes that change a
+        # pool's counts invalidate its entry, so only writes made by other
+        # processes can be missing from a cached response.
+        self.counts_cache = ResponseCache(
+            reactor, max_staleness=counts_cache_max_staleness)
+        for stat in ['hits', 'misses', 'shared']:
+            self.metrics.add_counter(
+                'unique_code_service_counts_cache_%s' % (stat,),
+                'Unique code counts cache %s.' % (stat,),
+                lambda stat=stat: self.counts_cache.stats()[stat])
+
+        # Audit queries and unique code counts go to the read replica, if
+        # there is one and it's fresh enough. See :meth:`_read`. The replica
+        # has its own pool registry, because a pool it doesn't have yet may
+        # already exist on the primary.
+        self.read_replica = None
+        self.read_pools = UniqueCodePoolRegistry(reactor, ttl=pool_cache_ttl)
+        if read_conn_str is not None:
+            read_conn_pool = ConnectionPool(
+                get_engine(read_conn_str, reactor), reactor,
+                min_size=min_connections, max_size=max_connections,
+                acquire_timeout=acquire_timeout, idle_timeout=idle_timeout)
+            self.read_replica = ReadReplica(
+                read_conn_pool, reactor, max_lag=read_max_lag)
+            add_conn_pool_metrics(
+                self.metrics, 'unique_code_service_db_read_pool',
+                'Read replica connection pool', read_conn_pool)
+            for stat in ['lag', 'fresh', 'reads', 'fallbacks']:
+                add = self.metrics.add_gauge
+                if stat in ('reads', 'fallbacks'):
+                    add = self.metrics.add_counter
+                add('unique_code_service_read_replica_%s' % (stat,),
+                    'Read replica %s.' % (stat,),
+                    lambda stat=stat: self.read_replica.stats()[stat])
+
+        # Bloom filters of each pool's codes, if they're enabled. See
+        # :meth:`_get_code_filter`.
+        self.code_filters = None
+        self.bloom_filter_options = {
+            'error_rate': bloom_filter_error_rate,
+            'max_bytes': bloom_filter_max_bytes,
+            'max_staleness': bloom_filter_max_staleness,
+        }
+        if bloom_filter:
+            self.code_filters = {}
+        for stat in ['bytes', 'codes', 'error_rate', 'fresh',
+                     'skipped_lookups']:
+            add = self.metrics.add_gauge
+            if stat == 'skipped_lookups':
+                add = self.metrics.add_counter
+            add('unique_code_service_bloom_filter_%s' % (stat,),
+                'Unique code Bloom filter %s.' % (stat.replace('_', ' '),),
+                lambda stat=stat: dict(
+                    ((name,), code_filter.stats()[stat])
+                    for name, code_filter in self._code_filter_items()),
+                label_names=('pool',))
+
+        # Group committers for each pool's redeems, if group commit is
+        # enabled. See :meth:`_get_group_committer`.
+        self.group_committers = None
+        self.group_commit_options = {
+            'interval': group_commit_interval,
+            'max_batch_size': group_commit_max_batch_size,
+        }
+        if group_commit:
+            self.group_committers = {}
+        for stat in ['batches', 'redeems', 'waiting']:
+            add = self.metrics.add_gauge
+            if stat in ('batches', 'redeems'):
+                add = self.metrics.add_counter
+            add('unique_code_service_group_commit_%s' % (stat,),
+                'Redeem group commit %s.' % (stat,),
+                lambda stat=stat: dict(
+                    ((name,), committer.stats()[stat])
+                    for name, committer in self._group_committer_items()),
+                label_names=('pool',))
+
+    def pool_known(self, unique_code_pool):
+        """Return ``True`` if we've recently seen that the named pool exists.
+
+        This never touches the database.
+        """
+        return (self.pools.known_to_exist(unique_code_pool) or
+                self.read_pools.known_to_exist(unique_code_pool))
+
+    def _code_filter_items(self):
+        if self.code_filters is None:
+            return []
+        return self.code_filters.items()
+
+    def _group_committer_items(self):
+        if self.group_committers is None:
+            return []
+        return self.group_committers.items()
+
+    @inlineCallbacks
+    def _get_pool(self, unique_code_pool, timer):
+        """Check out a connection and return the named pool bound to it.
+
+        The pool must be given back with :meth:`_release_pool`.
+        """
+        self.pools.check_exists(unique_code_pool)
+        conn = yield timer.time('acquire', self.conn_pool.acquire())
+        pool = self.pools.get_pool(unique_code_pool, conn)
+        pool.stage_timer = timer
+        pool.code_filter = self._get_code_filter(unique_code_pool)
+        returnValue(pool)
+
+    @inlineCallbacks
+    def _read(self, unique_code_pool, timer, func):
+        """Call ``func`` with the named pool bound to a connection for a
+        reporting query and return its result.
+
+        The query goes to the read replica if we have one that's fresh
+        enough, and to the primary otherwise. Only use this for queries that
+        are happy with slightly stale results.
+        """
+        self.pools.check_exists(unique_code_pool)
+        replica = self.read_replica
+        if replica is not None and replica.use():
+            conn_pool = replica.conn_pool
+            conn = yield timer.time('acquire', conn_pool.acquire())
+            try:
+                pool = self.read_pools.get_pool(unique_code_pool, conn)
+                pool.stage_timer = timer
+                result = yield func(pool)
+                returnValue(result)
+            except NoUniqueCodePool:
+                # The pool may be too new for the replica to have it, so we
+                # ask the primary.
+                self.read_pools.invalidate(unique_code_pool)
+            finally:
+                yield timer.time('release', conn_pool.release(conn))
+        pool = yield self._get_pool(unique_code_pool, timer)
+        try:
+            result = yield func(pool)
+        finally:
+            yield self._release_pool(pool, timer)
+        returnValue(result)
+
+    def stop_import_jobs(self):
+        """Stop the asynchronous import jobs this process is running.
+
+        Each job stops once its current batch is done and is marked as
+        failed, so that repeating the import resumes it straight away
+        instead of once it looks abandoned. Returns a :class:`Deferred` that
+        fires when they've all stopped.
+        """
+        self.stopping_import_jobs = True
+        return DeferredList(self.running_import_jobs.values())
+
+    @inlineCallbacks
+    def close(self):
+        """Close our database connections."""
+        yield self.conn_pool.close()
+        if self.read_replica is not None:
+            yield self.read_replica.conn_pool.close()
+
+    def _get_code_filter(self, unique_code_pool):
+        """Return the pool's :class:`UniqueCodeFilter`, or ``None`` if they
+        aren't enabled.
+
+        Filters are only built for pools we've seen exist, so the first
+        request for a pool does without one and starts building it when it
+        releases the pool. They're refreshed in the background while requests
+        go on using them, or doing without them until they're ready.
+        """
+        if self.code_filters is None:
+            return None
+        code_filter = self.code_filters.get(unique_code_pool)
+        if code_filter is None:
+            if not self.pools.known_to_exist(unique_code_pool):
+                # Requests for made-up pool names mustn't leave filters
+                # behind, or start refreshes that can't succeed.
+                return None
+            code_filter = UniqueCodeFilter(
+                self.reactor, **self.bloom_filter_options)
+            self.code_filters[unique_code_pool] = code_filter
+        if code_filter.needs_refresh():
+            d = code_filter.refresh(
+                lambda func: self._with_pool(unique_code_pool, func))
+            d.addErrback(
+                self._code_filter_refresh_failed, unique_code_pool,
+                code_filter)
+        return code_filter
+
+    def _code_filter_refresh_failed(self, failure, unique_code_pool,
+                                    code_filter):
+        if failure.check(NoUniqueCodePool):
+            # The pool has gone, so we drop its filter. We won't build
+            # another until we see the pool exist again, and requests find
+            # out about it without our help.
+            if self.code_filters.get(unique_code_pool) is code_filter:
+                del self.code_filters[unique_code_pool]
+            return
+        log.err(failure, 'Error refreshing the Bloom filter for %s.' % (
+            unique_code_pool,))
+
+    @inlineCallbacks
+    def _with_pool(self, unique_code_pool, func):
+        """Call ``func`` with the named pool bound to a connection of its
+        own, for work that isn't part of a request.
+        """
+        conn = yield self.conn_pool.acquire()
+        try:
+            result = yield func(self.pools.get_pool(unique_code_pool, conn))
+        finally:
+            yield self.conn_pool.release(conn)
+        returnValue(result)
+
+    def _get_group_committer(self, unique_code_pool):
+        """Return the pool's :class:`RedeemGroupCommitter`, or ``None`` if
+        group commit isn't enabled or we haven't seen the pool exist yet.
+
+        Redeems for pools we haven't seen exist are handled on their own,
+        which tells us whether the pool exists, so made-up pool names don't
+        leave committers behind.
+        """
+        if self.group_committers is None:
+            return None
+        committer = self.group_committers.get(unique_code_pool)
+        if committer is None:
+            if not self.pools.known_to_exist(unique_code_pool):
+                return None
+            committer = RedeemGroupCommitter(
+                self.reactor,
+                lambda func: self._with_pool(
+                    unique_code_pool, self._with_code_filter(
+                        unique_code_pool, func)),
+                **self.group_commit_options)
+            self.group_committers[unique_code_pool] = committer
+        return committer
+
+    def _with_code_filter(self, unique_code_pool, func):
+        def wrapper(pool):
+            pool.code_filter = self._get_code_filter(unique_code_pool)
+            return func(pool)
+        return wrapper
+
+    def _release_pool(self, pool, timer):
+        if pool.code_filter is None:
+            # If this was the pool's first use, we now know it exists.
+            self._get_code_filter(pool.name)
+        return timer.time('release', self.conn_pool.release(pool._conn))
 
     def handle_api_error(self, failure, request):
         if failure.check(NoUniqueCodePool):
             raise APIError('Unique code pool does not exist.', 404)
+        if failure.check(NoImportJob):
+            raise APIError('Import job does not exist.', 404)
+        if failure.check(ConnectionPoolTimeout):
+            raise APIError('Timed out waiting for a database connection.', 503)
+        if failure.check(IssueContention):
+            raise APIError('Too many concurrent requests, try again.', 503)
+        if failure.check(ImportConflict):
+            raise APIError(
+                'A concurrent import added some of these unique codes,'
+                ' try again.', 409)
+        if failure.check(ImportInProgress):
+            raise APIError(
+                'An asynchronous import with this request_id has not'
+                ' finished, check its status.', 409)
         if failure.check(AuditMismatch):
             raise BadRequestParams(
                 "This request has already been performed with different"
@@ -32,128 +433,572 @@ class UniqueCodeServiceApp(object):
     @handler(
         '/<string:unique_code_pool>/redeem/<string:request_id>',
         methods=['PUT'])
+    @timed('redeem')
     @inlineCallbacks
-    def redeem_unique_code(self, request, unique_code_pool, request_id):
+    def redeem_unique_code(self, request, unique_code_pool, request_id, timer):
         set_request_id(request, request_id)
-        params = get_json_params(
-            request, ['transaction_id', 'user_id', 'unique_code'])
+        with timer.stage('parse'):
+            params = get_json_params(
+                request, ['transaction_id', 'user_id', 'unique_code'])
         audit_params = {
             'request_id': request_id,
             'transaction_id': params.pop('transaction_id'),
             'user_id': params.pop('user_id'),
         }
-        conn = yield self.engine.connect()
-        pool = UniqueCodePool(unique_code_pool, conn)
         try:
-            unique_code = yield pool.redeem_unique_code(
-                params['unique_code'], audit_params)
+            unique_code = yield self._redeem(
+                unique_code_pool, params['unique_code'], audit_params, timer)
         except CannotRedeemUniqueCode as e:
             # This is a normal condition, so we still return a 200 OK.
             raise APIError('Cannot redeem unique code: %s' % (e.reason,), 200)
-        finally:
-            yield conn.close()
 
         returnValue({
             'unique_code': unique_code['unique_code'],
             'flavour': unique_code['flavour'],
         })
 
-    @handler('/<string:unique_code_pool>/audit_query', methods=['GET'])
     @inlineCallbacks
-    def audit_query(self, request, unique_code_pool):
-        params = get_url_params(
-            request, ['field', 'value'], ['request_id'])
-        if params['field'] not in [
-                'request_id', 'transaction_id', 'user_id', 'unique_code']:
-            raise BadRequestParams('Invalid audit field.')
+    def _redeem(self, unique_code_pool, candidate_code, audit_params, timer):
+        self.pools.check_exists(unique_code_pool)
+        committer = self._get_group_committer(unique_code_pool)
+        if committer is not None:
+            # The committer uses connections of its own.
+            unique_code = yield timer.time('group_commit', committer.redeem(
+                candidate_code, audit_params))
+        else:
+            pool = yield self._get_pool(unique_code_pool, timer)
+            try:
+                unique_code = yield pool.redeem_unique_code(
+                    candidate_code, audit_params)
+            finally:
+                yield self._release_pool(pool, timer)
+        self.counts_cache.invalidate(unique_code_pool)
+        returnValue(unique_code)
 
-        conn = yield self.engine.connect()
-        pool = UniqueCodePool(unique_code_pool, conn)
+    @handler(
+        '/<string:unique_code_pool>/redeem_batch/<string:request_id>',
+        methods=['PUT'])
+    @timed('redeem_batch')
+    @inlineCallbacks
+    def redeem_unique_codes(self, request, unique_code_pool, request_id,
+                            timer):
+        set_request_id(request, request_id)
+        with timer.stage('parse'):
+            params = get_json_params(
+                request, ['transaction_id', 'user_id', 'unique_codes'])
+        unique_codes = params['unique_codes']
+        if not (isinstance(unique_codes, list) and all(
+                isinstance(code, basestring) for code in unique_codes)):
+            raise BadRequestParams("unique_codes must be a list of strings.")
+        if len(unique_codes) > MAX_REDEEM_BATCH_SIZE:
+            raise BadRequestParams(
+                "Too many unique codes, the maximum is %s." % (
+                    MAX_REDEEM_BATCH_SIZE,))
+        audit_params = {
+            'request_id': request_id,
+            'transaction_id': params['transaction_id'],
+            'user_id': params['user_id'],
+        }
+        pool = yield self._get_pool(unique_code_pool, timer)
         try:
-            query = {
-                'request_id': pool.query_by_request_id,
-                'transaction_id': pool.query_by_transaction_id,
-                'user_id': pool.query_by_user_id,
-                'unique_code': pool.query_by_unique_code,
-            }[params['field']]
-            rows = yield query(params['value'])
+            redeemed = yield pool.redeem_unique_codes(
+                unique_codes, audit_params)
         finally:
-            yield conn.close()
-
-        results = [{
-            'request_id': row['request_id'],
-            'transaction_id': row['transaction_id'],
-            'user_id': row['user_id'],
-            'request_data': row['request_data'],
-            'response_data': row['response_data'],
-            'error': row['error'],
-            'created_at': row['created_at'].isoformat(),
-        } for row in rows]
+            yield self._release_pool(pool, timer)
+        self.counts_cache.invalidate(unique_code_pool)
+
+        results = []
+        for candidate_code, unique_code in zip(unique_codes, redeemed):
+            if isinstance(unique_code, CannotRedeemUniqueCode):
+                results.append({
+                    'candidate_code': candidate_code,
+                    'error': 'Cannot redeem unique code: %s' % (
+                        unique_code.reason,),
+                })
+            else:
+                results.append({
+                    'candidate_code': candidate_code,
+                    'unique_code': unique_code['unique_code'],
+                    'flavour': unique_code['flavour'],
+                })
         returnValue({'results': results})
 
+    @handler(
+        '/<string:unique_code_pool>/issue/<string:request_id>',
+        methods=['PUT'])
+    @timed('issue')
+    @inlineCallbacks
+    def issue_unique_code(self, request, unique_code_pool, request_id, timer):
+        set_request_id(request, request_id)
+        with timer.stage('parse'):
+            params = get_json_params(
+                request, ['transaction_id', 'user_id', 'flavour'])
+        audit_params = {
+            'request_id': request_id,
+            'transaction_id': params.pop('transaction_id'),
+            'user_id': params.pop('user_id'),
+        }
+        pool = yield self._get_pool(unique_code_pool, timer)
+        try:
+            unique_code = yield pool.issue_unique_code(
+                params['flavour'], audit_params)
+        except CannotIssueUniqueCode as e:
+            # This is a normal condition, so we still return a 200 OK.
+            raise APIError('Cannot issue unique code: %s' % (e.reason,), 200)
+        finally:
+            yield self._release_pool(pool, timer)
+        self.counts_cache.invalidate(unique_code_pool)
+
+        returnValue({
+            'unique_code': unique_code['unique_code'],
+            'flavour': unique_code['flavour'],
+        })
+
+    @handler('/<string:unique_code_pool>/audit_query', methods=['GET'])
+    @timed('audit_query')
+    @inlineCallbacks
+    def audit_query(self, request, unique_code_pool, timer):
+        with timer.stage('parse'):
+            params = get_url_params(
+                request, ['field', 'value'],
+                ['request_id', 'limit', 'cursor'])
+        check_audit_field(params['field'])
+        limit = parse_audit_limit(params.get('limit'))
+        after = decode_audit_cursor(params.get('cursor'))
+
+        rows, cursor = yield self._read(
+            unique_code_pool, timer, lambda pool: pool.query_audit(
+                params['field'], params['value'], limit, after))
+
+        returnValue({
+            'results': [format_audit_record(row) for row in rows],
+            'next_cursor': encode_audit_cursor(cursor),
+        })
+
+    @stream_handler(
+        '/<string:unique_code_pool>/audit_query_stream', methods=['GET'])
+    @timed('audit_query_stream')
+    @inlineCallbacks
+    def audit_query_stream(self, request, unique_code_pool, timer):
+        """Stream every matching audit record as a chunked JSON response.
+
+        The response has the same shape as an unpaginated ``audit_query``
+        response, but it's built from pages of :data:`AUDIT_STREAM_PAGE_SIZE`
+        records and sent as we go, so neither we nor the client need to hold
+        all the records at once.
+        """
+        with timer.stage('parse'):
+            params = get_url_params(
+                request, ['field', 'value'], ['request_id'])
+        check_audit_field(params['field'])
+        self.pools.check_exists(unique_code_pool)
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        request.setHeader('Content-Type', 'application/json')
+        cursor = None
+        first = True
+        while not finished:
+            # We only hold a connection for one page at a time.
+            rows, cursor = yield self._read(
+                unique_code_pool, timer, lambda pool: pool.query_audit(
+                    params['field'], params['value'],
+                    AUDIT_STREAM_PAGE_SIZE, cursor))
+
+            chunks = []
+            if first:
+                chunks.append('{"request_id": %s, "results": [' % (
+                    json.dumps(get_request_id(request)),))
+            for row in rows:
+                if not first:
+                    chunks.append(', ')
+                first = False
+                chunks.append(audit_record_json(row))
+            if cursor is None:
+                chunks.append(']}')
+            if not finished:
+                request.write(''.join(chunks).encode('utf-8'))
+            if cursor is None:
+                break
+
     @handler('/<string:unique_code_pool>', methods=['PUT'])
+    @timed('create')
     @inlineCallbacks
-    def create_pool(self, request, unique_code_pool):
-        conn = yield self.engine.connect()
-        pool = UniqueCodePool(unique_code_pool, conn)
+    def create_pool(self, request, unique_code_pool, timer):
+        # Somebody else may have created the pool since we last looked, so we
+        # don't trust a cached miss here.
+        try:
+            self.pools.check_exists(unique_code_pool)
+        except NoUniqueCodePool:
+            self.pools.invalidate(unique_code_pool)
+        pool = yield self._get_pool(unique_code_pool, timer)
         try:
             already_exists = yield pool.exists()
             if not already_exists:
                 request.setResponseCode(201)
                 yield pool.create_tables()
         finally:
-            yield conn.close()
+            yield self._release_pool(pool, timer)
 
         returnValue({'created': not already_exists})
 
     @handler(
         '/<string:unique_code_pool>/import/<string:request_id>',
         methods=['PUT'])
+    @timed('import')
     @inlineCallbacks
-    def import_unique_codes(self, request, unique_code_pool, request_id):
+    def import_unique_codes(self, request, unique_code_pool, request_id,
+                            timer):
         set_request_id(request, request_id)
+        with timer.stage('parse'):
+            params = get_url_params(request, [], ['async'])
+            run_async = parse_async(params.get('async'))
         content_md5 = request.requestHeaders.getRawHeaders('Content-MD5')
         if content_md5 is None:
             raise BadRequestParams("Missing Content-MD5 header.")
         content_md5 = content_md5[0].lower()
-        content = request.content.read()
-        if content_md5 != md5(content).hexdigest().lower():
+        if run_async:
+            result = yield self._import_async(
+                request, unique_code_pool, request_id, content_md5, timer)
+            returnValue(result)
+
+        # The request body has already been spooled by twisted.web, so we
+        # read it in chunks to hash it and then parse it lazily from the
+        # start rather than holding copies of it in memory.
+        content = request.content
+        content.seek(0)
+        with timer.stage('parse'):
+            content_matches = content_md5 == file_md5(content)
+        if not content_matches:
             raise BadRequestParams(
                 "Content-MD5 header does not match content.")
+        content.seek(0)
 
-        reader = csv.DictReader(StringIO(content))
+        reader = csv.DictReader(content)
         row_iter = lowercase_row_keys(reader)
 
-        conn = yield self.engine.connect()
-        pool = UniqueCodePool(unique_code_pool, conn)
+        pool = yield self._get_pool(unique_code_pool, timer)
         try:
-            yield pool.import_unique_codes(request_id, content_md5, row_iter)
+            summary = yield pool.import_unique_codes(
+                request_id, content_md5, row_iter)
         finally:
-            yield conn.close()
+            # Even a failed import may have committed some codes.
+            self.counts_cache.invalidate(unique_code_pool)
+            yield self._release_pool(pool, timer)
 
         request.setResponseCode(201)
-        returnValue({'imported': True})
+        # A repeated import has no summary, because nothing was imported.
+        returnValue({'imported': True, 'summary': summary})
+
+    @inlineCallbacks
+    def _import_async(self, request, unique_code_pool, request_id,
+                      content_md5, timer):
+        """Start an import job that runs after we've responded.
+
+        The upload is copied to the spool directory, because twisted.web
+        only keeps it until the request is done.
+        """
+        request.content.seek(0)
+        with timer.stage('parse'):
+            path, spooled_md5 = spool_file(
+                request.content, self.import_spool_dir)
+        run = False
+        try:
+            if spooled_md5 != content_md5:
+                raise BadRequestParams(
+                    "Content-MD5 header does not match content.")
+            pool = yield self._get_pool(unique_code_pool, timer)
+            try:
+                job, run = yield pool.start_import_job(
+                    request_id, content_md5)
+            finally:
+                yield self._release_pool(pool, timer)
+        finally:
+            if not run:
+                os.remove(path)
+
+        if job is None:
+            # This has already been imported synchronously.
+            request.setResponseCode(201)
+            returnValue({'imported': True, 'summary': None})
+        if run:
+            self._start_import_job(unique_code_pool, job, path)
+        request.setResponseCode(202)
+        returnValue(format_import_job(job))
+
+    def _start_import_job(self, unique_code_pool, job, path):
+        key = (unique_code_pool, job['request_id'])
+
+        def forget(_):
+            del self.running_import_jobs[key]
+        d = self._run_import_job(unique_code_pool, job, path)
+        self.running_import_jobs[key] = d
+        d.addBoth(forget)
 
-    @handler(
-        '/<string:unique_code_pool>/unique_code_counts', methods=['GET'])
     @inlineCallbacks
-    def unique_code_counts(self, request, unique_code_pool):
-        # This sets the request_id on the request object.
-        get_url_params(request, [], ['request_id'])
+    def _run_import_job(self, unique_code_pool, job, path):
+        """Import the spooled file for ``job`` a batch at a time.
 
-        conn = yield self.engine.connect()
-        pool = UniqueCodePool(unique_code_pool, conn)
+        Each batch gets its own connection and transaction. Errors mark the
+        job as failed, and repeating the import request picks it up again
+        where it left off.
+        """
+        timer = self.metrics.timer('import_job', unique_code_pool)
+        request_id = job['request_id']
+        try:
+            with open(path, 'rb') as content:
+                rows = islice(lowercase_row_keys(csv.DictReader(content)),
+                              job['rows_processed'], None)
+                while job['status'] == 'running':
+                    if self.stopping_import_jobs:
+                        yield self._fail_import_job(
+                            unique_code_pool, request_id,
+                            'Interrupted by a shutdown, repeat the import'
+                            ' to resume it.', timer)
+                        break
+                    with timer.stage('parse'):
+                        batch = list(islice(rows, IMPORT_JOB_BATCH_SIZE))
+                    pool = yield self._get_pool(unique_code_pool, timer)
+                    try:
+                        job = yield pool.import_job_batch(
+                            request_id, job['rows_processed'], batch)
+                    finally:
+                        self.counts_cache.invalidate(unique_code_pool)
+                        yield self._release_pool(pool, timer)
+        except ImportJobTakenOver:
+            log.msg('Import job %s for %s was taken over.' % (
+                request_id, unique_code_pool))
+        except Exception:
+            failure = Failure()
+            log.err(failure, 'Import job %s for %s failed.' % (
+                request_id, unique_code_pool))
+            yield self._fail_import_job(
+                unique_code_pool, request_id, failure.getErrorMessage(),
+                timer)
+        finally:
+            os.remove(path)
+            timer.finish()
+
+    @inlineCallbacks
+    def _fail_import_job(self, unique_code_pool, request_id, error, timer):
+        try:
+            pool = yield self._get_pool(unique_code_pool, timer)
+            try:
+                yield pool.fail_import_job(request_id, error)
+            finally:
+                yield self._release_pool(pool, timer)
+        except Exception:
+            # The job looks abandoned once it's stale, so it can still be
+            # picked up again.
+            log.err(None, 'Error recording failure of import job %s.' % (
+                request_id,))
+
+    @handler(
+        '/<string:unique_code_pool>/import/<string:request_id>/status',
+        methods=['GET'])
+    @timed('import_status')
+    @inlineCallbacks
+    def import_status(self, request, unique_code_pool, request_id, timer):
+        set_request_id(request, request_id)
+        pool = yield self._get_pool(unique_code_pool, timer)
         try:
-            rows = yield pool.count_unique_codes()
+            job = yield pool.get_import_job(request_id)
         finally:
-            yield conn.close()
+            yield self._release_pool(pool, timer)
+        returnValue(format_import_job(job))
 
-        results = [{
+    @handler(
+        '/<string:unique_code_pool>/unique_code_counts', methods=['GET'])
+    @timed('unique_code_counts')
+    @inlineCallbacks
+    def unique_code_counts(self, request, unique_code_pool, timer):
+        with timer.stage('parse'):
+            # This sets the request_id on the request object.
+            get_url_params(request, [], ['request_id'])
+
+        # Concurrent requests share one query, and its results are reused
+        # until they're too stale or we change the counts.
+        results = yield self.counts_cache.get(
+            unique_code_pool,
+            lambda: self._read(
+                unique_code_pool, timer, self._unique_code_counts))
+        returnValue({'unique_code_counts': results})
+
+    @inlineCallbacks
+    def _unique_code_counts(self, pool):
+        rows = yield pool.count_unique_codes()
+        returnValue([{
             'flavour': row['flavour'],
             'used': row['used'],
             'count': row['count'],
-        } for row in rows]
-        returnValue({'unique_code_counts': results})
+        } for row in rows])
+
+    @stream_handler('/metrics', methods=['GET'])
+    def export_metrics(self, request):
+        """Export request latency histograms and connection pool stats in
+        Prometheus text format.
+        """
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        request.write(self.metrics.render())
+
+
+def add_conn_pool_metrics(metrics, prefix, description, conn_pool):
+    """Export a :class:`ConnectionPool`'s stats with names starting with
+    ``prefix``.
+    """
+    for stat in ['size', 'in_use', 'idle', 'waiting', 'wait_time_max']:
+        metrics.add_gauge(
+            '%s_%s' % (prefix, stat),
+            '%s %s.' % (description, stat.replace('_', ' ')),
+            lambda stat=stat: conn_pool.stats()[stat])
+    # These only ever go up.
+    for stat in ['acquired', 'timeouts', 'wait_time_total']:
+        metrics.add_counter(
+            '%s_%s' % (prefix, stat),
+            '%s %s.' % (description, stat.replace('_', ' ')),
+            lambda stat=stat: conn_pool.stats()[stat])
+
+
+def check_audit_field(field):
+    if field not in UniqueCodePool.AUDIT_QUERY_FIELDS:
+        raise BadRequestParams('Invalid audit field.')
+
+
+def parse_audit_limit(limit):
+    if limit is None:
+        return MAX_AUDIT_QUERY_LIMIT
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = None
+    if limit is None or not 1 <= limit <= MAX_AUDIT_QUERY_LIMIT:
+        raise BadRequestParams(
+            'limit must be a number from 1 to %s.' % (MAX_AUDIT_QUERY_LIMIT,))
+    return limit
+
+
+def encode_audit_cursor(cursor):
+    """Turn an audit query cursor into an opaque string for clients."""
+    if cursor is None:
+        return None
+    created_at, audit_id = cursor
+    return '%s,%s' % (created_at.strftime(CURSOR_TIME_FORMAT), audit_id)
+
+
+def decode_audit_cursor(cursor):
+    if cursor is None:
+        return None
+    try:
+        created_at, audit_id = cursor.split(',')
+        return (datetime.strptime(created_at, CURSOR_TIME_FORMAT),
+                int(audit_id))
+    except ValueError:
+        raise BadRequestParams('Invalid cursor.')
+
+
+def format_audit_record(row):
+    return {
+        'request_id': row['request_id'],
+        'transaction_id': row['transaction_id'],
+        'user_id': row['user_id'],
+        'request_data': row['request_data'],
+        'response_data': row['response_data'],
+        'error': row['error'],
+        'created_at': row['created_at'].isoformat(),
+    }
+
+
+def audit_record_json(record):
+    """Serialise an :class:`AuditRecord` like :func:`format_audit_record`.
+
+    Request and response data is spliced in as JSON text instead of being
+    decoded and encoded again.
+    """
+    plain_json = json.dumps({
+        'request_id': record['request_id'],
+        'transaction_id': record['transaction_id'],
+        'user_id': record['user_id'],
+        'error': record['error'],
+        'created_at': record['created_at'].isoformat(),
+    })
+    return u'%s, "request_data": %s, "response_data": %s}' % (
+        plain_json[:-1], record.raw_request_data, record.raw_response_data)
+
+
+def parse_async(value):
+    if value is None or value == 'false':
+        return False
+    if value == 'true':
+        return True
+    raise BadRequestParams('async must be true or false.')
+
+
+def format_import_job(job):
+    elapsed = (job['modified_at'] - job['created_at']).total_seconds()
+    rows_per_second = None
+    if elapsed > 0:
+        rows_per_second = job['rows_processed'] / elapsed
+    return {
+        'job_id': job['request_id'],
+        'status': job['status'],
+        'rows_processed': job['rows_processed'],
+        'rows_per_second': rows_per_second,
+        'summary': job['summary'],
+        'error': job['error'],
+        'created_at': job['created_at'].isoformat(),
+        'modified_at': job['modified_at'].isoformat(),
+    }
+
+
+def spool_file(fileobj, directory=None, chunk_size=READ_CHUNK_SIZE):
+    """Copy ``fileobj`` to a new file in ``directory``.
+
+    Returns the new file's path and the MD5 of its content. The file's name
+    includes our process id, see :func:`remove_orphaned_spool_files`.
+    """
+    digest = md5()
+    spool = tempfile.NamedTemporaryFile(
+        dir=directory, prefix='import-%s-' % (os.getpid(),), suffix='.csv',
+        delete=False)
+    with spool:
+        for chunk in iter(lambda: fileobj.read(chunk_size), ''):
+            digest.update(chunk)
+            spool.write(chunk)
+    return spool.name, digest.hexdigest().lower()
+
+
+def remove_orphaned_spool_files(directory):
+    """Remove files left in ``directory`` by :func:`spool_file` in processes
+    that have died without cleaning up after themselves.
+    """
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        match = SPOOL_FILE_RE.match(name)
+        if match is None or pid_exists(int(match.group(1))):
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError as e:
+            # Another process may have removed it first.
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means the process exists but belongs to somebody else.
+        return e.errno == errno.EPERM
+    return True
+
+
+def file_md5(fileobj, chunk_size=READ_CHUNK_SIZE):
+    digest = md5()
+    for chunk in iter(lambda: fileobj.read(chunk_size), ''):
+        digest.update(chunk)
+    return digest.hexdigest().lower()
 
 
 def lowercase_row_keys(rows):
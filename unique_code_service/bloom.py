@@ -0,0 +1,242 @@
+"""Bloom filters of the unique codes in a pool.
+
+Most redeems of codes that don't exist are typos and guesses. A
+:class:`UniqueCodeFilter` keeps a :class:`BloomFilter` of a pool's codes in
+memory, so that we can answer those without looking the code up in the
+database. A Bloom filter never says that a code it has seen is missing, but
+it sometimes says that a missing code might be there, in which case we look
+it up as usual.
+"""
+
+from hashlib import md5
+import math
+import struct
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import log
+
+
+class BloomFilter(object):
+    """A Bloom filter sized for ``capacity`` items at ``error_rate``.
+
+    :param int capacity: Number of items we expect to add.
+    :param float error_rate:
+        Fraction of missing items we can live with being reported as present
+        once ``capacity`` items have been added.
+    :param int max_bytes:
+        The most memory the bit array may use. If ``capacity`` and
+        ``error_rate`` need more than this, the filter uses this much and has
+        a higher error rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, max_bytes=None):
+        self.capacity = max(capacity, 1)
+        num_bits = int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        if max_bytes is not None:
+            num_bits = min(num_bits, max_bytes * 8)
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(1, int(round(
+            float(self.num_bits) / self.capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    @property
+    def size_bytes(self):
+        return len(self.bits)
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        # Two halves of one digest give us as many hashes as we need, see
+        # Kirsch and Mitzenmacher, "Less Hashing, Same Performance".
+        h1, h2 = struct.unpack('<QQ', md5(item).digest())
+        return [(h1 + i * h2) % self.num_bits
+                for i in xrange(self.num_hashes)]
+
+    def add(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def expected_error_rate(self, items):
+        """Return the false positive rate we expect with ``items`` added."""
+        k = self.num_hashes
+        return (1 - math.exp(-float(k) * items / self.num_bits)) ** k
+
+
+class UniqueCodeFilter(object):
+    """A Bloom filter of one pool's unique codes, kept in sync with the
+    database.
+
+    The filter is only trusted for ``max_staleness`` seconds after it was
+    last synced, so codes imported by other processes may be reported as
+    invalid for up to that long. Codes imported by this process are added
+    straight away.
+
+    We know the filter has every code when the number of rows we've read
+    matches the pool's unique code counts. If it doesn't, because codes
+    were committed out of id order or because the counts are wrong, the
+    filter is rebuilt from scratch, at most once every
+    :attr:`REBUILD_BACKOFF` seconds.
+
+    :param clock: Something that provides ``seconds()``.
+    :param float error_rate: See :class:`BloomFilter`.
+    :param int max_bytes: See :class:`BloomFilter`.
+    :param float max_staleness:
+        Seconds after a sync that we trust the filter for.
+    """
+
+    # Codes are read from the database this many at a time.
+    REFRESH_BATCH_SIZE = 10000
+
+    # New filters have room for twice as many codes as the pool has, and at
+    # least this many.
+    MIN_CAPACITY = 10000
+
+    # Seconds to wait before rebuilding again if a rebuild doesn't match the
+    # counts.
+    REBUILD_BACKOFF = 300
+
+    def __init__(self, clock, error_rate=0.01, max_bytes=None,
+                 max_staleness=1.0):
+        self.clock = clock
+        self.error_rate = error_rate
+        self.max_bytes = max_bytes
+        self.max_staleness = max_staleness
+        self.bloom = None
+        # A new filter that a refresh is filling in.
+        self._building = None
+        # The number of rows we've read into the filter and the biggest id
+        # among them.
+        self.rows = 0
+        self.last_id = 0
+        self.synced_at = None
+        self.refreshing = None
+        self._rebuild_after = None
+        self.skipped_lookups = 0
+
+    def is_fresh(self):
+        return self.synced_at is not None and (
+            self.clock.seconds() - self.synced_at <= self.max_staleness)
+
+    def needs_refresh(self):
+        """Return ``True`` if it's time to start a refresh.
+
+        We refresh halfway through the staleness window, so that a busy pool
+        never has to wait for one.
+        """
+        if self.refreshing is not None:
+            return False
+        if self._rebuild_after is not None and (
+                self.clock.seconds() < self._rebuild_after):
+            return False
+        return self.synced_at is None or (
+            self.clock.seconds() - self.synced_at > self.max_staleness / 2.0)
+
+    def definitely_missing(self, canonical_code):
+        """Return ``True`` if ``canonical_code`` is certainly not in the pool.
+
+        ``False`` means that it might be, or that we don't know.
+        """
+        if not self.is_fresh() or canonical_code in self.bloom:
+            return False
+        self.skipped_lookups += 1
+        return True
+
+    def stats(self):
+        """Return a dict of statistics about the filter for monitoring."""
+        if self.bloom is None:
+            size_bytes, error_rate = 0, 1.0
+        else:
+            size_bytes = self.bloom.size_bytes
+            error_rate = self.bloom.expected_error_rate(self.rows)
+        return {
+            'bytes': size_bytes,
+            'codes': self.rows,
+            'error_rate': error_rate,
+            'fresh': int(self.is_fresh()),
+            'skipped_lookups': self.skipped_lookups,
+        }
+
+    def add(self, canonical_codes):
+        """Add codes that are being imported.
+
+        Adding a code that doesn't end up in the pool costs us nothing but a
+        database lookup when somebody tries to redeem it.
+        """
+        blooms = [bloom for bloom in [self.bloom, self._building]
+                  if bloom is not None]
+        for canonical_code in canonical_codes:
+            for bloom in blooms:
+                bloom.add(canonical_code)
+
+    def refresh(self, run):
+        """Read codes we haven't seen yet from the database.
+
+        ``run(func)`` must call ``func`` with the pool bound to a connection
+        and return a :class:`Deferred` that fires with its result, so that
+        each query can use a different connection. Concurrent calls share the
+        refresh that's already running.
+        """
+        if self.refreshing is not None:
+            return self.refreshing
+        d = self.refreshing = self._refresh(run)
+
+        def done(result):
+            self.refreshing = None
+            self._building = None
+            return result
+        return d.addBoth(done)
+
+    @inlineCallbacks
+    def _refresh(self, run):
+        started = self.clock.seconds()
+        total = yield run(lambda pool: pool.total_unique_codes())
+        rebuild = self.bloom is None or self._rebuild_after is not None or (
+            total > self.bloom.capacity)
+        if rebuild:
+            bloom = self._building = BloomFilter(
+                max(total * 2, self.MIN_CAPACITY), self.error_rate,
+                self.max_bytes)
+            rows, last_id = 0, 0
+        else:
+            bloom, rows, last_id = self.bloom, self.rows, self.last_id
+
+        while True:
+            batch = yield run(lambda pool: pool.get_unique_codes_after(
+                last_id, self.REFRESH_BATCH_SIZE))
+            for row in batch:
+                bloom.add(row['unique_code'])
+            rows += len(batch)
+            if batch:
+                last_id = batch[-1]['id']
+            if len(batch) < self.REFRESH_BATCH_SIZE:
+                break
+
+        self.bloom, self.rows, self.last_id = bloom, rows, last_id
+        if rows == total:
+            self.synced_at = started
+            self._rebuild_after = None
+        elif rows > total:
+            # Codes were committed while we were reading. We'll catch up
+            # next time.
+            self.synced_at = None
+        else:
+            # We've missed codes that were committed after codes with bigger
+            # ids, or the counts are wrong.
+            self.synced_at = None
+            if rebuild:
+                log.msg('Unique code filter has %s codes but the counts say'
+                        ' %s. The counts may need reconciling.' % (
+                            rows, total))
+                self._rebuild_after = (
+                    self.clock.seconds() + self.REBUILD_BACKOFF)
+            else:
+                self._rebuild_after = self.clock.seconds()
@@ -0,0 +1,233 @@
+"""Dialect-specific strategies for inserting rows in bulk.
+
+Each inserter knows how big its batches should be and how to get a batch of
+row dicts into a table as cheaply as the database allows. Use
+:func:`get_bulk_inserter` to pick the best one for a dialect.
+
+Inserters can also skip rows that would break a unique constraint, where
+the database lets them do that as part of the insert, and they report how
+many rows they actually inserted so that callers can tell when they have.
+"""
+
+from datetime import datetime
+from StringIO import StringIO
+
+
+class BulkInserter(object):
+    """Insert batches of rows with a plain ``executemany``.
+
+    This works everywhere and is the fallback when we don't know anything
+    better for a dialect.
+    """
+
+    DEFAULT_BATCH_SIZE = 1000
+
+    # The prefix that makes an insert skip rows that break a unique
+    # constraint instead of failing, or ``None`` if we don't know one.
+    IGNORE_CONFLICTS_PREFIX = None
+
+    def __init__(self, batch_size=None):
+        if batch_size is None:
+            batch_size = self.DEFAULT_BATCH_SIZE
+        self.batch_size = batch_size
+
+    def insert(self, collection, table, rows, unique_column=None):
+        """Insert ``rows`` into ``table`` using ``collection``'s connection.
+
+        All rows must have the same keys. If ``unique_column`` is given, rows
+        whose value for that column is already in the table are skipped if
+        the database lets us do that as part of the insert. Otherwise they
+        make the insert fail with an :class:`IntegrityError`.
+
+        Returns a :class:`Deferred` that fires with the number of rows
+        inserted.
+        """
+        if unique_column is None or self.IGNORE_CONFLICTS_PREFIX is None:
+            d = collection.execute_query(table.insert(), rows)
+            return d.addCallback(lambda _: len(rows))
+        d = collection.execute_query(
+            table.insert().prefix_with(self.IGNORE_CONFLICTS_PREFIX), rows)
+        # Skipped rows aren't included in the rowcount.
+        return d.addCallback(lambda result: result.rowcount)
+
+
+class MultiValuesInserter(BulkInserter):
+    """Insert batches of rows with a single multi-row ``VALUES`` clause.
+
+    This is used for dialects that support it if we don't know anything about
+    their drivers.
+    """
+
+    # The maximum number of bind parameters a single statement may have, or
+    # ``None`` if we don't need to worry about it.
+    MAX_PARAMS = None
+
+    def __init__(self, batch_size=None, max_params=None):
+        super(MultiValuesInserter, self).__init__(batch_size)
+        if max_params is None:
+            max_params = self.MAX_PARAMS
+        self.max_params = max_params
+
+    def insert(self, collection, table, rows, unique_column=None):
+        # We don't know how to skip conflicting rows for these dialects, so
+        # we ignore unique_column and let conflicts fail the insert.
+        if self.max_params is None:
+            d = collection.execute_query(table.insert().values(rows))
+            return d.addCallback(lambda _: len(rows))
+        # Split the batch if it has too many parameters for one statement.
+        # We do this here because we only know the row width now.
+        rows_per_statement = max(1, self.max_params // len(rows[0]))
+        d = collection.execute_query(
+            table.insert().values(rows[:rows_per_statement]))
+        if len(rows) > rows_per_statement:
+            d.addCallback(lambda _: self.insert(
+                collection, table, rows[rows_per_statement:]))
+        return d.addCallback(lambda _: len(rows))
+
+
+class SQLiteInserter(BulkInserter):
+    # The sqlite3 module's executemany() runs in C and is several times faster
+    # than compiling and executing multi-row VALUES statements, so all we do
+    # is make the batches big enough to keep thread handoffs cheap.
+    DEFAULT_BATCH_SIZE = 5000
+    IGNORE_CONFLICTS_PREFIX = 'OR IGNORE'
+
+
+class MySQLInserter(BulkInserter):
+    # MySQLdb's executemany() already rewrites simple inserts into multi-row
+    # VALUES statements, so we just need to keep the batches well inside the
+    # default max_allowed_packet.
+    DEFAULT_BATCH_SIZE = 1000
+    # This also turns some other errors into warnings, but the rows we
+    # insert are complete, so conflicts are the only ones we expect.
+    IGNORE_CONFLICTS_PREFIX = 'IGNORE'
+
+
+class PostgresCopyInserter(BulkInserter):
+    """Insert batches of rows with ``COPY ... FROM STDIN``.
+
+    This needs psycopg2, because we use its ``copy_expert()`` on the raw DBAPI
+    connection underneath the collection's connection so that the copy
+    happens inside the current transaction.
+
+    ``COPY`` can't skip conflicting rows, so if we're asked to we copy into a
+    temporary table and insert from there with ``ON CONFLICT DO NOTHING``,
+    or with ``NOT EXISTS`` before PostgreSQL 9.5. The latter still fails if
+    a concurrent transaction inserts the same value.
+    """
+
+    DEFAULT_BATCH_SIZE = 10000
+
+    # Temporary tables have their own schema, so this can't clash with
+    # anything else.
+    COPY_TABLE = 'pg_temp.bulk_insert_rows'
+
+    def insert(self, collection, table, rows, unique_column=None):
+        columns = sorted(rows[0].keys())
+        dialect = collection._conn._engine.dialect
+        preparer = dialect.identifier_preparer
+        table_name = preparer.format_table(table)
+        column_names = ', '.join(preparer.quote(column) for column in columns)
+        data = StringIO(''.join(
+            copy_text_row(row[column] for column in columns) for row in rows))
+
+        if unique_column is None:
+            statements = ['COPY %s (%s) FROM STDIN' % (
+                table_name, column_names)]
+        else:
+            if dialect.server_version_info >= (9, 5):
+                skip_conflicts = 'ON CONFLICT DO NOTHING'
+            else:
+                skip_conflicts = (
+                    'WHERE NOT EXISTS (SELECT 1 FROM %(table)s'
+                    ' WHERE %(table)s.%(column)s = %(copy)s.%(column)s)' % {
+                        'table': table_name,
+                        'column': preparer.quote(unique_column),
+                        'copy': self.COPY_TABLE,
+                    })
+            statements = [
+                'CREATE TEMPORARY TABLE %s ON COMMIT DROP AS'
+                ' SELECT %s FROM %s WITH NO DATA' % (
+                    self.COPY_TABLE, column_names, table_name),
+                'COPY %s (%s) FROM STDIN' % (self.COPY_TABLE, column_names),
+                'INSERT INTO %s (%s) SELECT %s FROM %s %s' % (
+                    table_name, column_names, column_names, self.COPY_TABLE,
+                    skip_conflicts),
+                'DROP TABLE %s' % (self.COPY_TABLE,),
+            ]
+
+        # Make sure the collection exists before we go behind its back.
+        d = collection.exists()
+        d.addCallback(
+            lambda _: collection._conn._engine._defer_to_thread(
+                self._copy, collection._conn, statements, data))
+        d.addCallback(lambda inserted: len(rows) if inserted is None
+                      else inserted)
+        return d
+
+    def _copy(self, conn, statements, data):
+        """Execute ``statements``, giving ``data`` to the ``COPY``.
+
+        Returns the number of rows the ``INSERT``, if there is one, inserted.
+        """
+        # This runs in a database thread.
+        # It would be nice to make this not use private things.
+        cursor = conn._connection.connection.cursor()
+        inserted = None
+        try:
+            for sql in statements:
+                if sql.startswith('COPY '):
+                    cursor.copy_expert(sql, data)
+                else:
+                    cursor.execute(sql)
+                    if sql.startswith('INSERT '):
+                        inserted = cursor.rowcount
+        finally:
+            cursor.close()
+        return inserted
+
+
+def _copy_text_value(value):
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, datetime):
+        value = value.isoformat(' ')
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+def copy_text_row(values):
+    """Format a row of values in PostgreSQL's ``COPY`` text format."""
+    return '\t'.join(_copy_text_value(value) for value in values) + '\n'
+
+
+BULK_INSERTERS = {
+    ('postgresql', 'psycopg2'): PostgresCopyInserter,
+    ('sqlite', 'pysqlite'): SQLiteInserter,
+    ('mysql', 'mysqldb'): MySQLInserter,
+}
+
+
+def get_bulk_inserter(dialect, batch_size=None):
+    """Return the best :class:`BulkInserter` we have for ``dialect``.
+
+    :data:`BULK_INSERTERS` maps ``(dialect name, driver)`` pairs to inserter
+    classes. A driver of ``None`` matches any driver for that dialect.
+    """
+    inserter_class = BULK_INSERTERS.get((dialect.name, dialect.driver))
+    if inserter_class is None:
+        inserter_class = BULK_INSERTERS.get((dialect.name, None))
+    if inserter_class is None:
+        if dialect.supports_multivalues_insert:
+            inserter_class = MultiValuesInserter
+        else:
+            inserter_class = BulkInserter
+    return inserter_class(batch_size=batch_size)
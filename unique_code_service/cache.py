@@ -0,0 +1,79 @@
+"""A short-lived cache of responses to expensive read-only requests."""
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.python.failure import Failure
+
+
+class ResponseCache(object):
+    """Cache of values computed by ``fetch()`` functions, keyed by pool.
+
+    Concurrent :meth:`get` calls for a key that isn't cached share one call
+    to ``fetch()``. Values are kept for ``max_staleness`` seconds after their
+    fetch started, or until the key is invalidated. A fetch that's still
+    running when its key is invalidated may have missed the write that
+    invalidated it, so its value is given to the callers that were already
+    waiting for it, but isn't cached or shared with anybody else. Failures
+    are never cached.
+
+    :param clock: Something that provides ``seconds()``.
+    :param float max_staleness:
+        Seconds to keep values for. If this is zero, values aren't kept at
+        all and only concurrent fetches are shared.
+    """
+
+    def __init__(self, clock, max_staleness=1.0):
+        self.clock = clock
+        self.max_staleness = max_staleness
+        # (value, fetched_at) for each key.
+        self._values = {}
+        # Deferreds waiting for the running fetch for each key.
+        self._waiting = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def stats(self):
+        """Return a dict of statistics about the cache for monitoring."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+        }
+
+    def get(self, key, fetch):
+        """Return a :class:`Deferred` that fires with the value for ``key``,
+        calling ``fetch()`` for it if necessary.
+        """
+        value, fetched_at = self._values.get(key, (None, None))
+        if fetched_at is not None and (
+                self.clock.seconds() - fetched_at <= self.max_staleness):
+            self.hits += 1
+            return succeed(value)
+        d = Deferred()
+        waiting = self._waiting.get(key)
+        if waiting is not None:
+            self.shared += 1
+            waiting.append(d)
+            return d
+        self.misses += 1
+        waiting = self._waiting[key] = [d]
+        started = self.clock.seconds()
+        maybeDeferred(fetch).addBoth(self._fetched, key, waiting, started)
+        return d
+
+    def _fetched(self, result, key, waiting, started):
+        if self._waiting.get(key) is waiting:
+            del self._waiting[key]
+            if self.max_staleness > 0 and not isinstance(result, Failure):
+                self._values[key] = (result, started)
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def invalidate(self, key):
+        """Forget the value for ``key`` and stop sharing its running fetch.
+        """
+        self._values.pop(key, None)
+        self._waiting.pop(key, None)
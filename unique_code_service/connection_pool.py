@@ -0,0 +1,252 @@
+"""A bounded pool of alchimia connections.
+
+Connections are handed out with :meth:`ConnectionPool.acquire` and must be
+given back with :meth:`ConnectionPool.release`. Waiting for a connection
+happens in the reactor rather than in a database thread, so a busy pool never
+ties up the thread pool.
+"""
+
+from collections import deque
+
+from sqlalchemy.sql import select
+from twisted.internet.defer import Deferred, fail, maybeDeferred, gatherResults
+from twisted.python import log
+
+
+class ConnectionPoolError(Exception):
+    pass
+
+
+class ConnectionPoolTimeout(ConnectionPoolError):
+    pass
+
+
+class ConnectionPoolClosed(ConnectionPoolError):
+    pass
+
+
+class _Waiter(object):
+    def __init__(self, requested_at):
+        self.requested_at = requested_at
+        self.deferred = Deferred()
+        self.timeout_call = None
+
+
+class ConnectionPool(object):
+    """A bounded, health-checked pool of connections to an alchimia engine.
+
+    :param engine: The alchimia engine to connect to.
+    :param clock: Something that provides ``seconds()`` and ``callLater()``.
+    :param int min_size:
+        Number of idle connections to keep open even if they haven't been
+        used for a while.
+    :param int max_size:
+        Maximum number of connections, both idle and in use. This should be
+        smaller than the reactor's thread pool, otherwise every thread can end
+        up waiting on a lock held by a transaction that has no thread left to
+        finish it.
+    :param float acquire_timeout:
+        Number of seconds to wait for a connection before giving up with
+        :class:`ConnectionPoolTimeout`, or ``None`` to wait forever.
+    :param float idle_timeout:
+        Idle connections beyond ``min_size`` are closed after this many
+        seconds. Connections that we keep are checked with a trivial query
+        before being handed out again after being idle this long.
+    """
+
+    def __init__(self, engine, clock, min_size=1, max_size=10,
+                 acquire_timeout=30, idle_timeout=300):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        if min_size > max_size:
+            raise ValueError("min_size may not be bigger than max_size.")
+        self.engine = engine
+        self.clock = clock
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+
+        self._size = 0
+        self._idle = []
+        self._in_use = set()
+        self._waiters = deque()
+        self._closed = False
+
+        self.acquired_count = 0
+        self.timeout_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def stats(self):
+        """Return a dict of pool metrics.
+
+        ``wait_time_total`` and ``wait_time_max`` are in seconds and cover
+        every successful :meth:`acquire`, including the time spent opening a
+        new connection if there wasn't an idle one.
+        """
+        return {
+            'size': self._size,
+            'in_use': len(self._in_use),
+            'idle': len(self._idle),
+            'waiting': len(self._waiters),
+            'acquired': self.acquired_count,
+            'timeouts': self.timeout_count,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+        }
+
+    def acquire(self):
+        """Get a connection from the pool.
+
+        Returns a :class:`Deferred` that fires with a connection, which must
+        be returned with :meth:`release` when the caller is done with it.
+        """
+        if self._closed:
+            return fail(ConnectionPoolClosed())
+        self._reap_idle()
+        waiter = _Waiter(self.clock.seconds())
+        self._waiters.append(waiter)
+        if self.acquire_timeout is not None:
+            waiter.timeout_call = self.clock.callLater(
+                self.acquire_timeout, self._timeout_waiter, waiter)
+        self._serve_waiters()
+        return waiter.deferred
+
+    def release(self, conn):
+        """Return a connection to the pool.
+
+        Connections that are still in a transaction or have been invalidated
+        are closed instead of being reused. Returns a :class:`Deferred` that
+        fires when the connection is ready for reuse or has been closed.
+        """
+        self._in_use.discard(conn)
+        if self._closed or not self._is_healthy(conn):
+            return self._discard(conn)
+        if conn.in_transaction():
+            # Closing rolls back whatever the caller left behind.
+            return self._discard(conn)
+
+        # Outside an explicit transaction, the DBAPI connection may still have
+        # an implicit one open. We roll it back so that we don't hold any
+        # locks while idle.
+        d = conn._engine._defer_to_thread(_reset_connection, conn)
+        d.addCallbacks(
+            lambda _: self._check_in(conn), lambda f: self._discard(conn))
+        return d
+
+    def close(self):
+        """Close all idle connections and stop handing out new ones.
+
+        Connections in use are closed when they are released.
+        """
+        self._closed = True
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            self._cancel_timeout(waiter)
+            waiter.deferred.errback(ConnectionPoolClosed())
+        ds = [self._discard(conn) for conn, _ in self._idle]
+        self._idle = []
+        return gatherResults(ds)
+
+    def _is_healthy(self, conn):
+        # It would be nice to make this not use private things.
+        return not (conn.closed or conn._connection.invalidated)
+
+    def _check_in(self, conn):
+        self._idle.append((conn, self.clock.seconds()))
+        self._reap_idle()
+        self._serve_waiters()
+
+    def _discard(self, conn):
+        self._size -= 1
+        d = maybeDeferred(conn.close)
+        d.addErrback(log.err, "Error closing pooled connection.")
+        self._serve_waiters()
+        return d
+
+    def _reap_idle(self):
+        if self.idle_timeout is None:
+            return
+        cutoff = self.clock.seconds() - self.idle_timeout
+        # The oldest connections are at the start of the list.
+        while len(self._idle) > self.min_size and self._idle[0][1] < cutoff:
+            conn, _ = self._idle.pop(0)
+            self._discard(conn)
+
+    def _serve_waiters(self):
+        while self._waiters:
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+                self._hand_out(self._waiters.popleft(), conn, idle_since)
+            elif self._size < self.max_size:
+                self._size += 1
+                self._open(self._waiters.popleft())
+            else:
+                return
+
+    def _hand_out(self, waiter, conn, idle_since):
+        if not self._is_healthy(conn):
+            self._waiters.appendleft(waiter)
+            self._discard(conn)
+            return
+        if (self.idle_timeout is not None and
+                self.clock.seconds() - idle_since > self.idle_timeout):
+            # This connection may have gone stale while it was idle.
+            d = maybeDeferred(conn.execute, select([1]))
+            d.addCallback(lambda result: result.scalar())
+            d.addCallbacks(
+                lambda _: self._deliver(waiter, conn),
+                lambda f: self._retry_after_failed_check(waiter, conn))
+            return
+        self._deliver(waiter, conn)
+
+    def _retry_after_failed_check(self, waiter, conn):
+        self._waiters.appendleft(waiter)
+        self._discard(conn)
+
+    def _open(self, waiter):
+        d = self.engine.connect()
+        d.addCallbacks(
+            lambda conn: self._deliver(waiter, conn),
+            lambda f: self._open_failed(waiter, f))
+
+    def _open_failed(self, waiter, failure):
+        self._size -= 1
+        self._cancel_timeout(waiter)
+        if not waiter.deferred.called:
+            waiter.deferred.errback(failure)
+        self._serve_waiters()
+
+    def _deliver(self, waiter, conn):
+        if waiter.deferred.called:
+            # The waiter has timed out, so this connection can go to the next
+            # one instead.
+            self._check_in(conn)
+            return
+        self._cancel_timeout(waiter)
+        wait_time = self.clock.seconds() - waiter.requested_at
+        self.acquired_count += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+        self._in_use.add(conn)
+        waiter.deferred.callback(conn)
+
+    def _cancel_timeout(self, waiter):
+        if waiter.timeout_call is not None and waiter.timeout_call.active():
+            waiter.timeout_call.cancel()
+        waiter.timeout_call = None
+
+    def _timeout_waiter(self, waiter):
+        waiter.timeout_call = None
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+        self.timeout_count += 1
+        waiter.deferred.errback(ConnectionPoolTimeout(
+            "Timed out waiting for a database connection."))
+
+
+def _reset_connection(conn):
+    # This runs in a database thread.
+    # It would be nice to make this not use private things.
+    conn._connection.connection.connection.rollback()
@@ -0,0 +1,135 @@
+"""Group commit for redeems.
+
+Every redeem has a transaction of its own, with a claim, a count update and
+an audit insert, and under heavy load the audit table and its indexes are
+the hottest thing we write to. A :class:`RedeemGroupCommitter` collects the
+redeems that arrive within a few milliseconds of each other and handles them
+together with :meth:`UniqueCodePool.redeem_unique_code_group`, so that they
+share one transaction, one multi-row audit insert and one commit.
+
+The audit row is never written behind the redeem: it's committed in the same
+transaction as the claim, and a redeem is only acknowledged once that
+transaction has been committed. An acknowledged redeem therefore always has
+its audit record. If we die before the commit, neither the claim nor the
+audit row is kept, and the client can safely retry. The request_id
+idempotency check relies on this too, because it's the audit row's unique
+request_id that tells us we've seen a request before. What group commit
+costs is latency: a redeem waits up to ``interval`` seconds for company
+before its transaction starts.
+"""
+
+from sqlalchemy.exc import IntegrityError
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from .models import AuditMismatch, CannotRedeemUniqueCode
+
+
+class RedeemGroupCommitter(object):
+    """Redeems unique codes from concurrent requests in shared transactions.
+
+    :param clock: Something that provides ``callLater()``.
+    :param run:
+        ``run(func)`` must call ``func`` with the pool bound to a connection
+        of its own and return a :class:`Deferred` that fires with its result.
+    :param float interval:
+        Seconds to wait for more redeems before starting a batch.
+    :param int max_batch_size:
+        A batch is started straight away once this many redeems are waiting.
+    """
+
+    def __init__(self, clock, run, interval=0.005, max_batch_size=100):
+        self.clock = clock
+        self.run = run
+        self.interval = interval
+        self.max_batch_size = max_batch_size
+        # (candidate_code, audit_params, deferred) for redeems that haven't
+        # been started yet.
+        self._waiting = []
+        self._flush_call = None
+        self.batches = 0
+        self.redeems = 0
+
+    def stats(self):
+        """Return a dict of statistics about the batches for monitoring."""
+        return {
+            'batches': self.batches,
+            'redeems': self.redeems,
+            'waiting': len(self._waiting),
+        }
+
+    def redeem(self, candidate_code, audit_params):
+        """Redeem a unique code as :meth:`UniqueCodePool.redeem_unique_code`
+        does, in a transaction shared with other redeems.
+        """
+        d = Deferred()
+        self._waiting.append((candidate_code, audit_params, d))
+        if len(self._waiting) >= self.max_batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.interval, self.flush)
+        return d
+
+    def flush(self):
+        """Start a batch with the redeems that are waiting."""
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        batch, later, request_ids = [], [], set()
+        for item in self._waiting:
+            request_id = item[1]['request_id']
+            if request_id in request_ids or len(batch) >= self.max_batch_size:
+                # A request_id can only be audited once per transaction, so
+                # repeats wait for the next batch and are replayed there.
+                later.append(item)
+            else:
+                request_ids.add(request_id)
+                batch.append(item)
+        self._waiting = later
+        if later:
+            self._flush_call = self.clock.callLater(self.interval, self.flush)
+        if batch:
+            self.batches += 1
+            self.redeems += len(batch)
+            d = self._run_batch(batch)
+            d.addErrback(log.err, 'Error finishing a redeem batch.')
+
+    @inlineCallbacks
+    def _run_batch(self, batch):
+        items = [(candidate_code, audit_params)
+                 for candidate_code, audit_params, _ in batch]
+        try:
+            results = yield self.run(
+                lambda pool: pool.redeem_unique_code_group(items))
+        except (IntegrityError, AuditMismatch):
+            # Another process audited one of these request_ids after we
+            # looked, or one of them doesn't match its previous request.
+            # Nothing was committed, so we try each redeem on its own to
+            # find out which and keep the others from failing with it.
+            yield self._run_separately(batch)
+            return
+        except Exception:
+            failure = Failure()
+            for _, _, d in batch:
+                d.errback(failure)
+            return
+        for (_, _, d), result in zip(batch, results):
+            if isinstance(result, CannotRedeemUniqueCode):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    @inlineCallbacks
+    def _run_separately(self, batch):
+        # One at a time, so that a big batch doesn't take every connection.
+        for candidate_code, audit_params, d in batch:
+            try:
+                result = yield self.run(
+                    lambda pool: pool.redeem_unique_code(
+                        candidate_code, audit_params))
+            except Exception:
+                d.errback(Failure())
+            else:
+                d.callback(result)
@@ -0,0 +1,233 @@
+"""Maintenance commands for unique code pools.
+
+Usage::
+
+    python -m unique_code_service.manage -d CONNECTION_STRING COMMAND ...
+
+Run with ``--help`` for a list of commands.
+"""
+
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import sys
+
+from aludel.database import get_engine, CollectionMetadata, TableMissingError
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue
+from sqlalchemy.exc import IntegrityError
+from twisted.python import usage
+
+from .models import UniqueCodePool, NoUniqueCodePool, audit_bucket_range
+
+
+class PoolsOptions(usage.Options):
+    synopsis = "[POOL ...]"
+
+    def parseArgs(self, *pools):
+        self['pools'] = list(pools)
+
+
+class ReconcileCountsOptions(PoolsOptions):
+    """Rebuild the unique code counts of the named pools, or of every pool if
+    none are named. This also creates the counts table for pools that were
+    created before counts were maintained.
+    """
+
+
+class UpgradeOptions(PoolsOptions):
+    """Create any tables and indexes that are missing from the named pools,
+    or from every pool if none are named. Creating indexes on big tables can
+    block writes to them for a while. Pools that have the same unique code
+    more than once can't have a unique index on their codes, and those codes
+    need to be cleaned up before the pool can be upgraded.
+    """
+
+
+class ArchiveAuditOptions(PoolsOptions):
+    """Move audit records older than --rotate-after days out of the audit
+    tables of the named pools, or of every pool if none are named, and into
+    monthly bucket tables. Audit queries still find them there. With
+    --retain-for, buckets that ended more than that many days ago are then
+    written to gzipped JSON lines files in --archive-dir and dropped. This
+    works in small transactions, so it can run while the pools are in use.
+    Repeated requests are only recognised while their audit records are in
+    the audit table.
+    """
+
+    optParameters = [["rotate-after", None, 30,
+                      "Days to keep audit records in the audit table", int],
+                     ["retain-for", None, None,
+                      "Days to keep audit buckets in the database after they"
+                      " end (by default they're kept forever)", int],
+                     ["archive-dir", None, None,
+                      "Directory to write archived audit buckets to"]]
+
+    def postOptions(self):
+        if self['retain-for'] is not None and self['archive-dir'] is None:
+            raise usage.UsageError(
+                "--archive-dir is required with --retain-for.")
+
+
+class Options(usage.Options):
+    optParameters = [["database-connection-string", "d", None,
+                      "Database connection string"]]
+    subCommands = [["archive-audit", None, ArchiveAuditOptions,
+                    "Move old audit records into buckets and archive old"
+                    " buckets"],
+                   ["reconcile-counts", None, ReconcileCountsOptions,
+                    "Rebuild unique code counts from the unique codes"],
+                   ["upgrade", None, UpgradeOptions,
+                    "Create missing tables and indexes for existing pools"]]
+
+    def postOptions(self):
+        if self['database-connection-string'] is None:
+            raise usage.UsageError(
+                "--database-connection-string parameter is mandatory.")
+        if self.subCommand is None:
+            raise usage.UsageError("Please specify a command.")
+
+
+@inlineCallbacks
+def get_pools(conn, pool_names):
+    """Return the named pools, or all pools if ``pool_names`` is empty.
+
+    Raises :class:`NoUniqueCodePool` if a named pool doesn't exist.
+    """
+    if not pool_names:
+        metadata = CollectionMetadata(UniqueCodePool.collection_type(), conn)
+        try:
+            all_metadata = yield metadata.get_all_metadata()
+        except TableMissingError:
+            # Nobody has created any pools yet.
+            all_metadata = {}
+        pool_names = sorted(all_metadata)
+
+    pools = []
+    for pool_name in pool_names:
+        pool = UniqueCodePool(pool_name, conn)
+        exists = yield pool.exists()
+        if not exists:
+            raise NoUniqueCodePool(pool_name)
+        pools.append(pool)
+    returnValue(pools)
+
+
+@inlineCallbacks
+def reconcile_counts(conn, options, out):
+    pools = yield get_pools(conn, options['pools'])
+    for pool in pools:
+        yield pool.create_tables()
+        changes = yield pool.rebuild_counts()
+        if not changes:
+            out.write('%s: counts are correct\n' % (pool.name,))
+        for flavour, used, old_count, new_count in changes:
+            out.write('%s: flavour=%s used=%s count %s -> %s\n' % (
+                pool.name, flavour, used, old_count, new_count))
+
+
+@inlineCallbacks
+def upgrade(conn, options, out):
+    pools = yield get_pools(conn, options['pools'])
+    for pool in pools:
+        try:
+            yield pool.create_tables()
+        except IntegrityError:
+            out.write('%s: has duplicate unique codes, not upgraded\n' % (
+                pool.name,))
+            continue
+        out.write('%s: upgraded\n' % (pool.name,))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+@inlineCallbacks
+def _archive_bucket(pool, bucket, archive_dir):
+    path = os.path.join(
+        archive_dir, '%s-audit-%s.jsonl.gz' % (pool.name, bucket))
+    # We only give the file its real name once it's complete, and only drop
+    # the bucket once the file is safely on disk.
+    archive_file = open(path + '.tmp', 'wb')
+    try:
+        archive = gzip.GzipFile(path, 'wb', fileobj=archive_file)
+
+        def write(rows):
+            for row in rows:
+                archive.write(json.dumps(row, default=_json_default) + '\n')
+
+        archived = yield pool.export_audit_bucket(bucket, write)
+        archive.close()
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+    finally:
+        archive_file.close()
+    os.rename(path + '.tmp', path)
+    fsync_dir(archive_dir)
+    yield pool.drop_audit_bucket(bucket)
+    returnValue((archived, path))
+
+
+def fsync_dir(path):
+    """Make sure that changes to a directory's entries are on disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@inlineCallbacks
+def archive_audit(conn, options, out):
+    pools = yield get_pools(conn, options['pools'])
+    now = datetime.utcnow()
+    rotate_before = now - timedelta(days=options['rotate-after'])
+    for pool in pools:
+        moved = yield pool.rotate_audit(rotate_before)
+        out.write('%s: moved %s audit records into buckets\n' % (
+            pool.name, moved))
+        if options['retain-for'] is None:
+            continue
+        retain_after = now - timedelta(days=options['retain-for'])
+        buckets = yield pool.get_audit_buckets()
+        for bucket in buckets:
+            if audit_bucket_range(bucket)[1] > retain_after:
+                continue
+            archived, path = yield _archive_bucket(
+                pool, bucket, options['archive-dir'])
+            out.write('%s: archived %s audit records from %s to %s\n' % (
+                pool.name, archived, bucket, path))
+
+
+COMMANDS = {
+    'archive-audit': archive_audit,
+    'reconcile-counts': reconcile_counts,
+    'upgrade': upgrade,
+}
+
+
+@inlineCallbacks
+def main(reactor, options, out=sys.stdout):
+    engine = get_engine(options['database-connection-string'], reactor)
+    if engine.dialect.name == 'sqlite':
+        # SQLite doesn't like being used from more than one thread.
+        reactor.suggestThreadPoolSize(1)
+    conn = yield engine.connect()
+    try:
+        yield COMMANDS[options.subCommand](conn, options.subOptions, out)
+    finally:
+        yield conn.close()
+
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:])
+    except usage.UsageError as e:
+        print >> sys.stderr, '%s\n%s' % (options, e)
+        sys.exit(1)
+    task.react(main, [options])
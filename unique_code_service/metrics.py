@@ -0,0 +1,253 @@
+"""In-process latency histograms, exported in Prometheus text format.
+
+Request handlers get a :class:`StageTimer` from :meth:`Metrics.timer` and use
+it to time each stage of the request. Everything here runs in the reactor
+thread, so there's no locking, and recording a stage costs a couple of clock
+reads, a dict lookup and a bisect.
+"""
+
+from bisect import bisect_left
+from timeit import default_timer
+
+
+# Upper bounds of the histogram buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+STAGE_METRIC = 'unique_code_service_stage_seconds'
+REQUEST_METRIC = 'unique_code_service_request_seconds'
+
+# The pool label for requests for pools we don't know exist, so that requests
+# for made-up pool names can't add labels without limit.
+UNKNOWN_POOL = 'unknown'
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last count is for values bigger than every bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _NullStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullTimer(object):
+    """A :class:`StageTimer` that doesn't record anything."""
+
+    def time(self, stage, d):
+        return d
+
+    def stage(self, stage):
+        return _NullStage()
+
+    def finish(self, result=None):
+        return result
+
+
+NULL_TIMER = NullTimer()
+
+
+class _Stage(object):
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = self.timer.clock()
+
+    def __exit__(self, *exc_info):
+        self.timer.record(self.stage, self.timer.clock() - self.started)
+
+
+class StageTimer(object):
+    """Records how long the stages of a single request take.
+
+    Use :meth:`time` for stages that return a :class:`Deferred` and
+    :meth:`stage` as a context manager for synchronous ones. Call
+    :meth:`finish` when the request is done to record its total time.
+
+    If ``pool_known`` is given, it's called when the request finishes, and
+    if it doesn't return ``True`` the request is recorded with a pool of
+    :data:`UNKNOWN_POOL` instead. Stages are held back until then.
+    """
+
+    def __init__(self, metrics, endpoint, pool, pool_known=None):
+        self.metrics = metrics
+        self.clock = metrics.clock
+        self.endpoint = endpoint
+        self.pool = pool
+        self.pool_known = pool_known
+        # (stage, seconds) pairs waiting for finish() to check the pool.
+        self._pending = None if pool_known is None else []
+        self.started = self.clock()
+
+    def record(self, stage, seconds):
+        if self._pending is not None:
+            self._pending.append((stage, seconds))
+            return
+        self.metrics.observe_stage(self.endpoint, self.pool, stage, seconds)
+
+    def time(self, stage, d):
+        """Record the time until ``d`` fires, and return ``d``."""
+        started = self.clock()
+
+        def record(result):
+            self.record(stage, self.clock() - started)
+            return result
+        return d.addBoth(record)
+
+    def stage(self, stage):
+        return _Stage(self, stage)
+
+    def finish(self, result=None):
+        """Record the total time for the request.
+
+        This returns ``result`` so that it can be used as a callback.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            if not self.pool_known():
+                self.pool = UNKNOWN_POOL
+            for stage, seconds in pending:
+                self.record(stage, seconds)
+        self.metrics.observe_request(
+            self.endpoint, self.pool, self.clock() - self.started)
+        return result
+
+
+class Metrics(object):
+    """Latency histograms for each endpoint, pool and request stage.
+
+    :param clock: A function that returns the current time in seconds.
+    :param buckets: Upper bounds for the histogram buckets.
+    """
+
+    def __init__(self, clock=default_timer, buckets=DEFAULT_BUCKETS):
+        self.clock = clock
+        self.buckets = buckets
+        self._stages = {}
+        self._requests = {}
+        self._exported = []
+
+    def timer(self, endpoint, pool, pool_known=None):
+        """Return a :class:`StageTimer` for a request."""
+        return StageTimer(self, endpoint, pool, pool_known)
+
+    def _histogram(self, histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets)
+        return histogram
+
+    def observe_stage(self, endpoint, pool, stage, seconds):
+        self._histogram(
+            self._stages, (endpoint, pool, stage)).observe(seconds)
+
+    def observe_request(self, endpoint, pool, seconds):
+        self._histogram(self._requests, (endpoint, pool)).observe(seconds)
+
+    def stage_histogram(self, endpoint, pool, stage):
+        """Return the histogram for a stage, or ``None`` if it's empty."""
+        return self._stages.get((endpoint, pool, stage))
+
+    def request_histogram(self, endpoint, pool):
+        """Return the histogram for an endpoint, or ``None`` if it's empty."""
+        return self._requests.get((endpoint, pool))
+
+    def add_gauge(self, name, help_text, func, label_names=None):
+        """Export the value returned by ``func()`` as a gauge.
+
+        If ``label_names`` is given, ``func()`` must return a dict that maps
+        tuples of label values to gauge values instead.
+        """
+        self._exported.append((name, help_text, func, label_names, 'gauge'))
+
+    def add_counter(self, name, help_text, func, label_names=None):
+        """Export the value returned by ``func()`` as a counter.
+
+        This is like :meth:`add_gauge`, but for values that only ever go up
+        while the process is running.
+        """
+        self._exported.append(
+            (name, help_text, func, label_names, 'counter'))
+
+    def render(self):
+        """Return all the metrics in Prometheus text format."""
+        lines = []
+        _render_histograms(
+            lines, STAGE_METRIC,
+            "Time spent in each stage of handling a request.",
+            ('endpoint', 'pool', 'stage'), self._stages)
+        _render_histograms(
+            lines, REQUEST_METRIC, "Time spent handling a request.",
+            ('endpoint', 'pool'), self._requests)
+        for name, help_text, func, label_names, kind in self._exported:
+            if label_names is None:
+                values = {None: func()}
+            else:
+                values = func()
+                if not values:
+                    continue
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for key in sorted(values):
+                if key is None:
+                    metric = name
+                else:
+                    metric = '%s{%s}' % (
+                        name, _format_labels(label_names, key))
+                lines.append('%s %s' % (metric, _format_value(values[key])))
+        return ''.join(line + '\n' for line in lines)
+
+
+def _escape_label_value(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_labels(names, values):
+    return ','.join('%s="%s"' % (name, _escape_label_value(value))
+                    for name, value in zip(names, values))
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+def _render_histograms(lines, name, help_text, label_names, histograms):
+    if not histograms:
+        return
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s histogram' % (name,))
+    for key in sorted(histograms):
+        histogram = histograms[key]
+        labels = _format_labels(label_names, key)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %s' % (
+                name, labels, _format_value(bound), cumulative))
+        lines.append('%s_bucket{%s,le="+Inf"} %s' % (
+            name, labels, histogram.count))
+        lines.append('%s_sum{%s} %s' % (
+            name, labels, _format_value(histogram.sum)))
+        lines.append('%s_count{%s} %s' % (name, labels, histogram.count))
@@ -1,11 +1,44 @@
-from datetime import datetime
+from collections import Mapping
+import copy
+from datetime import datetime, timedelta
+from hashlib import md5
+from itertools import chain, islice, imap
 import json
+import random
 import string
 
 from aludel.database import TableCollection, make_table, CollectionMissingError
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text
-from sqlalchemy.sql import select, func
+from sqlalchemy import (
+    Column, Integer, String, DateTime, Boolean, Text, Index, MetaData,
+    inspect,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex, DropTable
+from sqlalchemy.sql import select, func, false, text, bindparam
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python.failure import Failure
+
+from .bulk_insert import get_bulk_inserter
+from .metrics import NULL_TIMER
+
+
+# The columns set when a unique code is claimed.
+CLAIM_COLUMNS = ['used', 'reason', 'modified_at']
+
+# The errors we get when creating an index that already exists.
+INDEX_EXISTS_ERR_TEMPLATES = (
+    # SQLite
+    'index %(name)s already exists',
+    # PostgreSQL
+    'relation "%(name)s" already exists',
+    # MySQL
+    "Duplicate key name '%(name)s'",
+)
+
+# The longest index name every database we support allows. PostgreSQL's
+# limit is 63 and MySQL's is 64, and SQLAlchemy doesn't shorten index names
+# we choose ourselves.
+MAX_INDEX_NAME_LENGTH = 63
 
 
 class UniqueCodeError(Exception):
@@ -20,20 +53,340 @@ class NoUniqueCodePool(UniqueCodeError):
     pass
 
 
+class NoImportJob(UniqueCodeError):
+    pass
+
+
+class ImportJobTakenOver(UniqueCodeError):
+    """Raised when another process has picked up an import job we were
+    running, because it looked abandoned.
+    """
+
+
 class CannotRedeemUniqueCode(UniqueCodeError):
     def __init__(self, reason, unique_code):
         super(CannotRedeemUniqueCode, self).__init__(reason)
         self.reason = reason
         self.unique_code = unique_code
 
+    @classmethod
+    def from_audit_response(cls, resp_data):
+        return cls(resp_data['reason'], resp_data['unique_code'])
+
+
+class CannotIssueUniqueCode(UniqueCodeError):
+    def __init__(self, reason, flavour):
+        super(CannotIssueUniqueCode, self).__init__(reason)
+        self.reason = reason
+        self.flavour = flavour
+
+    @classmethod
+    def from_audit_response(cls, resp_data):
+        return cls(resp_data['reason'], resp_data['flavour'])
+
+
+class IssueContention(UniqueCodeError):
+    """Raised when we keep losing races for unused codes.
+
+    Nothing is audited for these, so the same request can be retried.
+    """
+
+
+class ImportConflict(UniqueCodeError):
+    """Raised when a concurrent import adds some of the codes we're importing.
+
+    Nothing is imported or audited for these, so the same import can be
+    retried and will skip the codes the other import added.
+    """
+
+
+class ImportInProgress(UniqueCodeError):
+    """Raised when a synchronous import has the request_id of an asynchronous
+    import job that hasn't finished.
+
+    The job's status says how it's getting on, and repeating the import
+    asynchronously picks it up again if it has failed.
+    """
+
+
+# Audit data stored compactly starts with this, which JSON never does. See
+# :func:`encode_audit_data`.
+COMPACT_AUDIT_PREFIX = '~'
+
+# json.dumps() makes a new encoder whenever it has options, so we keep one.
+# Sorting keys would take it off the C fast path.
+_compact_json = json.JSONEncoder(separators=(',', ':'))
+_encode_json_string = json.encoder.encode_basestring_ascii
+
+
+def index_name(name):
+    """Return ``name``, shortened to :data:`MAX_INDEX_NAME_LENGTH` if it's
+    too long.
+
+    Shortened names end with a hash of the whole name, so they're still
+    unique. Names that fit are left alone, so existing indexes keep them.
+    """
+    if len(name) <= MAX_INDEX_NAME_LENGTH:
+        return name
+    digest = md5(name.encode('utf-8')).hexdigest()[:8]
+    return '%s_%s' % (name[:MAX_INDEX_NAME_LENGTH - len(digest) - 1], digest)
+
+
+def implied_audit_data(field, unique_code, error):
+    """Return what an audit row's columns tell us about one of its JSON
+    fields, as a dict of the keys we expect it to have and their values.
+
+    Returns ``None`` if the columns don't tell us anything.
+    """
+    if unique_code is None:
+        return None
+    if field == 'request_data':
+        return {'candidate_code': unique_code}
+    if error:
+        return {'unique_code': unique_code}
+    return {'unique_code': unique_code, 'used': True}
+
+
+def encode_audit_data(data, implied):
+    """Encode the request or response data for an audit row.
+
+    Most of a redeem's data repeats the audit row's columns, so if ``data``
+    is a dict with every key and value in ``implied`` (see
+    :func:`implied_audit_data`) we only store the other keys, as the members
+    of a JSON object without its braces, after :data:`COMPACT_AUDIT_PREFIX`.
+    That lets :func:`audit_data_json` put the JSON back together without
+    decoding anything. Anything else is stored as plain JSON, as all audit
+    data used to be.
+    """
+    if implied is None or not isinstance(data, dict):
+        return json.dumps(data)
+    extra = dict(data)
+    for key, value in implied.iteritems():
+        # We mustn't mistake 1 for True.
+        if key not in extra or extra[key] != value or (
+                (extra[key] is True) != (value is True)):
+            return json.dumps(data)
+        del extra[key]
+    return COMPACT_AUDIT_PREFIX + _compact_json.encode(extra)[1:-1]
+
+
+def _implied_json(implied):
+    # Implied values are codes or True, so we can skip the general encoder.
+    return ','.join(
+        '%s:%s' % (_encode_json_string(key),
+                   'true' if value is True else _encode_json_string(value))
+        for key, value in sorted(implied.iteritems()))
+
+
+def audit_data_json(text, implied):
+    """Return audit data stored by :func:`encode_audit_data` as JSON text."""
+    if not text.startswith(COMPACT_AUDIT_PREFIX):
+        return text
+    extra = text[len(COMPACT_AUDIT_PREFIX):]
+    if not extra:
+        return '{%s}' % (_implied_json(implied),)
+    return '{%s,%s}' % (_implied_json(implied), extra)
+
+
+def decode_audit_data(text, implied):
+    """Decode audit data stored by :func:`encode_audit_data`."""
+    if not text.startswith(COMPACT_AUDIT_PREFIX):
+        return json.loads(text)
+    data = dict(implied)
+    data.update(json.loads('{%s}' % (text[len(COMPACT_AUDIT_PREFIX):],)))
+    return data
+
+
+class AuditRecord(Mapping):
+    """A read-only audit record that decodes its JSON fields on demand.
+
+    The ``request_data`` and ``response_data`` fields are stored as JSON text,
+    or compactly as described in :func:`encode_audit_data`, and only decoded
+    when they're looked up. Callers that just pass them on as JSON can use
+    :attr:`raw_request_data` and :attr:`raw_response_data` instead, which
+    never need to decode anything.
+    """
+
+    FIELDS = ('request_id', 'transaction_id', 'user_id', 'request_data',
+              'response_data', 'error', 'created_at')
+    JSON_FIELDS = ('request_data', 'response_data')
+
+    def __init__(self, row):
+        self._row = row
+        self._decoded = {}
+
+    def _implied(self, key):
+        return implied_audit_data(
+            key, self._row['unique_code'], self._row['error'])
+
+    def _raw(self, key):
+        return audit_data_json(self._row[key], self._implied(key))
+
+    @property
+    def raw_request_data(self):
+        return self._raw('request_data')
+
+    @property
+    def raw_response_data(self):
+        return self._raw('response_data')
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        if key not in self.JSON_FIELDS:
+            return self._row[key]
+        if key not in self._decoded:
+            self._decoded[key] = decode_audit_data(
+                self._row[key], self._implied(key))
+        return self._decoded[key]
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __repr__(self):
+        return '<AuditRecord request_id=%r>' % (self._row['request_id'],)
+
+
+class _Canonicaliser(object):
+    """Lowercases strings and strips out characters that aren't allowed.
+
+    This uses ``str.translate()`` with precomputed tables, so the work per
+    character happens in C. Unicode strings that are all ASCII, which is all
+    of them in practice, are handled the same way. Anything else takes the
+    slow path, which gives the same results.
+
+    :meth:`batch` joins batches of codes into a single string with newlines
+    between them, so that the per-code work in Python is just a split.
+    """
+
+    BATCH_SIZE = 10000
+
+    _instances = {}
+
+    @classmethod
+    def get(cls, allowed_chars):
+        canonicaliser = cls._instances.get(allowed_chars)
+        if canonicaliser is None:
+            canonicaliser = cls._instances[allowed_chars] = cls(allowed_chars)
+        return canonicaliser
+
+    def __init__(self, allowed_chars):
+        self.allowed_chars = allowed_chars
+        all_chars = ''.join(chr(i) for i in range(256))
+        # str.translate() deletes characters before it translates the rest,
+        # so we mustn't delete uppercase letters with allowed lowercase ones.
+        keep = set(c for c in all_chars if c.lower() in allowed_chars)
+        self.table = string.maketrans(
+            string.ascii_uppercase, string.ascii_lowercase)
+        self.deletechars = ''.join(c for c in all_chars if c not in keep)
+        self.batch_deletechars = self.deletechars.replace('\n', '')
+
+    def slow(self, unique_code):
+        return ''.join(c for c in unique_code.lower()
+                       if c in self.allowed_chars)
+
+    def __call__(self, unique_code):
+        if isinstance(unique_code, unicode):
+            try:
+                ascii_code = unique_code.encode('ascii')
+            except UnicodeEncodeError:
+                return self.slow(unique_code)
+            return ascii_code.translate(
+                self.table, self.deletechars).decode('ascii')
+        return unique_code.translate(self.table, self.deletechars)
+
+    def _canonicalise_batch(self, unique_codes):
+        try:
+            joined = '\n'.join(unique_codes)
+            # A code with a newline in it would end up split in two.
+            if joined.count('\n') == len(unique_codes) - 1:
+                if isinstance(joined, unicode):
+                    return joined.encode('ascii').translate(
+                        self.table, self.batch_deletechars).decode(
+                            'ascii').split('\n')
+                return joined.translate(
+                    self.table, self.batch_deletechars).split('\n')
+        except UnicodeError:
+            # Either there's a non-ASCII unicode code, or we have a mixture
+            # of unicode and non-ASCII bytes that can't be joined.
+            pass
+        return [self(unique_code) for unique_code in unique_codes]
+
+    def batch(self, unique_codes):
+        return chain.from_iterable(imap(
+            self._canonicalise_batch,
+            iter_batches(unique_codes, self.BATCH_SIZE)))
+
+
+def iter_batches(iterable, batch_size):
+    """Split an iterable into lists of at most ``batch_size`` items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def audit_bucket(created_at):
+    """Return the name of the audit bucket for a creation time.
+
+    Buckets hold a calendar month each, and are named ``YYYYMM``.
+    """
+    return created_at.strftime('%Y%m')
+
+
+def audit_bucket_range(bucket):
+    """Return the ``(starts_at, ends_at)`` of an audit bucket.
+
+    The bucket holds records created at or after ``starts_at`` and before
+    ``ends_at``.
+    """
+    starts_at = datetime.strptime(bucket, '%Y%m')
+    ends_at = (starts_at + timedelta(days=32)).replace(day=1)
+    return starts_at, ends_at
+
 
 class UniqueCodePool(TableCollection):
     # We assume all unique codes match this.
     UNIQUE_CODE_ALLOWED_CHARS = string.lowercase + string.digits
 
+    # Imports are inserted in batches so that we never need to hold the whole
+    # import in memory. If this is ``None``, the bulk inserter for the
+    # database dialect picks a suitable batch size.
+    IMPORT_BATCH_SIZE = None
+
+    # Imports look for existing codes this many at a time, which keeps us
+    # inside SQLite's limit on bind parameters.
+    IMPORT_LOOKUP_SIZE = 500
+
+    # Imports report at most this many of the rows they reject.
+    MAX_REJECTED_ROWS = 100
+
+    # Audit records are moved into bucket tables this many at a time, each
+    # batch in a short transaction of its own. This also keeps us inside
+    # SQLite's limit on bind parameters.
+    AUDIT_ROTATE_BATCH_SIZE = 500
+
+    # Archived audit buckets are read this many records at a time.
+    AUDIT_ARCHIVE_BATCH_SIZE = 1000
+
+    # Asynchronous import jobs that haven't made progress for this many
+    # seconds are assumed to have been abandoned and can be picked up again.
+    IMPORT_JOB_STALE_AFTER = 300
+
+    # When we can't skip locked rows, issuing a code picks randomly from this
+    # many candidates and gives up after losing this many rounds of races.
+    ISSUE_CANDIDATES = 10
+    ISSUE_ATTEMPTS = 3
+
+    # The unique_code column has a unique index, see :meth:`__init__`.
     unique_codes = make_table(
         Column("id", Integer(), primary_key=True),
-        Column("unique_code", String(255), nullable=False, index=True),
+        Column("unique_code", String(255), nullable=False),
         Column("flavour", String(255), index=True),
         Column("used", Boolean(), default=False, index=True),
         Column("created_at", DateTime(timezone=False)),
@@ -41,17 +394,21 @@ class UniqueCodePool(TableCollection):
         Column("reason", String(255), default=None),
     )
 
+    # The transaction_id, user_id and unique_code columns are indexed along
+    # with the audit query ordering, see :attr:`PAGE_INDEXES`. Old records
+    # can be moved into monthly bucket tables with the same columns, see
+    # :meth:`rotate_audit`.
     audit = make_table(
         Column("id", Integer(), primary_key=True),
         Column("request_id", String(255), nullable=False, index=True,
                unique=True),
-        Column("transaction_id", String(255), nullable=False, index=True),
-        Column("user_id", String(255), nullable=False, index=True),
+        Column("transaction_id", String(255), nullable=False),
+        Column("user_id", String(255), nullable=False),
         Column("request_data", Text(), nullable=False),
         Column("response_data", Text(), nullable=False),
         Column("error", Boolean(), nullable=False),
         Column("created_at", DateTime(timezone=False)),
-        Column("unique_code", String(255), index=True),
+        Column("unique_code", String(255)),
     )
 
     import_audit = make_table(
@@ -62,6 +419,133 @@ class UniqueCodePool(TableCollection):
         Column("created_at", DateTime(timezone=False)),
     )
 
+    # Asynchronous imports and how far they've got, see
+    # :meth:`start_import_job`.
+    import_jobs = make_table(
+        Column("id", Integer(), primary_key=True),
+        Column("request_id", String(255), nullable=False, index=True,
+               unique=True),
+        Column("content_md5", String(255), nullable=False),
+        Column("status", String(255), nullable=False),
+        Column("rows_processed", Integer(), nullable=False),
+        Column("summary", Text(), nullable=False),
+        Column("error", Text()),
+        Column("created_at", DateTime(timezone=False)),
+        Column("modified_at", DateTime(timezone=False)),
+    )
+
+    # Running totals of unique_codes grouped by flavour and used, kept up to
+    # date in the same transactions that change unique_codes. These can be
+    # rebuilt from scratch with :meth:`rebuild_counts`. Codes without a
+    # flavour aren't kept here, see :meth:`count_unique_codes`.
+    unique_code_counts = make_table(
+        Column("flavour", String(255), primary_key=True),
+        Column("used", Boolean(), primary_key=True),
+        Column("count", Integer(), nullable=False),
+    )
+
+    # Fields we can query the audit table by.
+    AUDIT_QUERY_FIELDS = ('request_id', 'transaction_id', 'user_id',
+                          'unique_code')
+
+    # Composite indexes for paging through audit queries in (created_at, id)
+    # order, as (table attribute, leading column) pairs.
+    PAGE_INDEXES = [
+        ('audit', 'transaction_id'),
+        ('audit', 'user_id'),
+        ('audit', 'unique_code'),
+    ]
+
+    # Request handlers replace this with a StageTimer on the pools they use,
+    # to record how long each stage of a request takes.
+    stage_timer = NULL_TIMER
+
+    # Request handlers may replace this with the pool's UniqueCodeFilter, so
+    # that redeems of codes that are certainly not in the pool don't need to
+    # look them up. Imports add their codes to it.
+    code_filter = None
+
+    def __init__(self, name, connection, collection_metadata=None):
+        super(UniqueCodePool, self).__init__(
+            name, connection, collection_metadata)
+        # Compiled statements, keyed by name and dialect. Copies made by
+        # :meth:`bind` share this, see :meth:`_compiled`.
+        self._compiled_statements = {}
+        # Audit bucket tables, keyed by bucket name. These are only built
+        # when we need them, and copies made by :meth:`bind` share them.
+        self._audit_bucket_metadata = MetaData()
+        self._audit_bucket_tables = {}
+        # What we've found out about the pool's tables in the database, see
+        # :meth:`_has_unique_request_ids`. Copies made by :meth:`bind`
+        # share this too.
+        self._schema_checks = {}
+        for table_attr, column in self.PAGE_INDEXES:
+            table = getattr(self, table_attr)
+            # Index names must be unique across the whole database, so they
+            # include the table name.
+            Index(index_name('ix_%s_%s_page' % (table.name, column)),
+                  table.c[column], table.c.created_at, table.c.id)
+        # Each code is in a pool at most once. Pools created before this
+        # have a non-unique ix_*_unique_code index instead, so this one has
+        # a different name and create_tables() can add it to them.
+        Index(index_name('ux_%s_unique_code' % (self.unique_codes.name,)),
+              self.unique_codes.c.unique_code, unique=True)
+
+    def create_tables(self, metadata=None):
+        """Create this pool's tables and indexes if they don't exist.
+
+        This is safe to call on an existing pool, and adds any tables or
+        indexes that are missing.
+        """
+        d = super(UniqueCodePool, self).create_tables(metadata)
+        d.addCallback(lambda _: self._create_indexes())
+        d.addCallback(lambda _: self._schema_checks.clear())
+        return d
+
+    @inlineCallbacks
+    def _create_indexes(self, tables=None):
+        # aludel only creates the tables themselves, so we do this part.
+        if tables is None:
+            tables = self._metadata.sorted_tables
+        for table in tables:
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                try:
+                    yield self._conn.execute(CreateIndex(index))
+                except Exception as e:
+                    if not any(template % {'name': index.name} in str(e)
+                               for template in INDEX_EXISTS_ERR_TEMPLATES):
+                        raise
+
+    def bind(self, connection):
+        """Return a copy of this pool that uses a different connection.
+
+        The copy shares table objects and the collection existence cache with
+        this pool, so neither needs to be built again.
+        """
+        # Make sure the existence cache exists so that the copies share it.
+        self._collection_metadata._existence_cache
+        pool = copy.copy(self)
+        pool._conn = connection
+        pool._collection_metadata = copy.copy(self._collection_metadata)
+        pool._collection_metadata._conn = connection
+        return pool
+
+    def known_missing(self):
+        """Return ``True`` if we've already seen that this pool is missing.
+
+        This never touches the database.
+        """
+        return self._collection_metadata._existence_cache.get(
+            self.name) is False
+
+    def known_to_exist(self):
+        """Return ``True`` if we've already seen that this pool exists.
+
+        This never touches the database.
+        """
+        return self._collection_metadata._existence_cache.get(
+            self.name) is True
+
     @inlineCallbacks
     def execute_query(self, query, *args, **kw):
         try:
@@ -71,6 +555,25 @@ class UniqueCodePool(TableCollection):
             raise NoUniqueCodePool(self.name)
         returnValue(result)
 
+    def _compiled(self, name, build, column_keys=None):
+        """Return a compiled statement to execute on our connection.
+
+        Statements that run on every request never change shape, so we build
+        and compile them once instead of on every execution. ``build`` is
+        called with no arguments to make the statement, and must use
+        :func:`bindparam` for everything that varies between executions. For
+        inserts and updates, ``column_keys`` lists the columns whose values
+        will be passed as parameters.
+        """
+        dialect = self._conn._engine.dialect
+        key = (name, dialect)
+        compiled = self._compiled_statements.get(key)
+        if compiled is None:
+            compiled = build().compile(
+                dialect=dialect, column_keys=column_keys)
+            self._compiled_statements[key] = compiled
+        return compiled
+
     @classmethod
     def canonicalise_unique_code(cls, unique_code):
         """Clean spurious characters out of unique code entries.
@@ -78,57 +581,204 @@ class UniqueCodePool(TableCollection):
         The unique_code is cleaned by converting it to lowercase and stripping
         out any characters not in :attr:`UNIQUE_CODE_ALLOWED_CHARS`.
         """
-        return ''.join(c for c in unique_code.lower()
-                       if c in cls.UNIQUE_CODE_ALLOWED_CHARS)
+        return _Canonicaliser.get(cls.UNIQUE_CODE_ALLOWED_CHARS)(unique_code)
+
+    @classmethod
+    def canonicalise_unique_codes(cls, unique_codes):
+        """Canonicalise an iterable of unique codes.
+
+        This returns a lazy iterator over the cleaned codes, in the same
+        order, with as little work per code as we can manage. See
+        :meth:`canonicalise_unique_code`.
+        """
+        return _Canonicaliser.get(cls.UNIQUE_CODE_ALLOWED_CHARS).batch(
+            unique_codes)
+
+    def _audit_row(self, audit_params, req_data, resp_data, unique_code,
+                   error=False):
+        return {
+            'request_id': audit_params['request_id'],
+            'transaction_id': audit_params['transaction_id'],
+            'user_id': audit_params['user_id'],
+            'request_data': encode_audit_data(req_data, implied_audit_data(
+                'request_data', unique_code, error)),
+            'response_data': encode_audit_data(resp_data, implied_audit_data(
+                'response_data', unique_code, error)),
+            'error': error,
+            'created_at': datetime.utcnow(),
+            'unique_code': unique_code,
+        }
 
     def _audit_request(self, audit_params, req_data, resp_data, unique_code,
                        error=False):
-        request_id = audit_params['request_id']
-        transaction_id = audit_params['transaction_id']
-        user_id = audit_params['user_id']
-        return self.execute_query(
-            self.audit.insert().values(
-                request_id=request_id,
-                transaction_id=transaction_id,
-                user_id=user_id,
-                request_data=json.dumps(req_data),
-                response_data=json.dumps(resp_data),
-                error=error,
-                created_at=datetime.utcnow(),
-                unique_code=unique_code,
-            ))
+        return self._insert_audit([self._audit_row(
+            audit_params, req_data, resp_data, unique_code, error)])
 
-    @inlineCallbacks
-    def _get_previous_request(self, audit_params, req_data):
-        rows = yield self.execute_fetchall(
-            self.audit.select().where(
-                self.audit.c.request_id == audit_params['request_id']))
-        if not rows:
-            returnValue(None)
-        [row] = rows
+    def _insert_audit(self, rows):
+        """Insert audit rows made by :meth:`_audit_row`."""
+        # We never need the new ids, so the insert doesn't fetch them.
+        return self.execute_query(self._compiled(
+            'insert_audit', lambda: self.audit.insert(inline=True),
+            sorted(rows[0])), rows)
+
+    def _previous_response(self, row, audit_params, req_data,
+                           error_class=CannotRedeemUniqueCode):
+        """Return the response to a previous request with the same audit row.
+
+        If the request doesn't match the previous one, :class:`AuditMismatch`
+        is raised. If the previous request failed, the same failure is raised
+        again as an ``error_class``.
+        """
         old_audit_params = {
             'request_id': row['request_id'],
             'transaction_id': row['transaction_id'],
             'user_id': row['user_id'],
         }
-        old_req_data = json.loads(row['request_data'])
-        old_resp_data = json.loads(row['response_data'])
+        record = AuditRecord(row)
+        old_req_data = record['request_data']
+        old_resp_data = record['response_data']
         if audit_params != old_audit_params or req_data != old_req_data:
             raise AuditMismatch()
 
         if row['error']:
-            raise CannotRedeemUniqueCode(
-                old_resp_data['reason'], old_resp_data['unique_code'])
-        returnValue(json.loads(row['response_data']))
+            raise error_class.from_audit_response(old_resp_data)
+        return old_resp_data
+
+    @inlineCallbacks
+    def _get_previous_request(self, audit_params, req_data,
+                              error_class=CannotRedeemUniqueCode):
+        # Pools without a unique request_id index may have been given the
+        # same request_id more than once, in which case the first request
+        # is the one we repeat.
+        rows = yield self.execute_fetchall(self._compiled(
+            'select_audit_by_request_id', lambda: self.audit.select().where(
+                self.audit.c.request_id == bindparam('b_request_id')
+            ).order_by(self.audit.c.id).limit(1)),
+            b_request_id=audit_params['request_id'])
+        if not rows:
+            returnValue(None)
+        returnValue(self._previous_response(
+            rows[0], audit_params, req_data, error_class))
+
+    def get_bulk_inserter(self):
+        """Return the :class:`BulkInserter` to use for imports.
+
+        Override this to plug in a different bulk insert strategy.
+        """
+        return get_bulk_inserter(
+            self._conn._engine.dialect, self.IMPORT_BATCH_SIZE)
+
+    @inlineCallbacks
+    def _find_unique_codes(self, canonical_codes):
+        """Return the set of ``canonical_codes`` that are already in the pool.
+        """
+        found = set()
+        for batch in iter_batches(canonical_codes, self.IMPORT_LOOKUP_SIZE):
+            rows = yield self.execute_fetchall(
+                select([self.unique_codes.c.unique_code]).where(
+                    self.unique_codes.c.unique_code.in_(batch)))
+            found.update(row['unique_code'] for row in rows)
+        returnValue(found)
+
+    @inlineCallbacks
+    def _import_batch(self, inserter, batch, first_row, now, summary,
+                      count_deltas):
+        canonical_codes = list(self.canonicalise_unique_codes(
+            unique_code_dict.get('unique_code') or ''
+            for unique_code_dict in batch))
+        # Earlier batches of this import have already been inserted in our
+        # transaction, so this finds duplicates within the import as well as
+        # codes that were already in the pool.
+        existing = yield self._find_unique_codes(
+            sorted(set(canonical_codes) - set([''])))
+
+        rows = []
+        for i, (unique_code_dict, canonical_code) in enumerate(
+                zip(batch, canonical_codes)):
+            if not canonical_code:
+                reason = 'invalid'
+            elif canonical_code in existing:
+                reason = 'duplicate'
+            else:
+                existing.add(canonical_code)
+                # Column defaults aren't applied to every row of a multi-row
+                # insert, so we fill them in ourselves.
+                rows.append({
+                    'flavour': unique_code_dict['flavour'],
+                    'unique_code': canonical_code,
+                    'used': False,
+                    'reason': None,
+                    'created_at': now,
+                    'modified_at': now,
+                })
+                continue
+            summary['rejected'][reason] += 1
+            if len(summary['rejected_rows']) < self.MAX_REJECTED_ROWS:
+                summary['rejected_rows'].append({
+                    'row': first_row + i,
+                    'unique_code': unique_code_dict.get('unique_code'),
+                    'reason': reason,
+                })
+
+        if rows:
+            if self.code_filter is not None:
+                self.code_filter.add(row['unique_code'] for row in rows)
+            inserted = yield self.stage_timer.time('insert', inserter.insert(
+                self, self.unique_codes, rows, unique_column='unique_code'))
+            if inserted != len(rows):
+                # Another import has added some of these codes since we
+                # looked, and we can't tell which ones to count.
+                raise ImportConflict()
+        summary['inserted'] += len(rows)
+        for row in rows:
+            key = (row['flavour'], False)
+            count_deltas[key] = count_deltas.get(key, 0) + 1
+            # We create the used counter as well so that redeems never
+            # need to.
+            count_deltas.setdefault((row['flavour'], True), 0)
+
+    def _new_import_summary(self):
+        return {
+            'inserted': 0,
+            'rejected': {'invalid': 0, 'duplicate': 0},
+            'rejected_rows': [],
+        }
+
+    def _select_import_audit(self, request_id):
+        return self.execute_fetchall(self._compiled(
+            'select_import_audit_by_request_id',
+            lambda: self.import_audit.select().where(
+                self.import_audit.c.request_id == bindparam('b_request_id'))),
+            b_request_id=request_id)
 
     @inlineCallbacks
     def import_unique_codes(self, request_id, content_md5, unique_code_dicts):
-        trx = yield self._conn.begin()
+        """Import unique codes from an iterable of dicts.
+
+        The iterable is consumed lazily and inserted in batches, all within a
+        single transaction. See :mod:`unique_code_service.bulk_insert` for the
+        dialect-specific details.
+
+        Codes are canonicalised before they're stored, so that they can be
+        redeemed. Codes that are empty once canonicalised are rejected as
+        ``invalid``, and codes that are already in the pool or appear earlier
+        in the import are rejected as ``duplicate``. Returns a summary dict
+        with the number of codes ``inserted``, the number ``rejected`` for
+        each reason and the first :attr:`MAX_REJECTED_ROWS` of the
+        ``rejected_rows``, numbered from 1. If the import has already been
+        done, nothing is imported and ``None`` is returned.
+
+        If a concurrent import adds some of the same codes, nothing is
+        imported and :class:`ImportConflict` is raised. If an asynchronous
+        import job with the same request_id hasn't finished, nothing is
+        imported and :class:`ImportInProgress` is raised, or
+        :class:`AuditMismatch` if the job has different content.
+        """
+        timer = self.stage_timer
+        trx = yield timer.time('begin', self._conn.begin())
 
         # Check if we've already done this one.
-        rows = yield self.execute_fetchall(
-            self.import_audit.select().where(
-                self.import_audit.c.request_id == request_id))
+        rows = yield self._select_import_audit(request_id)
         if rows:
             yield trx.rollback()
             [row] = rows
@@ -136,6 +786,13 @@ class UniqueCodePool(TableCollection):
                 returnValue(None)
             else:
                 raise AuditMismatch(row['content_md5'])
+        # Finished jobs have an import_audit row, so this one isn't done.
+        job = yield self._select_import_job(request_id, for_update=True)
+        if job is not None:
+            yield trx.rollback()
+            if job['content_md5'] != content_md5:
+                raise AuditMismatch(job['content_md5'])
+            raise ImportInProgress(request_id)
 
         yield self.execute_query(
             self.import_audit.insert().values(
@@ -144,20 +801,256 @@ class UniqueCodePool(TableCollection):
                 created_at=datetime.utcnow(),
             ))
 
-        # NOTE: We're assuming that this will be fast enough. If it isn't,
-        # we'll need to make a database-specific plan of some kind.
+        inserter = self.get_bulk_inserter()
         now = datetime.utcnow()
-        unique_code_rows = [{
-            'flavour': unique_code_dict['flavour'],
-            'unique_code': unique_code_dict['unique_code'],
-            'created_at': now,
-            'modified_at': now,
-        } for unique_code_dict in unique_code_dicts]
-        result = yield self.execute_query(
-            self.unique_codes.insert(), unique_code_rows)
+        summary = self._new_import_summary()
+        count_deltas = {}
+        first_row = 1
+        try:
+            for batch in iter_batches(unique_code_dicts, inserter.batch_size):
+                yield self._import_batch(
+                    inserter, batch, first_row, now, summary, count_deltas)
+                first_row += len(batch)
+            yield timer.time('count', self._adjust_counts(count_deltas))
+        except Exception:
+            failure = Failure()
+            yield timer.time('rollback', trx.rollback())
+            failure.raiseException()
+        yield timer.time('commit', trx.commit())
+        returnValue(summary)
+
+    def _format_import_job(self, row):
+        job = dict(row)
+        job['summary'] = json.loads(job['summary'])
+        return job
+
+    @inlineCallbacks
+    def _select_import_job(self, request_id, for_update=False):
+        query = self.import_jobs.select().where(
+            self.import_jobs.c.request_id == request_id)
+        if for_update:
+            query = query.with_for_update()
+        rows = yield self.execute_fetchall(query)
+        if not rows:
+            returnValue(None)
+        returnValue(self._format_import_job(rows[0]))
+
+    @inlineCallbacks
+    def get_import_job(self, request_id):
+        """Return the asynchronous import job for ``request_id``.
+
+        Raises :class:`NoImportJob` if there isn't one.
+        """
+        job = yield self._select_import_job(request_id)
+        if job is None:
+            raise NoImportJob(request_id)
+        returnValue(job)
+
+    @inlineCallbacks
+    def _start_import_job(self, request_id, content_md5):
+        now = datetime.utcnow()
+        job = yield self._select_import_job(request_id, for_update=True)
+        if job is None:
+            rows = yield self._select_import_audit(request_id)
+            if rows:
+                [row] = rows
+                if row['content_md5'] != content_md5:
+                    raise AuditMismatch(row['content_md5'])
+                returnValue((None, False))
+            job = {
+                'request_id': request_id,
+                'content_md5': content_md5,
+                'status': 'running',
+                'rows_processed': 0,
+                'summary': json.dumps(self._new_import_summary()),
+                'error': None,
+                'created_at': now,
+                'modified_at': now,
+            }
+            yield self.execute_query(self.import_jobs.insert().values(**job))
+            returnValue((self._format_import_job(job), True))
+
+        if job['content_md5'] != content_md5:
+            raise AuditMismatch(job['content_md5'])
+        stale = job['status'] == 'running' and (
+            now - job['modified_at'] >
+            timedelta(seconds=self.IMPORT_JOB_STALE_AFTER))
+        if job['status'] != 'failed' and not stale:
+            returnValue((job, False))
+        values = {'status': 'running', 'error': None, 'modified_at': now}
+        yield self.execute_query(self.import_jobs.update().where(
+            self.import_jobs.c.request_id == request_id).values(**values))
+        job.update(values)
+        returnValue((job, True))
+
+    @inlineCallbacks
+    def start_import_job(self, request_id, content_md5):
+        """Create the asynchronous import job for ``request_id``, or pick up
+        an existing one.
+
+        Returns ``(job, run)``, where ``run`` is ``True`` if the caller must
+        process the import with :meth:`import_job_batch`, starting after the
+        job's ``rows_processed``. That's the case for new jobs, for jobs that
+        failed and for jobs that haven't made progress for
+        :attr:`IMPORT_JOB_STALE_AFTER` seconds. If the same import has
+        already been done by :meth:`import_unique_codes`, ``(None, False)``
+        is returned.
+
+        Raises :class:`AuditMismatch` if the import has already been done or
+        started with different content.
+        """
+        trx = yield self._conn.begin()
+        try:
+            result = yield self._start_import_job(request_id, content_md5)
+        except IntegrityError:
+            # Somebody else has just started this job.
+            yield trx.rollback()
+            job = yield self.get_import_job(request_id)
+            if job['content_md5'] != content_md5:
+                raise AuditMismatch(job['content_md5'])
+            returnValue((job, False))
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
         yield trx.commit()
         returnValue(result)
 
+    @inlineCallbacks
+    def _import_job_batch(self, request_id, rows_processed,
+                          unique_code_dicts):
+        now = datetime.utcnow()
+        job = yield self._select_import_job(request_id, for_update=True)
+        if job['status'] != 'running' or (
+                job['rows_processed'] != rows_processed):
+            raise ImportJobTakenOver(request_id)
+        values = {'modified_at': now}
+        if unique_code_dicts:
+            count_deltas = {}
+            yield self._import_batch(
+                self.get_bulk_inserter(), unique_code_dicts,
+                rows_processed + 1, now, job['summary'], count_deltas)
+            yield self.stage_timer.time(
+                'count', self._adjust_counts(count_deltas))
+            values['rows_processed'] = rows_processed + len(unique_code_dicts)
+            values['summary'] = json.dumps(job['summary'])
+        else:
+            # Recording the import makes repeating it a no-op, just like
+            # repeating a synchronous import. A synchronous import that
+            # started before this job may have recorded it already.
+            rows = yield self._select_import_audit(request_id)
+            if not rows:
+                yield self.execute_query(self.import_audit.insert().values(
+                    request_id=request_id,
+                    content_md5=job['content_md5'],
+                    created_at=now,
+                ))
+            elif rows[0]['content_md5'] != job['content_md5']:
+                raise AuditMismatch(rows[0]['content_md5'])
+            values['status'] = 'done'
+        yield self.execute_query(self.import_jobs.update().where(
+            self.import_jobs.c.request_id == request_id).values(**values))
+        values.pop('summary', None)
+        job.update(values)
+        returnValue(job)
+
+    @inlineCallbacks
+    def import_job_batch(self, request_id, rows_processed, unique_code_dicts):
+        """Import the next batch of rows for an asynchronous import job.
+
+        ``rows_processed`` is the number of rows the caller has already
+        processed, which must match the job. Each batch is imported in its
+        own transaction along with the job's progress, so that a job that is
+        picked up again carries on where it left off. An empty batch finishes
+        the job. Returns the updated job.
+        """
+        timer = self.stage_timer
+        trx = yield timer.time('begin', self._conn.begin())
+        try:
+            job = yield self._import_job_batch(
+                request_id, rows_processed, unique_code_dicts)
+        except Exception:
+            failure = Failure()
+            yield timer.time('rollback', trx.rollback())
+            failure.raiseException()
+        yield timer.time('commit', trx.commit())
+        returnValue(job)
+
+    def fail_import_job(self, request_id, error):
+        """Record that an asynchronous import job has failed.
+
+        The job can be picked up again with :meth:`start_import_job`.
+        """
+        return self.execute_query(self.import_jobs.update().where(
+            (self.import_jobs.c.request_id == request_id) &
+            (self.import_jobs.c.status == 'running')
+        ).values(status='failed', error=error, modified_at=datetime.utcnow()))
+
+    @inlineCallbacks
+    def _adjust_counts(self, count_deltas):
+        """Apply changes to the unique code counts.
+
+        :param dict count_deltas:
+            A mapping of ``(flavour, used)`` to the number of unique codes to
+            add to that count.
+
+        This must be called inside the transaction that changes the unique
+        codes being counted. Codes without a flavour aren't counted here.
+        """
+        has_counts_table = yield self._has_counts_table()
+        if not has_counts_table:
+            return
+        counts = self.unique_code_counts
+        # We update the counters in a consistent order so that concurrent
+        # transactions can't deadlock each other.
+        update = self._compiled(
+            'update_count', lambda: counts.update().where(
+                (counts.c.flavour == bindparam('b_flavour')) &
+                (counts.c.used == bindparam('b_used'))
+            ).values(count=counts.c.count + bindparam('b_delta')))
+        for (flavour, used), delta in sorted(count_deltas.items()):
+            if flavour is None:
+                continue
+            result = yield self.execute_query(
+                update, b_flavour=flavour, b_used=used, b_delta=delta)
+            if result.rowcount == 0:
+                yield self._insert_count(flavour, used, delta, update)
+
+    @inlineCallbacks
+    def _insert_count(self, flavour, used, delta, update):
+        insert = self._compiled(
+            'insert_count', lambda: self.unique_code_counts.insert(
+                inline=True), ['flavour', 'used', 'count'])
+        if self._conn._engine.dialect.name == 'sqlite':
+            # Only one transaction can write at a time, so nobody else can
+            # have inserted this counter since we tried to update it.
+            yield self.execute_query(
+                insert, flavour=flavour, used=used, count=delta)
+            return
+        # A concurrent transaction may insert the same counter first. The
+        # savepoint lets us carry on with our transaction and update the
+        # counter they inserted once they've committed.
+        yield self.execute_query(text("SAVEPOINT insert_count"))
+        try:
+            yield self.execute_query(
+                insert, flavour=flavour, used=used, count=delta)
+        except IntegrityError:
+            yield self.execute_query(
+                text("ROLLBACK TO SAVEPOINT insert_count"))
+            yield self.execute_query(
+                update, b_flavour=flavour, b_used=used, b_delta=delta)
+        else:
+            yield self.execute_query(text("RELEASE SAVEPOINT insert_count"))
+
+    def _count_claims(self, unique_codes):
+        count_deltas = {}
+        for unique_code in unique_codes:
+            unused_key = (unique_code['flavour'], False)
+            used_key = (unique_code['flavour'], True)
+            count_deltas[unused_key] = count_deltas.get(unused_key, 0) - 1
+            count_deltas[used_key] = count_deltas.get(used_key, 0) + 1
+        return self._adjust_counts(count_deltas)
+
     def _format_unique_code(self, unique_code_row, fields=None):
         if fields is None:
             fields = set(f for f in unique_code_row.keys()
@@ -166,106 +1059,838 @@ class UniqueCodePool(TableCollection):
 
     @inlineCallbacks
     def _get_unique_code(self, canonical_code):
-        result = yield self.execute_query(
-            self.unique_codes.select().where(
-                self.unique_codes.c.unique_code == canonical_code,
-            ).limit(1))
+        result = yield self.execute_query(self._compiled(
+            'select_unique_code', lambda: self.unique_codes.select().where(
+                self.unique_codes.c.unique_code ==
+                bindparam('b_unique_code'))),
+            b_unique_code=canonical_code)
         unique_code = yield result.fetchone()
         if unique_code is not None:
             unique_code = self._format_unique_code(unique_code)
         returnValue(unique_code)
 
-    def _update_unique_code(self, unique_code_id, **values):
-        values['modified_at'] = datetime.utcnow()
-        return self.execute_query(
-            self.unique_codes.update().where(
-                self.unique_codes.c.id == unique_code_id).values(**values))
+    def _supports_returning(self):
+        # It would be nice to make this not use private things.
+        return self._conn._engine.dialect.implicit_returning
 
     @inlineCallbacks
-    def _redeem_unique_code(self, canonical_code, reason):
+    def _claim_unique_code_returning(self, canonical_code, reason):
+        result = yield self.execute_query(self._compiled(
+            'claim_unique_code_returning',
+            lambda: self.unique_codes.update().where(
+                (self.unique_codes.c.unique_code ==
+                 bindparam('b_unique_code')) &
+                (self.unique_codes.c.used == false())
+            ).returning(
+                self.unique_codes.c.id,
+                self.unique_codes.c.unique_code,
+                self.unique_codes.c.flavour,
+                self.unique_codes.c.used,
+                self.unique_codes.c.reason,
+            ), CLAIM_COLUMNS),
+            b_unique_code=canonical_code, used=True, reason=reason,
+            modified_at=datetime.utcnow())
+        unique_code = yield result.fetchone()
+        if unique_code is not None:
+            returnValue(self._format_unique_code(unique_code))
+
+        # We didn't claim anything, so find out why. This extra query only
+        # happens on the failure path.
+        unique_code = yield self._get_unique_code(canonical_code)
+        if unique_code is None:
+            raise CannotRedeemUniqueCode('invalid', canonical_code)
+        raise CannotRedeemUniqueCode('used', canonical_code)
+
+    def _claim_unique_code_by_id(self, unique_code_id, reason):
+        # The `used` check makes the claim atomic. If somebody else got there
+        # first, nothing matches.
+        return self.execute_query(self._compiled(
+            'claim_unique_code_by_id',
+            lambda: self.unique_codes.update().where(
+                (self.unique_codes.c.id == bindparam('b_id')) &
+                (self.unique_codes.c.used == false())
+            ), CLAIM_COLUMNS),
+            b_id=unique_code_id, used=True, reason=reason,
+            modified_at=datetime.utcnow())
+
+    @inlineCallbacks
+    def _claim_unique_code_fallback(self, canonical_code, reason):
         unique_code = yield self._get_unique_code(canonical_code)
         if unique_code is None:
             raise CannotRedeemUniqueCode('invalid', canonical_code)
         if unique_code['used']:
             raise CannotRedeemUniqueCode('used', canonical_code)
-        yield self._update_unique_code(
-            unique_code['id'], used=True, reason=reason)
+
+        # If somebody else got there between our select and our update,
+        # nothing matches.
+        result = yield self._claim_unique_code_by_id(unique_code['id'], reason)
+        if result.rowcount != 1:
+            raise CannotRedeemUniqueCode('used', canonical_code)
+        unique_code.update({'used': True, 'reason': reason})
         returnValue(unique_code)
 
+    def _redeem_unique_code(self, canonical_code, reason):
+        """Claim an unused unique code.
+
+        On dialects that support ``RETURNING`` this is a single conditional
+        update. Elsewhere we select the code and then update it only if it is
+        still unused, checking the rowcount to detect a lost race.
+        """
+        if self._supports_returning():
+            return self._claim_unique_code_returning(canonical_code, reason)
+        return self._claim_unique_code_fallback(canonical_code, reason)
+
     @inlineCallbacks
-    def redeem_unique_code(self, candidate_code, audit_params):
-        audit_req_data = {'candidate_code': candidate_code}
+    def _audited(self, audit_params, audit_req_data, error_class, perform):
+        """Handle a request in a transaction, or repeat an earlier response.
+
+        ``perform`` is called with no arguments to do the work, and must
+        insert the request's audit row as its last step. It returns a result,
+        or an ``error_class`` instance to raise once the transaction has been
+        committed.
 
-        # If we have already seen this request, return the same response as
-        # before. Appropriate exceptions will be raised here.
-        previous_data = yield self._get_previous_request(
-            audit_params, audit_req_data)
+        If the audit row conflicts with an existing one, we've seen this
+        request before. We then roll everything back and respond the way we
+        did last time, or raise :class:`AuditMismatch` if the requests don't
+        match. Nearly all requests are new, so this is cheaper than looking
+        for the previous request up front, and it can't race. Pools that
+        don't have a unique request_id index yet can't tell us about
+        conflicts, so for those we look first, as we used to.
+        """
+        timer = self.stage_timer
+        unique_request_ids = yield self._has_unique_request_ids()
+        trx = yield timer.time('begin', self._conn.begin())
+        try:
+            previous_data = None
+            if not unique_request_ids:
+                previous_data = yield timer.time(
+                    'replay', self._get_previous_request(
+                        audit_params, audit_req_data, error_class))
+            if previous_data is None:
+                result = yield perform()
+        except IntegrityError:
+            failure = Failure()
+            yield timer.time('rollback', trx.rollback())
+            previous_data = yield timer.time(
+                'replay', self._get_previous_request(
+                    audit_params, audit_req_data, error_class))
+            if previous_data is None:
+                # The conflict wasn't on the request_id.
+                failure.raiseException()
+            returnValue(previous_data)
+        except Exception:
+            failure = Failure()
+            yield timer.time('rollback', trx.rollback())
+            failure.raiseException()
         if previous_data is not None:
+            yield timer.time('rollback', trx.rollback())
             returnValue(previous_data)
+        yield timer.time('commit', trx.commit())
+        if isinstance(result, error_class):
+            raise result
+        returnValue(result)
 
-        # We do this after the audit check so we don't loosen the conditions.
-        candidate_code = self.canonicalise_unique_code(candidate_code)
+    def _has_unique_request_ids(self):
+        """Return ``True`` if the audit table has a unique request_id index.
 
-        # This is a new request, so handle it accordingly.
-        trx = yield self._conn.begin()
+        aludel doesn't create indexes, so pools made before we created them
+        ourselves don't have this one until they're upgraded. We only look
+        once for each pool template, and new templates look again.
+        """
+        return self._check_schema(
+            'unique_request_ids', self._inspect_unique_request_ids)
+
+    @inlineCallbacks
+    def _check_schema(self, name, check):
+        """Return the result of ``check()``, which inspects the pool's tables
+        in a database thread, or what it returned last time.
+        """
+        result = self._schema_checks.get(name)
+        if result is None:
+            exists = yield self.exists()
+            if not exists:
+                raise NoUniqueCodePool(self.name)
+            result = yield self._conn._engine._defer_to_thread(check)
+            self._schema_checks[name] = result
+        returnValue(result)
+
+    def _inspect_unique_request_ids(self):
+        # This runs in a database thread.
+        inspector = inspect(self._conn._connection)
+        uniques = [index['column_names'] for index in inspector.get_indexes(
+            self.audit.name) if index['unique']]
         try:
-            unique_code = yield self._redeem_unique_code(
-                candidate_code, 'redeemed')
+            uniques.extend(
+                constraint['column_names'] for constraint in
+                inspector.get_unique_constraints(self.audit.name))
+        except NotImplementedError:
+            pass
+        return ['request_id'] in uniques
+
+    def _has_counts_table(self):
+        """Return ``True`` if the pool has its unique_code_counts table.
+
+        Pools created before counts were maintained don't have it until
+        they're upgraded or their counts are reconciled. Until then, we count
+        the unique codes themselves.
+        """
+        return self._check_schema('counts_table', lambda: (
+            self._conn._engine.dialect.has_table(
+                self._conn._connection, self.unique_code_counts.name)))
+
+    def _definitely_missing(self, canonical_code):
+        return self.code_filter is not None and (
+            self.code_filter.definitely_missing(canonical_code))
+
+    @inlineCallbacks
+    def _redeem_and_audit(self, canonical_code, audit_params, audit_req_data):
+        timer = self.stage_timer
+        try:
+            if self._definitely_missing(canonical_code):
+                raise CannotRedeemUniqueCode('invalid', canonical_code)
+            unique_code = yield timer.time('claim', self._redeem_unique_code(
+                canonical_code, 'redeemed'))
         except CannotRedeemUniqueCode as e:
             audit_resp_data = {
                 'reason': e.reason,
                 'unique_code': e.unique_code,
             }
-            yield self._audit_request(
-                audit_params, audit_req_data, audit_resp_data, candidate_code,
-                error=True)
-            raise e
-        else:
-            yield self._audit_request(
-                audit_params, audit_req_data, unique_code, candidate_code)
-        finally:
-            yield trx.commit()
+            yield timer.time('audit', self._audit_request(
+                audit_params, audit_req_data, audit_resp_data, canonical_code,
+                error=True))
+            returnValue(e)
+        yield timer.time('count', self._count_claims([unique_code]))
+        yield timer.time('audit', self._audit_request(
+            audit_params, audit_req_data, unique_code, canonical_code))
         returnValue(unique_code)
 
+    def redeem_unique_code(self, candidate_code, audit_params):
+        audit_req_data = {'candidate_code': candidate_code}
+        # The audit row records the code as it was given to us, so repeated
+        # requests must match exactly even though we canonicalise here.
+        canonical_code = self.canonicalise_unique_code(candidate_code)
+        return self._audited(
+            audit_params, audit_req_data, CannotRedeemUniqueCode,
+            lambda: self._redeem_and_audit(
+                canonical_code, audit_params, audit_req_data))
+
     @inlineCallbacks
-    def count_unique_codes(self):
-        trx = yield self._conn.begin()
+    def _get_previous_requests(self, request_ids):
         rows = yield self.execute_fetchall(
-            select([
-                self.unique_codes.c.flavour,
-                self.unique_codes.c.used,
-                func.count().label('count'),
-            ]).group_by(
-                self.unique_codes.c.flavour,
-                self.unique_codes.c.used,
-            )
+            self.audit.select().where(
+                self.audit.c.request_id.in_(request_ids)))
+        returnValue(dict((row['request_id'], row) for row in rows))
+
+    @inlineCallbacks
+    def _lock_unique_codes(self, canonical_codes):
+        # We lock the rows in id order so that concurrent batches can't
+        # deadlock each other. Databases without row locks (SQLite) ignore the
+        # FOR UPDATE, but they only allow one writer at a time anyway.
+        rows = yield self.execute_fetchall(
+            self.unique_codes.select().where(
+                self.unique_codes.c.unique_code.in_(canonical_codes),
+            ).order_by(self.unique_codes.c.id).with_for_update())
+        unique_codes = {}
+        for row in rows:
+            unique_code = self._format_unique_code(row)
+            # Pools that haven't been upgraded to a unique index may have
+            # codes more than once, so we prefer a row we can still redeem.
+            existing = unique_codes.get(unique_code['unique_code'])
+            if existing is None or (existing['used'] and not row['used']):
+                unique_codes[unique_code['unique_code']] = unique_code
+        returnValue(unique_codes)
+
+    @inlineCallbacks
+    def _redeem_batch(self, items, reason, batch_audit=None):
+        """Redeem a batch of unique codes using set-based statements.
+
+        :param items:
+            A list of ``(candidate_code, audit_params)`` pairs, each with a
+            different request_id.
+        :param batch_audit:
+            ``(audit_params, request_data)`` for an audit row recording the
+            whole batch, or ``None``. If we've seen its request_id before and
+            the request data doesn't match, :class:`AuditMismatch` is raised.
+
+        Each item is handled as if it had been passed to
+        :meth:`redeem_unique_code` in order, but the idempotency lookup, the
+        claims and the audit rows each take a single statement. If a
+        concurrent request audits the same request_ids first, we respond the
+        way it did. Returns a list with a unique code dict or a
+        :class:`CannotRedeemUniqueCode` instance for each item.
+        """
+        if not items and batch_audit is None:
+            returnValue([])
+        timer = self.stage_timer
+        reqs = [{'candidate_code': candidate_code}
+                for candidate_code, _ in items]
+
+        results, new_items = yield timer.time(
+            'replay', self._replay_batch(items, reqs, batch_audit))
+        if new_items is None:
+            returnValue(results)
+
+        # We do this after the audit check so we don't loosen the conditions.
+        canonical_codes = dict(
+            (i, self.canonicalise_unique_code(items[i][0])) for i in new_items)
+
+        trx = yield timer.time('begin', self._conn.begin())
+        try:
+            unique_codes = {}
+            to_lock = sorted(set(
+                canonical_code for canonical_code in canonical_codes.values()
+                if not self._definitely_missing(canonical_code)))
+            if to_lock:
+                unique_codes = yield timer.time(
+                    'lock', self._lock_unique_codes(to_lock))
+            to_claim = []
+            for i in new_items:
+                unique_code = unique_codes.get(canonical_codes[i])
+                if unique_code is None:
+                    results[i] = CannotRedeemUniqueCode(
+                        'invalid', canonical_codes[i])
+                elif unique_code['used']:
+                    results[i] = CannotRedeemUniqueCode(
+                        'used', canonical_codes[i])
+                else:
+                    # Later items with the same code will find it used.
+                    unique_code.update({'used': True, 'reason': reason})
+                    results[i] = dict(unique_code)
+                    to_claim.append(unique_code['id'])
+
+            if to_claim:
+                result = yield timer.time('claim', self.execute_query(
+                    self.unique_codes.update().where(
+                        self.unique_codes.c.id.in_(to_claim) &
+                        (self.unique_codes.c.used == false())
+                    ).values(
+                        used=True, reason=reason,
+                        modified_at=datetime.utcnow())))
+                if result.rowcount != len(to_claim):
+                    raise UniqueCodeError(
+                        "Claimed %s of %s locked unique codes." % (
+                            result.rowcount, len(to_claim)))
+                yield timer.time('count', self._count_claims([
+                    results[i] for i in new_items
+                    if isinstance(results[i], dict)]))
+
+            audit_rows = []
+            for i in new_items:
+                if isinstance(results[i], CannotRedeemUniqueCode):
+                    audit_rows.append(self._audit_row(
+                        items[i][1], reqs[i], {
+                            'reason': results[i].reason,
+                            'unique_code': results[i].unique_code,
+                        }, canonical_codes[i], error=True))
+                else:
+                    audit_rows.append(self._audit_row(
+                        items[i][1], reqs[i], results[i], canonical_codes[i]))
+            if batch_audit is not None:
+                failed = sum(isinstance(r, CannotRedeemUniqueCode)
+                             for r in results)
+                audit_rows.append(self._audit_row(
+                    batch_audit[0], batch_audit[1], {
+                        'redeemed': len(results) - failed,
+                        'failed': failed,
+                    }, None))
+            yield timer.time(
+                'audit', self._insert_audit(audit_rows))
+        except IntegrityError:
+            failure = Failure()
+            yield timer.time('rollback', trx.rollback())
+            results, new_items = yield timer.time(
+                'replay', self._replay_batch(items, reqs, batch_audit))
+            if new_items is not None:
+                # The conflict wasn't on the request_ids.
+                failure.raiseException()
+            returnValue(results)
+        except Exception:
+            failure = Failure()
+            yield timer.time('rollback', trx.rollback())
+            failure.raiseException()
+        yield timer.time('commit', trx.commit())
+        returnValue(results)
+
+    @inlineCallbacks
+    def _replay_batch(self, items, reqs, batch_audit):
+        """Look up the previous responses to a batch's items.
+
+        Returns a list with the previous response for each item we've seen
+        before and ``None`` for the others, and a list of the indexes of the
+        others. If we don't need to do anything else, because we've seen
+        every item and the batch itself, the second list is ``None``.
+        """
+        results = [None] * len(items)
+        request_ids = [audit_params['request_id'] for _, audit_params in items]
+        if batch_audit is not None:
+            request_ids.append(batch_audit[0]['request_id'])
+        previous = yield self._get_previous_requests(request_ids)
+        seen_batch = True
+        if batch_audit is not None:
+            row = previous.get(batch_audit[0]['request_id'])
+            if row is None:
+                seen_batch = False
+            else:
+                self._previous_response(row, *batch_audit)
+        new_items = []
+        for i, (candidate_code, audit_params) in enumerate(items):
+            row = previous.get(audit_params['request_id'])
+            if row is None:
+                new_items.append(i)
+                continue
+            try:
+                results[i] = self._previous_response(
+                    row, audit_params, reqs[i])
+            except CannotRedeemUniqueCode as e:
+                results[i] = e
+        if seen_batch and not new_items:
+            new_items = None
+        returnValue((results, new_items))
+
+    def redeem_unique_codes(self, candidate_codes, audit_params):
+        """Redeem several unique codes in one request.
+
+        The batch is audited with its request_id and its list of candidate
+        codes, so repeating the request returns the same results and reusing
+        the request_id for anything else raises :class:`AuditMismatch`. Each
+        code is also audited separately with a request_id of
+        ``<request_id>/<index>``. Request ids come from URL path segments,
+        which can't contain ``/``, so these never clash with the request_id
+        of another request.
+
+        Returns a list with a unique code dict or a
+        :class:`CannotRedeemUniqueCode` instance for each candidate code.
+        """
+        items = []
+        for i, candidate_code in enumerate(candidate_codes):
+            item_audit_params = dict(audit_params)
+            item_audit_params['request_id'] = '%s/%s' % (
+                audit_params['request_id'], i)
+            items.append((candidate_code, item_audit_params))
+        return self._redeem_batch(items, 'redeemed', (
+            audit_params, {'candidate_codes': list(candidate_codes)}))
+
+    def redeem_unique_code_group(self, items):
+        """Redeem unique codes for several separate requests in one
+        transaction.
+
+        :param items:
+            A list of ``(candidate_code, audit_params)`` pairs, each with a
+            different request_id.
+
+        Each item is audited and replayed exactly as if it had been passed
+        to :meth:`redeem_unique_code`. If any item doesn't match its previous
+        request, :class:`AuditMismatch` is raised and nothing is redeemed.
+
+        Returns a list with a unique code dict or a
+        :class:`CannotRedeemUniqueCode` instance for each item.
+        """
+        return self._redeem_batch(items, 'redeemed')
+
+    def _supports_skip_locked(self):
+        dialect = self._conn._engine.dialect
+        return (dialect.name == 'postgresql' and
+                (dialect.server_version_info or ()) >= (9, 5))
+
+    @inlineCallbacks
+    def _issue_unique_code_skip_locked(self, flavour, reason):
+        # SQLAlchemy can't build SKIP LOCKED for us, so we write this one out
+        # by hand. Concurrent issuers skip rows that are already being claimed
+        # instead of queueing up behind them.
+        table = self._conn._engine.dialect.identifier_preparer.format_table(
+            self.unique_codes)
+        result = yield self.execute_query(text(
+            "UPDATE %(table)s SET used = true, reason = :reason,"
+            " modified_at = :modified_at"
+            " WHERE id = (SELECT id FROM %(table)s"
+            " WHERE flavour = :flavour AND used = false"
+            " LIMIT 1 FOR UPDATE SKIP LOCKED)"
+            " RETURNING id, unique_code, flavour, used, reason" % {
+                'table': table,
+            }),
+            reason=reason, modified_at=datetime.utcnow(), flavour=flavour)
+        unique_code = yield result.fetchone()
+        if unique_code is None:
+            raise CannotIssueUniqueCode('exhausted', flavour)
+        returnValue(self._format_unique_code(unique_code))
+
+    @inlineCallbacks
+    def _issue_unique_code_fallback(self, flavour, reason):
+        for attempt in range(self.ISSUE_ATTEMPTS):
+            rows = yield self.execute_fetchall(self._compiled(
+                'select_issue_candidates',
+                lambda: self.unique_codes.select().where(
+                    (self.unique_codes.c.flavour == bindparam('b_flavour')) &
+                    (self.unique_codes.c.used == false())
+                ).limit(self.ISSUE_CANDIDATES)),
+                b_flavour=flavour)
+            if not rows:
+                raise CannotIssueUniqueCode('exhausted', flavour)
+
+            # Concurrent issuers all see the same candidates, so we try them
+            # in random order to avoid everyone fighting over the first one.
+            candidates = [self._format_unique_code(row) for row in rows]
+            random.shuffle(candidates)
+            for unique_code in candidates:
+                result = yield self._claim_unique_code_by_id(
+                    unique_code['id'], reason)
+                if result.rowcount == 1:
+                    unique_code.update({'used': True, 'reason': reason})
+                    returnValue(unique_code)
+        raise IssueContention(flavour)
+
+    def _issue_unique_code(self, flavour, reason):
+        """Claim any unused unique code of the given flavour.
+
+        On PostgreSQL 9.5 and later this is a single update that uses
+        ``FOR UPDATE SKIP LOCKED`` to pick its row. Elsewhere we select a few
+        candidates and try to claim them one at a time with a conditional
+        update, giving up with :class:`IssueContention` if we lose every race
+        :attr:`ISSUE_ATTEMPTS` times.
+        """
+        if self._supports_skip_locked():
+            return self._issue_unique_code_skip_locked(flavour, reason)
+        return self._issue_unique_code_fallback(flavour, reason)
+
+    @inlineCallbacks
+    def _issue_and_audit(self, flavour, audit_params, audit_req_data):
+        timer = self.stage_timer
+        try:
+            unique_code = yield timer.time(
+                'claim', self._issue_unique_code(flavour, 'issued'))
+        except CannotIssueUniqueCode as e:
+            audit_resp_data = {
+                'reason': e.reason,
+                'flavour': e.flavour,
+            }
+            yield timer.time('audit', self._audit_request(
+                audit_params, audit_req_data, audit_resp_data, None,
+                error=True))
+            returnValue(e)
+        yield timer.time('count', self._count_claims([unique_code]))
+        yield timer.time('audit', self._audit_request(
+            audit_params, audit_req_data, unique_code,
+            unique_code['unique_code']))
+        returnValue(unique_code)
+
+    def issue_unique_code(self, flavour, audit_params):
+        """Issue an unused unique code of the given flavour.
+
+        The issued code is marked as used, so it can't be redeemed. Requests
+        are audited and idempotent in the same way as redeems.
+        """
+        audit_req_data = {'flavour': flavour}
+        return self._audited(
+            audit_params, audit_req_data, CannotIssueUniqueCode,
+            lambda: self._issue_and_audit(
+                flavour, audit_params, audit_req_data))
+
+    @inlineCallbacks
+    def count_unique_codes(self):
+        """Return ``(flavour, used, count)`` rows for all nonzero counts.
+
+        This reads the maintained counts, so it only touches one row per
+        flavour and used state rather than every unique code. Codes without
+        a flavour can't have a counter, so those are counted directly, which
+        only touches those codes. Pools without a counts table have all
+        their codes counted directly.
+        """
+        has_counts_table = yield self._has_counts_table()
+        if not has_counts_table:
+            rows = yield self.execute_fetchall(self._exact_counts_query())
+            returnValue(rows)
+        counts = self.unique_code_counts
+        rows = yield self.execute_fetchall(self._compiled(
+            'select_counts', lambda: select([
+                counts.c.flavour, counts.c.used, counts.c.count,
+            ]).where(counts.c.count > 0)))
+        null_rows = yield self.execute_fetchall(self._compiled(
+            'select_null_flavour_counts', lambda: self._exact_counts_query(
+            ).where(self.unique_codes.c.flavour.is_(None))))
+        returnValue(rows + null_rows)
+
+    @inlineCallbacks
+    def total_unique_codes(self):
+        """Return the number of unique codes in the pool, from the counts."""
+        rows = yield self.count_unique_codes()
+        returnValue(sum(row['count'] for row in rows))
+
+    def get_unique_codes_after(self, after_id, limit):
+        """Return up to ``limit`` ``(id, unique_code)`` rows in id order,
+        starting after ``after_id``.
+        """
+        return self.execute_fetchall(
+            select([self.unique_codes.c.id, self.unique_codes.c.unique_code])
+            .where(self.unique_codes.c.id > after_id)
+            .order_by(self.unique_codes.c.id).limit(limit))
+
+    def _exact_counts_query(self):
+        return select([
+            self.unique_codes.c.flavour,
+            self.unique_codes.c.used,
+            func.count().label('count'),
+        ]).group_by(
+            self.unique_codes.c.flavour,
+            self.unique_codes.c.used,
         )
+
+    def _lock_counts(self):
+        # Nothing may change the counts while we rebuild them, otherwise a
+        # transaction that we can't see yet would adjust counters that we're
+        # about to replace.
+        dialect = self._conn._engine.dialect
+        if dialect.name == 'postgresql':
+            table = dialect.identifier_preparer.format_table(
+                self.unique_code_counts)
+            return self.execute_query(
+                text("LOCK TABLE %s IN EXCLUSIVE MODE" % (table,)))
+        # Databases without row locks (SQLite) ignore the FOR UPDATE, but they
+        # only allow one writer at a time anyway.
+        return self.execute_fetchall(
+            self.unique_code_counts.select().with_for_update())
+
+    @inlineCallbacks
+    def rebuild_counts(self):
+        """Recalculate the unique code counts from the unique codes.
+
+        This scans the whole unique_codes table and blocks redeems and imports
+        while it runs, so it's only meant for repairs. Pools created before
+        counts were maintained need :meth:`create_tables` to be called first.
+
+        Returns a list of ``(flavour, used, old_count, new_count)`` tuples for
+        the counts that changed.
+        """
+        counts = self.unique_code_counts
+        trx = yield self._conn.begin()
+        try:
+            yield self._lock_counts()
+            old_rows = yield self.execute_fetchall(counts.select())
+            new_rows = yield self.execute_fetchall(
+                self._exact_counts_query().where(
+                    self.unique_codes.c.flavour.isnot(None)))
+            yield self.execute_query(counts.delete())
+            if new_rows:
+                yield self.execute_query(counts.insert(), [{
+                    'flavour': row['flavour'],
+                    'used': row['used'],
+                    'count': row['count'],
+                } for row in new_rows])
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
         yield trx.commit()
-        returnValue(rows)
+
+        old_counts = dict(
+            ((row['flavour'], row['used']), row['count']) for row in old_rows)
+        new_counts = dict(
+            ((row['flavour'], row['used']), row['count']) for row in new_rows)
+        returnValue(sorted(
+            key + (old_counts.get(key, 0), new_counts.get(key, 0))
+            for key in set(old_counts) | set(new_counts)
+            if old_counts.get(key, 0) != new_counts.get(key, 0)))
+
+    def _audit_bucket_table(self, bucket):
+        """Return the table for the named audit bucket."""
+        table = self._audit_bucket_tables.get(bucket)
+        if table is None:
+            table = type(self).audit.make_table(
+                self.get_table_name('audit_%s' % (bucket,)),
+                self._audit_bucket_metadata)
+            for table_attr, column in self.PAGE_INDEXES:
+                if table_attr == 'audit':
+                    Index(index_name('ix_%s_%s_page' % (table.name, column)),
+                          table.c[column], table.c.created_at, table.c.id)
+            self._audit_bucket_tables[bucket] = table
+        return table
 
     @inlineCallbacks
-    def _query_audit(self, where_clause):
-        rows = yield self.execute_fetchall(
-            self.audit.select().where(where_clause).order_by(
-                self.audit.c.created_at))
-        returnValue([{
-            'request_id': row['request_id'],
-            'transaction_id': row['transaction_id'],
-            'user_id': row['user_id'],
-            'request_data': json.loads(row['request_data']),
-            'response_data': json.loads(row['response_data']),
-            'error': row['error'],
-            'created_at': row['created_at'],
-        } for row in rows])
+    def get_audit_buckets(self):
+        """Return the names of this pool's audit buckets, oldest first.
+
+        The list of buckets is kept in the pool's metadata, so pools that
+        have never been rotated need no upgrade.
+        """
+        try:
+            metadata = yield self.get_metadata()
+        except CollectionMissingError:
+            raise NoUniqueCodePool(self.name)
+        returnValue(sorted(metadata.get('audit_buckets', [])))
+
+    @inlineCallbacks
+    def _set_audit_buckets(self, buckets):
+        metadata = yield self.get_metadata()
+        metadata['audit_buckets'] = sorted(buckets)
+        yield self.set_metadata(metadata)
+
+    @inlineCallbacks
+    def _add_audit_bucket(self, bucket):
+        table = self._audit_bucket_table(bucket)
+        yield self._create_table(None, table)
+        yield self._create_indexes([table])
+        buckets = yield self.get_audit_buckets()
+        if bucket not in buckets:
+            yield self._set_audit_buckets(buckets + [bucket])
+
+    @inlineCallbacks
+    def rotate_audit(self, before):
+        """Move audit records created before ``before`` into bucket tables.
+
+        Each month's records go into a bucket table of their own, which
+        :meth:`query_audit` reads along with the audit table. This keeps the
+        audit table, which every request writes to, small. Records are moved
+        :attr:`AUDIT_ROTATE_BATCH_SIZE` at a time, each batch in a short
+        transaction, so this can run while the pool is in use.
+
+        Repeated requests are recognised by their audit records in the audit
+        table, so ``before`` should be well outside the time in which clients
+        might retry a request. Returns the number of records moved.
+        """
+        buckets = set((yield self.get_audit_buckets()))
+        moved = 0
+        while True:
+            rows = yield self.execute_fetchall(
+                self.audit.select().where(
+                    self.audit.c.created_at < before,
+                ).order_by(self.audit.c.id).limit(
+                    self.AUDIT_ROTATE_BATCH_SIZE))
+            if not rows:
+                break
+            bucket_rows = {}
+            for row in rows:
+                bucket_rows.setdefault(
+                    audit_bucket(row['created_at']), []).append(dict(row))
+            for bucket in sorted(set(bucket_rows) - buckets):
+                yield self._add_audit_bucket(bucket)
+                buckets.add(bucket)
+
+            trx = yield self._conn.begin()
+            try:
+                for bucket, batch in sorted(bucket_rows.items()):
+                    yield self.execute_query(
+                        self._audit_bucket_table(bucket).insert(), batch)
+                yield self.execute_query(self.audit.delete().where(
+                    self.audit.c.id.in_([row['id'] for row in rows])))
+            except Exception:
+                failure = Failure()
+                yield trx.rollback()
+                failure.raiseException()
+            yield trx.commit()
+            moved += len(rows)
+        returnValue(moved)
+
+    @inlineCallbacks
+    def export_audit_bucket(self, bucket, write):
+        """Pass every record in an audit bucket to ``write``.
+
+        ``write`` is called with lists of up to
+        :attr:`AUDIT_ARCHIVE_BATCH_SIZE` records in id order, each a dict of
+        the row's columns with the request and response data as plain JSON.
+        Returns the number of records exported. The bucket is left alone, so
+        that it can be dropped with :meth:`drop_audit_bucket` once whatever
+        ``write`` wrote to is safely stored.
+        """
+        table = self._audit_bucket_table(bucket)
+        exported = 0
+        last_id = None
+        while True:
+            query = table.select().order_by(table.c.id).limit(
+                self.AUDIT_ARCHIVE_BATCH_SIZE)
+            if last_id is not None:
+                query = query.where(table.c.id > last_id)
+            rows = yield self.execute_fetchall(query)
+            if not rows:
+                break
+            write([self._archive_row(row) for row in rows])
+            exported += len(rows)
+            last_id = rows[-1]['id']
+        returnValue(exported)
+
+    @inlineCallbacks
+    def drop_audit_bucket(self, bucket):
+        """Drop an audit bucket and every record in it."""
+        # Queries stop reading the bucket before it goes away.
+        buckets = yield self.get_audit_buckets()
+        yield self._set_audit_buckets([b for b in buckets if b != bucket])
+        yield self.execute_query(DropTable(self._audit_bucket_table(bucket)))
+
+    def _archive_row(self, row):
+        record = AuditRecord(row)
+        archive_row = dict(row)
+        archive_row['request_data'] = record.raw_request_data
+        archive_row['response_data'] = record.raw_response_data
+        return archive_row
+
+    def _query_audit_table(self, table, field, value, limit, after):
+        query = table.select().where(table.c[field] == value)
+        if after is not None:
+            created_at, audit_id = after
+            query = query.where(
+                (table.c.created_at > created_at) |
+                ((table.c.created_at == created_at) &
+                 (table.c.id > audit_id)))
+        query = query.order_by(table.c.created_at, table.c.id)
+        if limit is not None:
+            # We fetch an extra row to find out if there's another page.
+            query = query.limit(limit + 1)
+        return self.execute_fetchall(query)
+
+    @inlineCallbacks
+    def _query_audit_page(self, field, value, limit=None, after=None):
+        rows = yield self._query_audit_table(
+            self.audit, field, value, limit, after)
+        buckets = yield self.get_audit_buckets()
+        bucket_rows = []
+        for bucket in buckets:
+            if limit is not None and len(bucket_rows) > limit:
+                # Buckets don't overlap, so the rest only have later records.
+                break
+            starts_at, ends_at = audit_bucket_range(bucket)
+            if after is not None and ends_at <= after[0]:
+                continue
+            bucket_rows.extend((yield self._query_audit_table(
+                self._audit_bucket_table(bucket), field, value, limit,
+                after)))
+        if bucket_rows:
+            # Records usually reach the audit table in creation order, but
+            # we can't count on it.
+            rows = sorted(rows + bucket_rows,
+                          key=lambda row: (row['created_at'], row['id']))
+            if limit is not None:
+                rows = rows[:limit + 1]
+
+        cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            cursor = (rows[-1]['created_at'], rows[-1]['id'])
+        returnValue(([AuditRecord(row) for row in rows], cursor))
+
+    def query_audit(self, field, value, limit=None, after=None):
+        """Return a page of audit records with ``field`` equal to ``value``.
+
+        Each record is an :class:`AuditRecord`, and records are ordered by
+        creation time and then by id. Returns a ``(records, cursor)`` tuple,
+        where ``cursor`` should be passed as ``after`` to get the next page or
+        is ``None`` if there are no more records. If ``limit`` is ``None``,
+        all records are returned at once. Records that have been moved into
+        audit buckets are included.
+        """
+        if field not in self.AUDIT_QUERY_FIELDS:
+            raise ValueError("Invalid audit field: %r" % (field,))
+        return self._query_audit_page(field, value, limit, after)
+
+    def _query_audit(self, field, value):
+        d = self._query_audit_page(field, value)
+        return d.addCallback(lambda page: page[0])
 
     def query_by_request_id(self, request_id):
-        return self._query_audit(self.audit.c.request_id == request_id)
+        return self._query_audit('request_id', request_id)
 
     def query_by_transaction_id(self, transaction_id):
-        return self._query_audit(self.audit.c.transaction_id == transaction_id)
+        return self._query_audit('transaction_id', transaction_id)
 
     def query_by_user_id(self, user_id):
-        return self._query_audit(self.audit.c.user_id == user_id)
+        return self._query_audit('user_id', user_id)
 
     def query_by_unique_code(self, unique_code):
-        return self._query_audit(self.audit.c.unique_code == unique_code)
+        return self._query_audit('unique_code', unique_code)
@@ -0,0 +1,113 @@
+"""A process-wide cache of unique code pools."""
+
+from collections import OrderedDict
+
+from .models import UniqueCodePool, NoUniqueCodePool
+
+
+class UniqueCodePoolRegistry(object):
+    """Cache of :class:`UniqueCodePool` objects shared between requests.
+
+    Building a :class:`UniqueCodePool` creates all its table objects, and the
+    first query on it needs an extra query to check that it exists. The
+    registry keeps a template for each pool for ``ttl`` seconds and hands out
+    copies of it bound to the caller's connection. Once a template has seen
+    that its pool is missing, requests for that pool fail without touching
+    the database until the template expires or is invalidated.
+
+    Anybody can ask for a pool that doesn't exist, so templates for missing
+    pools are kept apart, and only the :attr:`MAX_MISSING` most recently used
+    of them are kept. Expired templates are thrown away every ``ttl``
+    seconds, or sooner if the registry has doubled in size since then.
+
+    :param clock: Something that provides ``seconds()``.
+    :param float ttl: Number of seconds to keep each template for.
+    """
+
+    pool_class = UniqueCodePool
+
+    # Most templates for missing pools to keep.
+    MAX_MISSING = 100
+
+    # Fewest templates to keep before we look for ones we can throw away
+    # early.
+    MIN_SWEEP_SIZE = 100
+
+    def __init__(self, clock, ttl=60):
+        self.clock = clock
+        self.ttl = ttl
+        # (template, expires_at) for each name, with templates for missing
+        # pools in least recently used order in _missing.
+        self._templates = {}
+        self._missing = OrderedDict()
+        self._next_sweep = clock.seconds() + ttl
+        self._sweep_size = self.MIN_SWEEP_SIZE
+
+    def _get_template(self, name):
+        now = self.clock.seconds()
+        if now >= self._next_sweep or len(self._templates) > self._sweep_size:
+            self._sweep(now)
+        entry = self._missing.pop(name, None)
+        if entry is not None and entry[1] > now:
+            self._missing[name] = entry
+            return entry[0]
+        template, expires_at = self._templates.get(name, (None, None))
+        if template is None or expires_at <= now:
+            template = self.pool_class(name, None)
+            self._templates[name] = (template, now + self.ttl)
+        elif template.known_missing():
+            self._add_missing(name, self._templates.pop(name))
+        return template
+
+    def _add_missing(self, name, entry):
+        self._missing[name] = entry
+        while len(self._missing) > self.MAX_MISSING:
+            self._missing.popitem(last=False)
+
+    def _sweep(self, now):
+        """Throw away expired templates and move templates for missing pools
+        into :attr:`_missing`.
+        """
+        for name, entry in self._templates.items():
+            template, expires_at = entry
+            if expires_at <= now:
+                del self._templates[name]
+            elif template.known_missing():
+                del self._templates[name]
+                self._add_missing(name, entry)
+        for name, (_, expires_at) in self._missing.items():
+            if expires_at <= now:
+                del self._missing[name]
+        self._next_sweep = now + self.ttl
+        self._sweep_size = max(2 * len(self._templates), self.MIN_SWEEP_SIZE)
+
+    def get_pool(self, name, connection):
+        """Return the named pool bound to ``connection``."""
+        return self._get_template(name).bind(connection)
+
+    def check_exists(self, name):
+        """Raise :class:`NoUniqueCodePool` if we know the pool is missing.
+
+        Pools we don't know about yet pass this check, and their existence is
+        checked when they're first used.
+        """
+        if self._get_template(name).known_missing():
+            raise NoUniqueCodePool(name)
+
+    def known_to_exist(self, name):
+        """Return ``True`` if we've recently seen that the pool exists.
+
+        Unlike :meth:`check_exists`, this never makes a template.
+        """
+        template, expires_at = self._templates.get(name, (None, None))
+        return template is not None and (
+            expires_at > self.clock.seconds() and template.known_to_exist())
+
+    def invalidate(self, name=None):
+        """Forget what we know about the named pool, or all of them."""
+        if name is None:
+            self._templates.clear()
+            self._missing.clear()
+        else:
+            self._templates.pop(name, None)
+            self._missing.pop(name, None)
@@ -0,0 +1,164 @@
+"""Read replicas for reporting queries.
+
+Audit queries and unique code counts only read, but a big audit export can
+keep the primary busy enough to slow down redeems. A :class:`ReadReplica`
+sends those queries to a replica of the database instead, as long as the
+replica is no further behind the primary than we're prepared to report.
+Everything that writes, and every lookup that decides what a write does
+(such as checking whether a request_id has been seen before), stays on the
+primary.
+"""
+
+from sqlalchemy.sql import text
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import log
+
+
+class ReadReplica(object):
+    """A read replica of the database and how far behind the primary it is.
+
+    Replication lag is measured in the background at most once every
+    :attr:`CHECK_INTERVAL` seconds. We assume that the replica may have
+    stopped replicating as soon as we've measured it, so it's only used
+    while the lag we measured plus the time since we measured it is within
+    ``max_lag``. If the lag can't be measured, the replica isn't used.
+
+    :param conn_pool: A :class:`ConnectionPool` for the replica.
+    :param clock: Something that provides ``seconds()``.
+    :param float max_lag:
+        Most seconds behind the primary the replica may be for us to read
+        from it.
+    """
+
+    # Seconds between replication lag checks.
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, conn_pool, clock, max_lag=5.0):
+        self.conn_pool = conn_pool
+        self.clock = clock
+        self.max_lag = max_lag
+        self.lag = None
+        self.checked_at = None
+        self.checking = None
+        self.reads = 0
+        self.fallbacks = 0
+
+    def is_fresh(self):
+        if self.lag is None:
+            return False
+        age = self.clock.seconds() - self.checked_at
+        return self.lag + age <= self.max_lag
+
+    def needs_check(self):
+        if self.checking is not None:
+            return False
+        return self.checked_at is None or (
+            self.clock.seconds() - self.checked_at >= self.CHECK_INTERVAL)
+
+    def use(self):
+        """Return ``True`` if a read should go to the replica.
+
+        This starts a lag check if one is due, but doesn't wait for it.
+        """
+        if self.needs_check():
+            self.check().addErrback(log.err, 'Error checking replica lag.')
+        if self.is_fresh():
+            self.reads += 1
+            return True
+        self.fallbacks += 1
+        return False
+
+    def stats(self):
+        """Return a dict of statistics about the replica for monitoring."""
+        return {
+            'lag': -1 if self.lag is None else self.lag,
+            'fresh': int(self.is_fresh()),
+            'reads': self.reads,
+            'fallbacks': self.fallbacks,
+        }
+
+    def check(self):
+        """Measure the replication lag.
+
+        Concurrent calls share the check that's already running.
+        """
+        if self.checking is not None:
+            return self.checking
+        d = self.checking = self._check()
+
+        def done(result):
+            self.checking = None
+            return result
+        return d.addBoth(done)
+
+    @inlineCallbacks
+    def _check(self):
+        started = self.clock.seconds()
+        try:
+            conn = yield self.conn_pool.acquire()
+            try:
+                lag = yield replication_lag(conn, self.conn_pool.engine)
+            finally:
+                yield self.conn_pool.release(conn)
+        except Exception:
+            self.lag, self.checked_at = None, started
+            raise
+        self.lag, self.checked_at = lag, started
+        returnValue(lag)
+
+
+@inlineCallbacks
+def replication_lag(conn, engine):
+    """Return how many seconds behind its primary the database is, or
+    ``None`` if we can't tell.
+
+    A database that isn't replicating from anything is never behind, so
+    pointing the read connection string at the primary itself is fine. On
+    PostgreSQL 9.6 and later, the replica's connection must be able to see
+    the WAL receiver's status, which needs a superuser or (on PostgreSQL 10
+    and later) a member of ``pg_read_all_stats``. Otherwise we can't tell
+    whether it's still streaming, so the lag is measured from the last
+    transaction it replayed, which makes an idle replica look further behind
+    than it is.
+    """
+    dialect = engine.dialect
+    if dialect.name == 'postgresql':
+        result = yield conn.execute(text(postgresql_lag_query(
+            dialect.server_version_info or ())))
+        row = yield result.fetchone()
+        lag = row['lag']
+    elif dialect.name == 'mysql':
+        result = yield conn.execute(text("SHOW SLAVE STATUS"))
+        row = yield result.fetchone()
+        # Seconds_Behind_Master is NULL if replication isn't running.
+        lag = 0 if row is None else row['Seconds_Behind_Master']
+    else:
+        lag = 0
+    returnValue(None if lag is None else max(float(lag), 0.0))
+
+
+def postgresql_lag_query(server_version):
+    """Return a query for the replication lag of a PostgreSQL server with
+    version ``server_version``, a tuple of ints.
+    """
+    if server_version >= (10,):
+        receive, replay = ('pg_last_wal_receive_lsn', 'pg_last_wal_replay_lsn')
+    else:
+        receive, replay = ('pg_last_xlog_receive_location',
+                           'pg_last_xlog_replay_location')
+    # An idle primary commits nothing for the replica to replay, so the
+    # replay timestamp only tells us the lag if there's something left to
+    # replay. A replica that has replayed everything it received is only up
+    # to date if it's still receiving, so we check the WAL receiver too.
+    # Before 9.6 we can't, and the replay timestamp is all we have.
+    if server_version >= (9, 6):
+        caught_up = (
+            "%s() = %s() AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver"
+            " WHERE status = 'streaming')" % (receive, replay))
+    else:
+        caught_up = "FALSE"
+    return (
+        "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0"
+        " WHEN %s THEN 0"
+        " ELSE EXTRACT(EPOCH FROM"
+        " now() - pg_last_xact_replay_timestamp()) END AS lag" % (caught_up,))
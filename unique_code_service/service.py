@@ -1,9 +1,14 @@
+import sys
+
+from aludel.database import get_engine
 from twisted.application import strports
 from twisted.internet import reactor
 from twisted.python import usage
 from twisted.web import server
 
-from .api import UniqueCodeServiceApp
+from .api import UniqueCodeServiceApp, MAX_REDEEM_BATCH_SIZE
+from .workers import (
+    AppService, WorkerSupervisor, WORKER_LISTEN_FD, run_worker)
 
 
 DEFAULT_PORT = '8080'
@@ -11,19 +16,169 @@ DEFAULT_PORT = '8080'
 
 class Options(usage.Options):
     """Command line args when run as a twistd plugin"""
+    optFlags = [["bloom-filter", None,
+                 "Keep a Bloom filter of each pool's unique codes so that"
+                 " redeems of codes that don't exist skip the lookup"],
+                ["group-commit", None,
+                 "Redeem unique codes from concurrent requests in shared"
+                 " transactions"]]
     optParameters = [["port", "p", DEFAULT_PORT,
                       "Port number for unique-code-service to listen on"],
                      ["database-connection-string", "d", None,
-                      "Database connection string"]]
+                      "Database connection string"],
+                     ["read-database-connection-string", None, None,
+                      "Connection string for a read replica to send audit"
+                      " queries and unique code counts to"],
+                     ["read-replica-max-lag", None, 5.0,
+                      "Most seconds behind the primary the read replica may"
+                      " be before its queries go to the primary instead",
+                      float],
+                     ["db-pool-min-size", None, 1,
+                      "Number of idle database connections to keep open",
+                      int],
+                     ["db-pool-max-size", None, 10,
+                      "Maximum number of database connections (keep this"
+                      " below the reactor's thread pool size)", int],
+                     ["db-pool-acquire-timeout", None, 30.0,
+                      "Seconds to wait for a database connection", float],
+                     ["db-pool-idle-timeout", None, 300.0,
+                      "Seconds before idle database connections are closed"
+                      " or rechecked", float],
+                     ["pool-cache-ttl", None, 60.0,
+                      "Seconds to cache unique code pool metadata and"
+                      " existence for", float],
+                     ["workers", "w", 1,
+                      "Number of worker processes to serve requests with."
+                      " Each worker has its own database connection pool.",
+                      int],
+                     ["drain-timeout", None, 30.0,
+                      "Seconds to let workers finish their requests when"
+                      " shutting down", float],
+                     ["import-spool-dir", None, None,
+                      "Directory to keep uploads for asynchronous imports in"
+                      " (defaults to the system's temporary directory, where"
+                      " uploads left by processes that died aren't cleaned"
+                      " up)"],
+                     ["bloom-filter-error-rate", None, 0.01,
+                      "Fraction of missing unique codes the Bloom filters may"
+                      " report as present", float],
+                     ["bloom-filter-max-bytes", None, 16 * 1024 * 1024,
+                      "Most memory each pool's Bloom filter may use", int],
+                     ["bloom-filter-max-staleness", None, 1.0,
+                      "Seconds to trust a Bloom filter for after it was last"
+                      " synced. Codes imported by another worker may be"
+                      " reported as invalid for this long.", float],
+                     ["group-commit-interval", None, 0.005,
+                      "Seconds a redeem waits for others to share its"
+                      " transaction with", float],
+                     ["group-commit-max-batch-size", None, 100,
+                      "Most redeems to put in one transaction", int],
+                     ["counts-cache-max-staleness", None, 1.0,
+                      "Seconds to reuse unique code counts for. Writes by"
+                      " this worker are always included, but writes by"
+                      " other workers may be missing for this long. 0"
+                      " disables caching.", float]]
 
     def postOptions(self):
         if self['database-connection-string'] is None:
             raise usage.UsageError(
                 "--database-connection-string parameter is mandatory.")
+        if self['workers'] < 1:
+            raise usage.UsageError("--workers must be at least 1.")
+        if self['workers'] > 1 and not self['port'].isdigit():
+            raise usage.UsageError(
+                "--port must be a TCP port number when using more than one"
+                " worker.")
+        if self['counts-cache-max-staleness'] < 0:
+            raise usage.UsageError(
+                "--counts-cache-max-staleness may not be negative.")
+        if not 1 <= self['group-commit-max-batch-size'] <= (
+                MAX_REDEEM_BATCH_SIZE):
+            raise usage.UsageError(
+                "--group-commit-max-batch-size must be between 1 and %s." % (
+                    MAX_REDEEM_BATCH_SIZE,))
+
+
+def make_app(options):
+    return UniqueCodeServiceApp(
+        options['database-connection-string'], reactor=reactor,
+        min_connections=options.get('db-pool-min-size', 1),
+        max_connections=options.get('db-pool-max-size', 10),
+        acquire_timeout=options.get('db-pool-acquire-timeout', 30.0),
+        idle_timeout=options.get('db-pool-idle-timeout', 300.0),
+        pool_cache_ttl=options.get('pool-cache-ttl', 60.0),
+        import_spool_dir=options.get('import-spool-dir'),
+        bloom_filter=options.get('bloom-filter', False),
+        bloom_filter_error_rate=options.get('bloom-filter-error-rate', 0.01),
+        bloom_filter_max_bytes=options.get('bloom-filter-max-bytes'),
+        bloom_filter_max_staleness=options.get(
+            'bloom-filter-max-staleness', 1.0),
+        group_commit=options.get('group-commit', False),
+        group_commit_interval=options.get('group-commit-interval', 0.005),
+        group_commit_max_batch_size=options.get(
+            'group-commit-max-batch-size', 100),
+        read_conn_str=options.get('read-database-connection-string'),
+        read_max_lag=options.get('read-replica-max-lag', 5.0),
+        counts_cache_max_staleness=options.get(
+            'counts-cache-max-staleness', 1.0))
+
+
+class WorkerOptions(Options):
+    """Command line args for a worker process started by makeService"""
+    optParameters = [["fd", None, None,
+                      "File descriptor of the socket to accept connections"
+                      " on", int]]
+
+    def postOptions(self):
+        Options.postOptions(self)
+        if self['fd'] is None:
+            raise usage.UsageError("--fd parameter is mandatory.")
+
+
+def worker_argv(options):
+    """Return the command line for a worker process with our options."""
+    argv = [sys.executable, '-m', __name__, '--fd', str(WORKER_LISTEN_FD)]
+    for name in ['database-connection-string',
+                 'read-database-connection-string', 'read-replica-max-lag',
+                 'db-pool-min-size',
+                 'db-pool-max-size', 'db-pool-acquire-timeout',
+                 'db-pool-idle-timeout', 'pool-cache-ttl', 'drain-timeout',
+                 'import-spool-dir', 'bloom-filter-error-rate',
+                 'bloom-filter-max-bytes', 'bloom-filter-max-staleness',
+                 'group-commit-interval', 'group-commit-max-batch-size',
+                 'counts-cache-max-staleness']:
+        if options.get(name) is not None:
+            argv.extend(['--%s' % (name,), str(options[name])])
+    for flag in ['bloom-filter', 'group-commit']:
+        if options.get(flag):
+            argv.append('--%s' % (flag,))
+    return argv
 
 
 def makeService(options):
-    app = UniqueCodeServiceApp(
-        options['database-connection-string'], reactor=reactor)
+    workers = options.get('workers', 1)
+    if workers > 1:
+        # Check the connection strings here rather than in every worker.
+        get_engine(options['database-connection-string'], reactor)
+        if options.get('read-database-connection-string') is not None:
+            get_engine(options['read-database-connection-string'], reactor)
+        return WorkerSupervisor(
+            worker_argv(options), int(options['port']), workers, reactor,
+            drain_timeout=options.get('drain-timeout', 30.0))
+    app = make_app(options)
     site = server.Site(app.app.resource())
-    return strports.service(options['port'], site)
+    svc = AppService(
+        app, reactor, drain_timeout=options.get('drain-timeout', 30.0))
+    strports.service(options['port'], site).setServiceParent(svc)
+    return svc
+
+
+if __name__ == '__main__':
+    worker_options = WorkerOptions()
+    try:
+        worker_options.parseOptions(sys.argv[1:])
+    except usage.UsageError as e:
+        print >> sys.stderr, '%s\n%s' % (worker_options, e)
+        sys.exit(1)
+    run_worker(reactor, worker_options['fd'], make_app(worker_options),
+               worker_options['drain-timeout'])
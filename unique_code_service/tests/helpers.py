@@ -1,3 +1,5 @@
+import shutil
+import tempfile
 from uuid import uuid4
 
 
@@ -26,3 +28,14 @@ def mk_audit_params(request_id, transaction_id=None, user_id=None):
 
 def sorted_dicts(dicts):
     return sorted(dicts, key=lambda d: sorted(d.items()))
+
+
+def mk_temp_dir(test_case):
+    """Make a temporary directory that's removed once the test is done.
+
+    ``TestCase.mktemp()`` makes paths relative to the current directory,
+    which is only a temporary one when the tests are run by trial.
+    """
+    path = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, path, ignore_errors=True)
+    return path
@@ -3,21 +3,27 @@ from hashlib import md5
 from itertools import izip_longest
 import json
 import os
+import subprocess
 from urllib import urlencode
 from StringIO import StringIO
 
 from aludel.database import MetaData
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
-from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, gatherResults, succeed
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase, SkipTest
 from twisted.web.client import Agent, FileBodyProducer, readBody
 from twisted.web.http_headers import Headers
 from twisted.web.server import Site
 
+from unique_code_service import api
 from unique_code_service.api import UniqueCodeServiceApp
-from unique_code_service.models import UniqueCodePool
+from unique_code_service.connection_pool import ConnectionPool
+from unique_code_service.models import UniqueCodePool, NoUniqueCodePool
+from unique_code_service.replica import ReadReplica
 
-from .helpers import populate_pool, mk_audit_params, sorted_dicts
+from .helpers import (
+    populate_pool, mk_audit_params, mk_temp_dir, sorted_dicts)
 
 
 class ApiClient(object):
@@ -64,8 +70,10 @@ class ApiClient(object):
         return self.put(url_path, Headers({}), None, expected_code)
 
     def put_import(self, request_id, content, content_md5=None,
-                   expected_code=201):
+                   expected_code=201, params=None):
         url_path = 'testpool/import/%s' % (request_id,)
+        if params is not None:
+            url_path = '?'.join([url_path, urlencode(params)])
         hdict = {
             'Content-Type': ['text/csv'],
         }
@@ -75,6 +83,14 @@ class ApiClient(object):
             hdict['Content-MD5'] = [content_md5]
         return self.put(url_path, Headers(hdict), content, expected_code)
 
+    def put_import_async(self, request_id, content, expected_code=202):
+        return self.put_import(request_id, content, params={'async': 'true'},
+                               expected_code=expected_code)
+
+    def get_import_status(self, request_id, expected_code=200):
+        url_path = 'testpool/import/%s/status' % (request_id,)
+        return self.get(url_path, {}, expected_code)
+
     def get_audit_query(self, request_id, field, value, expected_code=200):
         params = {'request_id': request_id, 'field': field, 'value': value}
         return self.get('testpool/audit_query', params, expected_code)
@@ -84,6 +100,14 @@ class ApiClient(object):
         return self.get('testpool/unique_code_counts', params, expected_code)
 
 
+def import_summary(inserted, invalid=0, duplicate=0, rejected_rows=()):
+    return {
+        'inserted': inserted,
+        'rejected': {'invalid': invalid, 'duplicate': duplicate},
+        'rejected_rows': list(rejected_rows),
+    }
+
+
 class TestUniqueCodeServiceApp(TestCase):
     timeout = 5
 
@@ -95,6 +119,7 @@ class TestUniqueCodeServiceApp(TestCase):
         connection_string = os.environ.get(
             "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
         self._using_mysql = connection_string.startswith('mysql')
+        self._using_sqlite = connection_string.startswith('sqlite')
         self.asapp = UniqueCodeServiceApp(connection_string, reactor=reactor)
         site = Site(self.asapp.app.resource())
         self.listener = reactor.listenTCP(0, site, interface='localhost')
@@ -107,6 +132,7 @@ class TestUniqueCodeServiceApp(TestCase):
     @inlineCallbacks
     def tearDown(self):
         yield self.conn.close()
+        yield self.asapp.conn_pool.close()
         self._drop_tables()
         yield self.listener.loseConnection()
 
@@ -117,6 +143,12 @@ class TestUniqueCodeServiceApp(TestCase):
         md.drop_all()
         assert self.asapp.engine._engine.table_names() == []
 
+    def use_thread_pool_size(self, size):
+        # Later tests need their single thread back.
+        self.addCleanup(
+            reactor.suggestThreadPoolSize, reactor.getThreadPool().max)
+        reactor.suggestThreadPoolSize(size)
+
     @inlineCallbacks
     def assert_unique_code_counts(self, expected_rows):
         rows = yield self.pool.count_unique_codes()
@@ -168,6 +200,25 @@ class TestUniqueCodeServiceApp(TestCase):
             'error': 'Unique code pool does not exist.',
         }
 
+    @inlineCallbacks
+    def test_redeem_missing_pool_cached(self):
+        yield self.pool._collection_metadata.create()
+        yield self.client.put_redeem('req-0', 'vanilla0', expected_code=404)
+        acquired = self.asapp.conn_pool.stats()['acquired']
+
+        # We know the pool is missing, so we don't need the database.
+        rsp = yield self.client.put_redeem(
+            'req-1', 'vanilla0', expected_code=404)
+        assert rsp == {
+            'request_id': 'req-1',
+            'error': 'Unique code pool does not exist.',
+        }
+        assert self.asapp.conn_pool.stats()['acquired'] == acquired
+
+        # Creating the pool through the API works, though.
+        yield self.client.put_create()
+        yield self.client.put_redeem('req-2', 'vanilla0')
+
     @inlineCallbacks
     def test_issue_response_contains_request_id(self):
         yield self.pool.create_tables()
@@ -247,7 +298,183 @@ class TestUniqueCodeServiceApp(TestCase):
             'error': 'Cannot redeem unique code: used',
         }
 
-    def _assert_audit_entries(self, request_id, response, expected_entries):
+    @inlineCallbacks
+    def test_redeem_concurrent_single_winner(self):
+        if self._using_sqlite:
+            raise SkipTest(
+                "SQLite connections in a single thread share a transaction.")
+        # Each in-flight redeem may block a thread waiting for a row lock, so
+        # we need enough threads for the lock holders to make progress.
+        self.use_thread_pool_size(60)
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla'], range(5))
+
+        ds = []
+        for code in range(5):
+            for attempt in range(10):
+                ds.append(self.client.put_redeem(
+                    'req-%s-%s' % (code, attempt), 'vanilla%s' % (code,)))
+        responses = yield gatherResults(ds)
+
+        winners = [rsp['unique_code'] for rsp in responses
+                   if 'unique_code' in rsp]
+        assert sorted(winners) == ['vanilla%s' % (i,) for i in range(5)]
+        losers = [rsp for rsp in responses if 'unique_code' not in rsp]
+        assert len(losers) == 45
+        assert set(rsp['error'] for rsp in losers) == set([
+            'Cannot redeem unique code: used'])
+        yield self.assert_unique_code_counts([('vanilla', True, 5)])
+
+    @inlineCallbacks
+    def test_import_concurrent_new_flavour(self):
+        if self._using_sqlite:
+            raise SkipTest(
+                "SQLite connections in a single thread share a transaction.")
+        self.use_thread_pool_size(20)
+        yield self.pool.create_tables()
+        # Every import creates the same new counters.
+        ds = []
+        for i in range(10):
+            content = 'unique_code,flavour\nvanilla%s,vanilla' % (i,)
+            ds.append(self.client.put_import('req-%s' % (i,), content))
+        yield gatherResults(ds)
+        yield self.assert_unique_code_counts([('vanilla', False, 10)])
+
+    @inlineCallbacks
+    def test_redeem_batch(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla', 'chocolate'], [0, 1])
+        params = mk_audit_params('req-0')
+        params.pop('request_id')
+        params['unique_codes'] = [
+            'vanilla0', 'CHOCOLATE1', 'banana', 'vanilla0']
+        rsp = yield self.client.put_json('testpool/redeem_batch/req-0', params)
+        assert rsp == {
+            'request_id': 'req-0',
+            'results': [{
+                'candidate_code': 'vanilla0',
+                'unique_code': 'vanilla0',
+                'flavour': 'vanilla',
+            }, {
+                'candidate_code': 'CHOCOLATE1',
+                'unique_code': 'chocolate1',
+                'flavour': 'chocolate',
+            }, {
+                'candidate_code': 'banana',
+                'error': 'Cannot redeem unique code: invalid',
+            }, {
+                'candidate_code': 'vanilla0',
+                'error': 'Cannot redeem unique code: used',
+            }],
+        }
+
+        # Repeating the request gets the same response.
+        rsp2 = yield self.client.put_json(
+            'testpool/redeem_batch/req-0', params)
+        assert rsp2 == rsp
+
+        # Repeating it with more codes doesn't redeem them.
+        params['unique_codes'].append('chocolate0')
+        rsp3 = yield self.client.put_json(
+            'testpool/redeem_batch/req-0', params, expected_code=400)
+        assert rsp3 == {
+            'request_id': 'req-0',
+            'error': (
+                'This request has already been performed with different'
+                ' parameters.'),
+        }
+        yield self.assert_unique_code_counts([
+            ('vanilla', False, 1),
+            ('vanilla', True, 1),
+            ('chocolate', False, 1),
+            ('chocolate', True, 1),
+        ])
+
+    @inlineCallbacks
+    def test_redeem_batch_bad_unique_codes(self):
+        yield self.pool.create_tables()
+        params = mk_audit_params('req-0')
+        params.pop('request_id')
+        params['unique_codes'] = 'vanilla0'
+        rsp = yield self.client.put_json(
+            'testpool/redeem_batch/req-0', params, expected_code=400)
+        assert rsp == {
+            'request_id': 'req-0',
+            'error': 'unique_codes must be a list of strings.',
+        }
+
+        params['unique_codes'] = ['vanilla%s' % (i,) for i in range(501)]
+        rsp = yield self.client.put_json(
+            'testpool/redeem_batch/req-0', params, expected_code=400)
+        assert rsp == {
+            'request_id': 'req-0',
+            'error': 'Too many unique codes, the maximum is 500.',
+        }
+
+    @inlineCallbacks
+    def test_redeem_batch_missing_pool(self):
+        params = mk_audit_params('req-0')
+        params.pop('request_id')
+        params['unique_codes'] = ['vanilla0']
+        rsp = yield self.client.put_json(
+            'testpool/redeem_batch/req-0', params, expected_code=404)
+        assert rsp == {
+            'request_id': 'req-0',
+            'error': 'Unique code pool does not exist.',
+        }
+
+    def mk_issue_params(self, flavour):
+        params = mk_audit_params('ignored')
+        params.pop('request_id')
+        params['flavour'] = flavour
+        return params
+
+    @inlineCallbacks
+    def test_issue(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla', 'chocolate'], [0])
+        rsp = yield self.client.put_json(
+            'testpool/issue/req-0', self.mk_issue_params('vanilla'))
+        assert rsp == {
+            'request_id': 'req-0',
+            'unique_code': 'vanilla0',
+            'flavour': 'vanilla',
+        }
+
+        # Repeating the request gets the same response.
+        rsp2 = yield self.client.put_json(
+            'testpool/issue/req-0', self.mk_issue_params('vanilla'))
+        assert rsp2 == rsp
+        yield self.assert_unique_code_counts([
+            ('vanilla', True, 1),
+            ('chocolate', False, 1),
+        ])
+
+    @inlineCallbacks
+    def test_issue_exhausted(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla'], [0])
+        yield self.client.put_json(
+            'testpool/issue/req-0', self.mk_issue_params('vanilla'))
+        rsp = yield self.client.put_json(
+            'testpool/issue/req-1', self.mk_issue_params('vanilla'))
+        assert rsp == {
+            'request_id': 'req-1',
+            'error': 'Cannot issue unique code: exhausted',
+        }
+
+    @inlineCallbacks
+    def test_issue_missing_pool(self):
+        rsp = yield self.client.put_json(
+            'testpool/issue/req-0', self.mk_issue_params('vanilla'),
+            expected_code=404)
+        assert rsp == {
+            'request_id': 'req-0',
+            'error': 'Unique code pool does not exist.',
+        }
+
+    def _assert_audit_entries(self, request_id, response, expected_entries,
+                              next_cursor=None):
         def created_ats():
             format_str = '%Y-%m-%dT%H:%M:%S.%f'
             if self._using_mysql:
@@ -270,6 +497,7 @@ class TestUniqueCodeServiceApp(TestCase):
         assert response == {
             'request_id': request_id,
             'results': expected_results,
+            'next_cursor': next_cursor,
         }
 
     @inlineCallbacks
@@ -293,6 +521,7 @@ class TestUniqueCodeServiceApp(TestCase):
         assert rsp == {
             'request_id': 'audit-0',
             'results': [],
+            'next_cursor': None,
         }
 
         yield self.pool._audit_request(
@@ -319,6 +548,7 @@ class TestUniqueCodeServiceApp(TestCase):
         assert rsp == {
             'request_id': 'audit-0',
             'results': [],
+            'next_cursor': None,
         }
 
         yield self.pool._audit_request(
@@ -351,6 +581,7 @@ class TestUniqueCodeServiceApp(TestCase):
         assert rsp == {
             'request_id': 'audit-0',
             'results': [],
+            'next_cursor': None,
         }
 
         yield self.pool._audit_request(
@@ -382,6 +613,7 @@ class TestUniqueCodeServiceApp(TestCase):
         assert rsp == {
             'request_id': 'audit-0',
             'results': [],
+            'next_cursor': None,
         }
 
         yield self.pool._audit_request(
@@ -404,6 +636,156 @@ class TestUniqueCodeServiceApp(TestCase):
             'error': False,
         }])
 
+    @inlineCallbacks
+    def add_audit_entries(self, count, transaction_id='transaction-0'):
+        for i in range(count):
+            yield self.pool._audit_request(
+                mk_audit_params(
+                    'req-%s-%s' % (transaction_id, i), transaction_id),
+                'req_data_%s' % (i,), 'resp_data_%s' % (i,), 'vanilla0')
+
+    @inlineCallbacks
+    def test_query_pages(self):
+        yield self.pool.create_tables()
+        yield self.add_audit_entries(5)
+
+        request_ids = []
+        params = {
+            'request_id': 'audit-0',
+            'field': 'transaction_id',
+            'value': 'transaction-0',
+            'limit': 2,
+        }
+        pages = 0
+        while True:
+            rsp = yield self.client.get('testpool/audit_query', params, 200)
+            pages += 1
+            request_ids.extend(r['request_id'] for r in rsp['results'])
+            if rsp['next_cursor'] is None:
+                break
+            params['cursor'] = rsp['next_cursor']
+        assert pages == 3
+        assert request_ids == [
+            'req-transaction-0-%s' % (i,) for i in range(5)]
+
+    @inlineCallbacks
+    def test_query_default_limit(self):
+        self.patch(api, 'MAX_AUDIT_QUERY_LIMIT', 3)
+        yield self.pool.create_tables()
+        yield self.add_audit_entries(5)
+        rsp = yield self.client.get_audit_query(
+            'audit-0', 'transaction_id', 'transaction-0')
+        assert len(rsp['results']) == 3
+        assert rsp['next_cursor'] is not None
+
+    @inlineCallbacks
+    def test_query_bad_limit(self):
+        yield self.pool.create_tables()
+        for limit in ['0', '1001', 'many']:
+            rsp = yield self.client.get('testpool/audit_query', {
+                'request_id': 'audit-0',
+                'field': 'user_id',
+                'value': 'user-0',
+                'limit': limit,
+            }, 400)
+            assert rsp == {
+                'request_id': 'audit-0',
+                'error': 'limit must be a number from 1 to 1000.',
+            }
+
+    @inlineCallbacks
+    def test_query_bad_cursor(self):
+        yield self.pool.create_tables()
+        for cursor in ['foo', 'foo,1', '2014-01-01T00:00:00.000000,x']:
+            rsp = yield self.client.get('testpool/audit_query', {
+                'request_id': 'audit-0',
+                'field': 'user_id',
+                'value': 'user-0',
+                'cursor': cursor,
+            }, 400)
+            assert rsp == {
+                'request_id': 'audit-0',
+                'error': 'Invalid cursor.',
+            }
+
+    @inlineCallbacks
+    def test_query_stream(self):
+        self.patch(api, 'AUDIT_STREAM_PAGE_SIZE', 2)
+        yield self.pool.create_tables()
+        yield self.add_audit_entries(5)
+        yield self.add_audit_entries(1, 'transaction-1')
+
+        rsp = yield self.client.get('testpool/audit_query_stream', {
+            'request_id': 'audit-0',
+            'field': 'transaction_id',
+            'value': 'transaction-0',
+        }, 200)
+        assert rsp['request_id'] == 'audit-0'
+        assert [r['request_id'] for r in rsp['results']] == [
+            'req-transaction-0-%s' % (i,) for i in range(5)]
+
+        # The streamed records look like the paged ones.
+        paged_rsp = yield self.client.get_audit_query(
+            'audit-0', 'transaction_id', 'transaction-0')
+        assert rsp['results'] == paged_rsp['results']
+
+    @inlineCallbacks
+    def test_audit_record_json(self):
+        yield self.pool.create_tables()
+        yield self.pool._audit_request(
+            mk_audit_params('req-0'), {'candidate_code': u'vanill\xe1'},
+            {'reason': 'invalid'}, 'vanilla0', error=True)
+        [record] = yield self.pool.query_by_request_id('req-0')
+        record_json = api.audit_record_json(record)
+        # We didn't need to decode anything.
+        assert record._decoded == {}
+        assert json.loads(record_json) == api.format_audit_record(record)
+
+        # Compactly stored records come out the same.
+        yield self.pool._audit_request(
+            mk_audit_params('req-1'), {'candidate_code': u'vanilla0'},
+            {'reason': 'used', 'unique_code': u'vanilla0'}, u'vanilla0',
+            error=True)
+        [record] = yield self.pool.query_by_request_id('req-1')
+        record_json = api.audit_record_json(record)
+        assert record._decoded == {}
+        assert json.loads(record_json) == api.format_audit_record(record)
+        assert json.loads(record.raw_request_data) == {
+            'candidate_code': 'vanilla0'}
+
+    @inlineCallbacks
+    def test_query_stream_empty(self):
+        yield self.pool.create_tables()
+        rsp = yield self.client.get('testpool/audit_query_stream', {
+            'request_id': 'audit-0',
+            'field': 'transaction_id',
+            'value': 'transaction-0',
+        }, 200)
+        assert rsp == {'request_id': 'audit-0', 'results': []}
+
+    @inlineCallbacks
+    def test_query_stream_errors(self):
+        rsp = yield self.client.get('testpool/audit_query_stream', {
+            'request_id': 'audit-0',
+            'field': 'transaction_id',
+            'value': 'transaction-0',
+        }, 404)
+        assert rsp == {
+            'request_id': 'audit-0',
+            'error': 'Unique code pool does not exist.',
+        }
+
+        yield self.pool.create_tables()
+        rsp = yield self.client.get('testpool/audit_query_stream', {
+            'request_id': 'audit-1',
+            'field': 'flavour',
+            'value': 'vanilla',
+        }, 400)
+        assert rsp == {
+            'request_id': 'audit-1',
+            'error': 'Invalid audit field.',
+        }
+
     @inlineCallbacks
     def test_create(self):
         resp = yield self.client.put_create()
@@ -435,12 +817,64 @@ class TestUniqueCodeServiceApp(TestCase):
         assert resp == {
             'request_id': 'req-0',
             'imported': True,
+            'summary': import_summary(4),
         }
         yield self.assert_unique_code_counts([
             ('vanilla', False, 2),
             ('chocolate', False, 2),
         ])
 
+    @inlineCallbacks
+    def test_import_large(self):
+        yield self.pool.create_tables()
+
+        # This is big enough for twisted.web to spool it to a temporary file
+        # and to need several insert batches.
+        content = '\n'.join(['unique_code,flavour'] + [
+            'vanilla%s,vanilla' % (i,) for i in range(15000)])
+        assert len(content) > 100000
+
+        resp = yield self.client.put_import('req-0', content)
+        assert resp == {
+            'request_id': 'req-0',
+            'imported': True,
+            'summary': import_summary(15000),
+        }
+        yield self.assert_unique_code_counts([('vanilla', False, 15000)])
+
+    @inlineCallbacks
+    def test_import_rejects(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla'], [0])
+
+        content = '\n'.join([
+            'unique_code,flavour',
+            'Vanilla-1,vanilla',
+            'VANILLA0,vanilla',
+            '--,vanilla',
+            'vanilla 1,vanilla',
+            'chocolate0,chocolate',
+        ])
+        resp = yield self.client.put_import('req-0', content)
+        assert resp == {
+            'request_id': 'req-0',
+            'imported': True,
+            'summary': import_summary(
+                2, invalid=1, duplicate=2, rejected_rows=[
+                    {'row': 2, 'unique_code': 'VANILLA0',
+                     'reason': 'duplicate'},
+                    {'row': 3, 'unique_code': '--', 'reason': 'invalid'},
+                    {'row': 4, 'unique_code': 'vanilla 1',
+                     'reason': 'duplicate'},
+                ]),
+        }
+        yield self.assert_unique_code_counts([
+            ('vanilla', False, 2),
+            ('chocolate', False, 1),
+        ])
+        rsp = yield self.client.put_redeem('req-1', 'VANILLA-1')
+        assert rsp['unique_code'] == 'vanilla1'
+
     @inlineCallbacks
     def test_import_missing_pool(self):
         content = '\n'.join([
@@ -474,6 +908,7 @@ class TestUniqueCodeServiceApp(TestCase):
         assert resp == {
             'request_id': 'req-0',
             'imported': True,
+            'summary': import_summary(4),
         }
         yield self.assert_unique_code_counts([
             ('vanilla', False, 2),
@@ -524,6 +959,7 @@ class TestUniqueCodeServiceApp(TestCase):
         assert resp == {
             'request_id': 'req-0',
             'imported': True,
+            'summary': import_summary(4),
         }
         yield self.assert_unique_code_counts(expected_counts)
 
@@ -531,6 +967,7 @@ class TestUniqueCodeServiceApp(TestCase):
         assert resp == {
             'request_id': 'req-0',
             'imported': True,
+            'summary': None,
         }
         yield self.assert_unique_code_counts(expected_counts)
 
@@ -552,6 +989,208 @@ class TestUniqueCodeServiceApp(TestCase):
         }
         yield self.assert_unique_code_counts(expected_counts)
 
+    def use_spool_dir(self):
+        spool_dir = mk_temp_dir(self)
+        self.asapp.import_spool_dir = spool_dir
+        return spool_dir
+
+    def wait_for_import_job(self, request_id):
+        # The job may have finished before we got our response.
+        return self.asapp.running_import_jobs.get(
+            ('testpool', request_id), succeed(None))
+
+    @inlineCallbacks
+    def test_import_async(self):
+        yield self.pool.create_tables()
+        spool_dir = self.use_spool_dir()
+        self.patch(api, 'IMPORT_JOB_BATCH_SIZE', 2)
+
+        content = '\n'.join([
+            'unique_code,flavour',
+            'vanilla0,vanilla',
+            'vanilla1,vanilla',
+            'VANILLA1,vanilla',
+            'chocolate0,chocolate',
+            'chocolate1,chocolate',
+        ])
+        resp = yield self.client.put_import_async('req-0', content)
+        assert resp['request_id'] == 'req-0'
+        assert resp['job_id'] == 'req-0'
+        assert resp['status'] == 'running'
+        assert resp['rows_processed'] == 0
+
+        yield self.wait_for_import_job('req-0')
+        resp = yield self.client.get_import_status('req-0')
+        assert resp['status'] == 'done'
+        assert resp['rows_processed'] == 5
+        assert resp['error'] is None
+        assert resp['summary'] == import_summary(
+            4, duplicate=1, rejected_rows=[
+                {'row': 3, 'unique_code': 'VANILLA1', 'reason': 'duplicate'},
+            ])
+        assert resp['rows_per_second'] > 0
+        yield self.assert_unique_code_counts([
+            ('vanilla', False, 2),
+            ('chocolate', False, 2),
+        ])
+        # The upload is deleted once it's been imported.
+        assert os.listdir(spool_dir) == []
+
+    @inlineCallbacks
+    def test_import_async_idempotent(self):
+        yield self.pool.create_tables()
+        self.use_spool_dir()
+        content = 'unique_code,flavour\nvanilla0,vanilla\n'
+
+        yield self.client.put_import_async('req-0', content)
+        yield self.wait_for_import_job('req-0')
+        resp = yield self.client.put_import_async('req-0', content)
+        assert resp['status'] == 'done'
+        assert self.asapp.running_import_jobs == {}
+        resp = yield self.client.put_import('req-0', content)
+        assert resp['summary'] is None
+
+        resp = yield self.client.put_import_async(
+            'req-0', content + 'vanilla1,vanilla\n', expected_code=400)
+        assert resp['error'] == (
+            'This request has already been performed with different'
+            ' parameters.')
+        yield self.assert_unique_code_counts([('vanilla', False, 1)])
+
+        # Synchronous imports can't be repeated asynchronously either.
+        yield self.client.put_import('req-1', content)
+        resp = yield self.client.put_import_async(
+            'req-1', content, expected_code=201)
+        assert resp['summary'] is None
+
+    @inlineCallbacks
+    def test_import_async_failure(self):
+        yield self.pool.create_tables()
+        spool_dir = self.use_spool_dir()
+        self.patch(api, 'IMPORT_JOB_BATCH_SIZE', 2)
+        import_batch = UniqueCodePool._import_batch
+        calls = []
+
+        def failing_import_batch(pool, *args):
+            calls.append(None)
+            if len(calls) == 2:
+                raise ValueError('oops')
+            return import_batch(pool, *args)
+        self.patch(UniqueCodePool, '_import_batch', failing_import_batch)
+
+        content = '\n'.join(['unique_code,flavour'] + [
+            'vanilla%s,vanilla' % (i,) for i in range(5)])
+        yield self.client.put_import_async('req-0', content)
+        yield self.wait_for_import_job('req-0')
+        self.flushLoggedErrors(ValueError)
+        resp = yield self.client.get_import_status('req-0')
+        assert resp['status'] == 'failed'
+        assert resp['error'] == 'oops'
+        assert resp['rows_processed'] == 2
+        assert os.listdir(spool_dir) == []
+        yield self.assert_unique_code_counts([('vanilla', False, 2)])
+
+        # Repeating the import carries on where the job left off.
+        resp = yield self.client.put_import_async('req-0', content)
+        assert resp['status'] == 'running'
+        yield self.wait_for_import_job('req-0')
+        resp = yield self.client.get_import_status('req-0')
+        assert resp['status'] == 'done'
+        assert resp['rows_processed'] == 5
+        assert resp['summary'] == import_summary(5)
+        yield self.assert_unique_code_counts([('vanilla', False, 5)])
+
+    @inlineCallbacks
+    def test_import_async_stopped(self):
+        yield self.pool.create_tables()
+        spool_dir = self.use_spool_dir()
+        self.patch(api, 'IMPORT_JOB_BATCH_SIZE', 2)
+        import_batch = UniqueCodePool._import_batch
+
+        def stopping_import_batch(pool, *args):
+            # We're told to stop in the middle of the first batch.
+            self.asapp.stop_import_jobs()
+            return import_batch(pool, *args)
+        self.patch(UniqueCodePool, '_import_batch', stopping_import_batch)
+
+        content = '\n'.join(['unique_code,flavour'] + [
+            'vanilla%s,vanilla' % (i,) for i in range(5)])
+        yield self.client.put_import_async('req-0', content)
+        yield self.asapp.stop_import_jobs()
+        assert self.asapp.running_import_jobs == {}
+        resp = yield self.client.get_import_status('req-0')
+        assert resp['status'] == 'failed'
+        assert resp['error'] == (
+            'Interrupted by a shutdown, repeat the import to resume it.')
+        assert resp['rows_processed'] == 2
+        assert os.listdir(spool_dir) == []
+
+        # Another process picks it up without waiting for it to go stale.
+        self.asapp.stopping_import_jobs = False
+        self.patch(UniqueCodePool, '_import_batch', import_batch)
+        resp = yield self.client.put_import_async('req-0', content)
+        assert resp['status'] == 'running'
+        yield self.wait_for_import_job('req-0')
+        resp = yield self.client.get_import_status('req-0')
+        assert (resp['status'], resp['rows_processed']) == ('done', 5)
+        yield self.assert_unique_code_counts([('vanilla', False, 5)])
+
+    def test_remove_orphaned_spool_files(self):
+        spool_dir = self.use_spool_dir()
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        names = ['import-%s-a.csv' % (dead.pid,),
+                 'import-%s-b.csv' % (os.getpid(),),
+                 'other.csv']
+        for name in names:
+            open(os.path.join(spool_dir, name), 'w').close()
+        api.remove_orphaned_spool_files(spool_dir)
+        assert sorted(os.listdir(spool_dir)) == names[1:]
+
+    def test_remove_orphaned_spool_files_configured_only(self):
+        swept = []
+        self.patch(api, 'remove_orphaned_spool_files', swept.append)
+        # Other programs' files live in the system's temporary directory.
+        UniqueCodeServiceApp('sqlite://', reactor=reactor)
+        assert swept == []
+        spool_dir = mk_temp_dir(self)
+        UniqueCodeServiceApp(
+            'sqlite://', reactor=reactor, import_spool_dir=spool_dir)
+        assert swept == [spool_dir]
+
+    @inlineCallbacks
+    def test_import_async_bad_params(self):
+        yield self.pool.create_tables()
+        resp = yield self.client.put_import(
+            'req-0', 'content', params={'async': 'maybe'}, expected_code=400)
+        assert resp['error'] == 'async must be true or false.'
+        resp = yield self.client.put_import(
+            'req-0', 'content', params={'foo': 'bar'}, expected_code=400)
+        assert resp['error'] == "Unexpected request parameters: 'foo'"
+
+    @inlineCallbacks
+    def test_import_status_missing_job(self):
+        yield self.pool.create_tables()
+        resp = yield self.client.get_import_status('req-0', expected_code=404)
+        assert resp == {
+            'request_id': 'req-0',
+            'error': 'Import job does not exist.',
+        }
+
+    @inlineCallbacks
+    def test_import_job_in_progress(self):
+        yield self.pool.create_tables()
+        content = 'unique_code,flavour\nvanilla0,vanilla'
+        yield self.pool.start_import_job('req-0', md5(content).hexdigest())
+        resp = yield self.client.put_import(
+            'req-0', content, expected_code=409)
+        assert resp == {
+            'request_id': 'req-0',
+            'error': 'An asynchronous import with this request_id has not'
+                     ' finished, check its status.',
+        }
+        yield self.assert_unique_code_counts([])
+
     @inlineCallbacks
     def test_unique_code_counts(self):
         yield self.pool.create_tables()
@@ -562,6 +1201,8 @@ class TestUniqueCodeServiceApp(TestCase):
         }
 
         yield populate_pool(self.pool, ['vanilla'], [0, 1])
+        # We've changed the counts behind the app's back.
+        self.asapp.counts_cache.invalidate('testpool')
         rsp1 = yield self.client.get_unique_code_counts('req-1')
         assert rsp1 == {
             'request_id': 'req-1',
@@ -577,6 +1218,7 @@ class TestUniqueCodeServiceApp(TestCase):
         yield populate_pool(self.pool, ['chocolate'], [0, 1])
         yield self.pool.redeem_unique_code(
             'chocolate0', mk_audit_params('req-0'))
+        self.asapp.counts_cache.invalidate('testpool')
         rsp2 = yield self.client.get_unique_code_counts('req-2')
         assert sorted_dicts(rsp2['unique_code_counts']) == sorted_dicts([
             {
@@ -595,3 +1237,216 @@ class TestUniqueCodeServiceApp(TestCase):
                 'count': 1,
             },
         ])
+
+    @inlineCallbacks
+    def test_unique_code_counts_cache(self):
+        # Nothing in this test should get stale on a slow machine.
+        self.asapp.counts_cache.max_staleness = 60
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla'], [0, 1])
+        vanilla = [{'flavour': 'vanilla', 'used': False, 'count': 2}]
+        rsps = yield gatherResults([
+            self.client.get_unique_code_counts('req-%s' % (i,))
+            for i in range(3)])
+        assert [rsp['request_id'] for rsp in rsps] == [
+            'req-0', 'req-1', 'req-2']
+        assert all(rsp['unique_code_counts'] == vanilla for rsp in rsps)
+        stats = self.asapp.counts_cache.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] + stats['shared'] == 2
+
+        # Writes from elsewhere aren't seen until the cache is stale.
+        yield populate_pool(self.pool, ['chocolate'], [0])
+        rsp = yield self.client.get_unique_code_counts('req-3')
+        assert rsp['unique_code_counts'] == vanilla
+
+        # Our own writes are seen straight away.
+        yield self.client.put_redeem('req-4', 'vanilla0')
+        rsp = yield self.client.get_unique_code_counts('req-5')
+        assert sorted_dicts(rsp['unique_code_counts']) == sorted_dicts([
+            {'flavour': 'vanilla', 'used': False, 'count': 1},
+            {'flavour': 'vanilla', 'used': True, 'count': 1},
+            {'flavour': 'chocolate', 'used': False, 'count': 1}])
+        content = 'unique_code,flavour\nchocolate1,chocolate'
+        yield self.client.put_import('req-6', content)
+        rsp = yield self.client.get_unique_code_counts('req-7')
+        assert {'flavour': 'chocolate', 'used': False, 'count': 2} in (
+            rsp['unique_code_counts'])
+        assert self.asapp.counts_cache.stats()['misses'] == 3
+
+    @inlineCallbacks
+    def test_redeem_bloom_filter(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla'], [0])
+        # This is what bloom_filter=True does.
+        self.asapp.code_filters = {}
+
+        # The filter is built in the background when the pool is first used.
+        rsp = yield self.client.put_redeem('req-0', 'vanilla0')
+        assert rsp['unique_code'] == 'vanilla0'
+        code_filter = self.asapp.code_filters['testpool']
+        if code_filter.refreshing is not None:
+            yield code_filter.refreshing
+        assert code_filter.is_fresh()
+
+        rsp = yield self.client.put_redeem('req-1', 'chocolate7')
+        assert rsp == {
+            'request_id': 'req-1',
+            'error': 'Cannot redeem unique code: invalid',
+        }
+        assert code_filter.skipped_lookups == 1
+        # We still audit the request.
+        [record] = yield self.pool.query_by_request_id('req-1')
+        assert record['error']
+
+        response = yield Agent(reactor).request(
+            'GET', self.client._make_url('metrics'))
+        lines = (yield readBody(response)).splitlines()
+        assert ('unique_code_service_bloom_filter_skipped_lookups'
+                '{pool="testpool"} 1.0') in lines
+        assert ('unique_code_service_bloom_filter_codes'
+                '{pool="testpool"} 1.0') in lines
+
+    @inlineCallbacks
+    def test_bloom_filter_unknown_pool(self):
+        self.asapp.code_filters = {}
+        params = mk_audit_params('req-0')
+        params.pop('request_id')
+        params['unique_code'] = 'vanilla0'
+        for _ in range(2):
+            yield self.client.put_json(
+                'nopool/redeem/req-0', params, expected_code=404)
+        # We don't build filters for pools we haven't seen exist.
+        assert self.asapp.code_filters == {}
+
+        yield self.pool.create_tables()
+        yield self.client.put_redeem('req-0', 'vanilla0')
+        code_filter = self.asapp.code_filters['testpool']
+        if code_filter.refreshing is not None:
+            yield code_filter.refreshing
+        # If the pool goes away, we drop its filter.
+        self.asapp._code_filter_refresh_failed(
+            Failure(NoUniqueCodePool('testpool')), 'testpool', code_filter)
+        assert self.asapp.code_filters == {}
+
+    @inlineCallbacks
+    def test_redeem_group_commit(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla'], [0, 1])
+        # This is what group_commit=True does.
+        self.asapp.group_committers = {}
+        # Redeems only share transactions once we've seen the pool exist.
+        yield self.client.put_redeem('req-x', 'banana')
+        assert self.asapp.group_committers == {}
+
+        rsps = yield gatherResults([
+            self.client.put_redeem('req-0', 'vanilla0'),
+            self.client.put_redeem('req-1', 'vanilla1'),
+            self.client.put_redeem('req-2', 'vanilla0'),
+        ])
+        assert rsps == [
+            {'request_id': 'req-0', 'unique_code': 'vanilla0',
+             'flavour': 'vanilla'},
+            {'request_id': 'req-1', 'unique_code': 'vanilla1',
+             'flavour': 'vanilla'},
+            {'request_id': 'req-2',
+             'error': 'Cannot redeem unique code: used'},
+        ]
+        # Repeated requests get the same response.
+        rsp = yield self.client.put_redeem('req-0', 'vanilla0')
+        assert rsp == rsps[0]
+        [record] = yield self.pool.query_by_request_id('req-1')
+        assert not record['error']
+        stats = self.asapp.group_committers['testpool'].stats()
+        assert stats['redeems'] == 4
+        assert stats['batches'] < 4
+
+    @inlineCallbacks
+    def test_redeem_group_commit_missing_pool(self):
+        self.asapp.group_committers = {}
+        for _ in range(2):
+            rsp = yield self.client.put_redeem('req-0', 'vanilla0', 404)
+            assert rsp == {
+                'request_id': 'req-0',
+                'error': 'Unique code pool does not exist.',
+            }
+        # We don't make committers for pools we haven't seen exist.
+        assert self.asapp.group_committers == {}
+
+    @inlineCallbacks
+    def test_read_replica(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla'], [0, 1])
+        # This is what read_conn_str does, but our in-memory test database
+        # has to be its own replica.
+        read_conn_pool = ConnectionPool(self.asapp.engine, reactor)
+        self.addCleanup(read_conn_pool.close)
+        replica = self.asapp.read_replica = ReadReplica(
+            read_conn_pool, reactor)
+        yield replica.check()
+        acquired = self.asapp.conn_pool.stats()['acquired']
+
+        rsp = yield self.client.get_unique_code_counts('req-0')
+        assert rsp['unique_code_counts'] == [
+            {'flavour': 'vanilla', 'used': False, 'count': 2}]
+        yield self.client.put_redeem('req-1', 'vanilla0')
+        rsp = yield self.client.get_audit_query(
+            'req-2', 'request_id', 'req-1')
+        assert [r['request_id'] for r in rsp['results']] == ['req-1']
+        # The reporting queries went to the replica, the redeem didn't.
+        assert replica.stats()['reads'] == 2
+        assert read_conn_pool.stats()['acquired'] == 3
+        assert self.asapp.conn_pool.stats()['acquired'] == acquired + 1
+
+        # A replica that's too far behind isn't used.
+        replica.lag = replica.max_lag + 1
+        rsp = yield self.client.get_unique_code_counts('req-3')
+        assert sorted_dicts(rsp['unique_code_counts']) == sorted_dicts([
+            {'flavour': 'vanilla', 'used': False, 'count': 1},
+            {'flavour': 'vanilla', 'used': True, 'count': 1}])
+        assert replica.stats()['fallbacks'] == 1
+        assert self.asapp.conn_pool.stats()['acquired'] == acquired + 2
+
+    @inlineCallbacks
+    def test_metrics(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['vanilla'], [0, 1])
+        yield self.client.put_redeem('req-0', 'vanilla0')
+        yield self.client.put_redeem('req-1', 'vanilla1')
+
+        response = yield Agent(reactor).request(
+            'GET', self.client._make_url('metrics'))
+        assert response.code == 200
+        assert response.headers.getRawHeaders('Content-Type') == [
+            'text/plain; version=0.0.4']
+        body = yield readBody(response)
+        lines = body.splitlines()
+
+        labels = 'endpoint="redeem",pool="testpool"'
+        for stage in ['parse', 'acquire', 'begin', 'claim', 'count', 'audit',
+                      'commit', 'release']:
+            assert ('unique_code_service_stage_seconds_count{%s,stage="%s"} 2'
+                    % (labels, stage)) in lines
+        assert ('unique_code_service_stage_seconds_count{%s,stage="rollback"}'
+                ' 0' % (labels,)) not in lines
+        assert ('unique_code_service_request_seconds_count{%s} 2'
+                % (labels,)) in lines
+        assert 'unique_code_service_db_pool_in_use 0.0' in lines
+        assert '# TYPE unique_code_service_db_pool_size gauge' in lines
+        assert '# TYPE unique_code_service_db_pool_acquired counter' in lines
+        assert '# TYPE unique_code_service_counts_cache_hits counter' in lines
+
+    @inlineCallbacks
+    def test_metrics_unknown_pool(self):
+        # Requests for pools that don't exist don't get labels of their own.
+        for i in range(3):
+            params = mk_audit_params('req-0')
+            params.pop('request_id')
+            params['unique_code'] = 'vanilla0'
+            yield self.client.put_json(
+                'nopool%s/redeem/req-0' % (i,), params, expected_code=404)
+        metrics = self.asapp.metrics
+        for i in range(3):
+            assert metrics.request_histogram(
+                'redeem', 'nopool%s' % (i,)) is None
+        assert metrics.request_histogram('redeem', 'unknown').count == 3
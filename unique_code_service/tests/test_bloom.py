@@ -0,0 +1,146 @@
+import os
+
+from aludel.database import get_engine, MetaData
+from aludel.tests.doubles import FakeReactorThreads
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from unique_code_service.bloom import BloomFilter, UniqueCodeFilter
+from unique_code_service.models import UniqueCodePool
+
+from .helpers import populate_pool
+
+
+class TestBloomFilter(TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        codes = ['code%s' % (i,) for i in range(1000)]
+        for code in codes:
+            bloom.add(code)
+        assert all(code in bloom for code in codes)
+        # Unicode codes hash the same as their UTF-8 bytes.
+        assert u'code1' in bloom
+
+    def test_error_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('code%s' % (i,))
+        false_positives = sum(
+            1 for i in range(10000) if 'missing%s' % (i,) in bloom)
+        # We expect about 100, but this is a random process.
+        assert false_positives < 200
+        assert 0.005 < bloom.expected_error_rate(1000) < 0.015
+
+    def test_sizing(self):
+        bloom = BloomFilter(1000, 0.01)
+        # About 9.6 bits and 7 hashes per item for 1%.
+        assert bloom.size_bytes == 1199
+        assert bloom.num_hashes == 7
+        small = BloomFilter(1000, 0.01, max_bytes=100)
+        assert small.size_bytes == 100
+        assert small.num_hashes == 1
+        assert small.expected_error_rate(1000) > 0.5
+
+
+class TestUniqueCodeFilter(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self._drop_tables()
+        self.conn = self.successResultOf(self.engine.connect())
+        self.pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(self.pool.create_tables())
+        self.clock = Clock()
+        self.code_filter = UniqueCodeFilter(self.clock, max_staleness=10)
+        self.patch(self.code_filter, 'REFRESH_BATCH_SIZE', 3)
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        self._drop_tables()
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def refresh(self):
+        return self.successResultOf(
+            self.code_filter.refresh(lambda func: func(self.pool)))
+
+    def test_refresh(self):
+        populate_pool(self.pool, ['vanilla'], range(5))
+        assert self.code_filter.needs_refresh()
+        assert not self.code_filter.definitely_missing('nothing')
+        self.refresh()
+        assert self.code_filter.rows == 5
+        assert self.code_filter.is_fresh()
+        assert self.code_filter.definitely_missing('nothing')
+        assert not self.code_filter.definitely_missing('vanilla4')
+        assert self.code_filter.stats()['skipped_lookups'] == 1
+
+        # Refreshes pick up new codes halfway through the staleness window.
+        bloom = self.code_filter.bloom
+        populate_pool(self.pool, ['chocolate'], range(2))
+        self.clock.advance(5)
+        assert not self.code_filter.needs_refresh()
+        self.clock.advance(1)
+        assert self.code_filter.needs_refresh()
+        self.refresh()
+        assert self.code_filter.bloom is bloom
+        assert self.code_filter.rows == 7
+        assert not self.code_filter.definitely_missing('chocolate1')
+
+        # We don't trust a filter that hasn't been refreshed for too long.
+        self.clock.advance(11)
+        assert not self.code_filter.is_fresh()
+        assert not self.code_filter.definitely_missing('nothing')
+
+    def test_add(self):
+        self.refresh()
+        self.code_filter.add(['vanilla0'])
+        assert not self.code_filter.definitely_missing('vanilla0')
+        assert self.code_filter.definitely_missing('vanilla1')
+
+    def test_rebuild_when_full(self):
+        self.patch(self.code_filter, 'MIN_CAPACITY', 4)
+        populate_pool(self.pool, ['vanilla'], range(2))
+        self.refresh()
+        bloom = self.code_filter.bloom
+        assert bloom.capacity == 4
+        populate_pool(self.pool, ['vanilla'], range(2, 6))
+        self.refresh()
+        assert self.code_filter.bloom is not bloom
+        assert self.code_filter.bloom.capacity == 12
+        assert self.code_filter.rows == 6
+        assert self.code_filter.is_fresh()
+
+    def test_counts_mismatch(self):
+        populate_pool(self.pool, ['vanilla'], range(2))
+        self.refresh()
+        # Pretend that a code was committed after one with a bigger id.
+        self.code_filter.rows -= 1
+        populate_pool(self.pool, ['vanilla'], [2])
+        self.refresh()
+        assert not self.code_filter.is_fresh()
+        # The next refresh starts from scratch.
+        assert self.code_filter.needs_refresh()
+        self.refresh()
+        assert self.code_filter.rows == 3
+        assert self.code_filter.is_fresh()
+
+    def test_counts_wrong(self):
+        populate_pool(self.pool, ['vanilla'], range(2))
+        counts = self.pool.unique_code_counts
+        self.successResultOf(self.pool.execute_query(
+            counts.update().values(count=5)))
+        self.refresh()
+        assert not self.code_filter.is_fresh()
+        # Rebuilding won't help until the counts are fixed, so we back off.
+        assert not self.code_filter.needs_refresh()
+        self.clock.advance(UniqueCodeFilter.REBUILD_BACKOFF)
+        assert self.code_filter.needs_refresh()
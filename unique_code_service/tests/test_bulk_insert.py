@@ -0,0 +1,149 @@
+from datetime import datetime
+import os
+
+from aludel.database import get_engine, MetaData
+from aludel.tests.doubles import FakeReactorThreads
+from sqlalchemy.dialects import sqlite, postgresql, mysql, mssql
+from sqlalchemy.dialects.mysql import mysqlconnector
+from sqlalchemy.exc import IntegrityError
+from twisted.trial.unittest import TestCase, SkipTest
+
+from unique_code_service.bulk_insert import (
+    BulkInserter, MultiValuesInserter, SQLiteInserter, MySQLInserter,
+    PostgresCopyInserter, get_bulk_inserter, copy_text_row,
+)
+from unique_code_service.models import UniqueCodePool
+
+
+class TestBulkInserters(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self._drop_tables()
+        self.conn = self.successResultOf(self.engine.connect())
+        self.pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(self.pool.create_tables())
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        self._drop_tables()
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def mk_rows(self, count):
+        now = datetime.utcnow()
+        return [{
+            'flavour': 'vanilla',
+            'unique_code': 'vanilla%s' % (i,),
+            'used': False,
+            'reason': None,
+            'created_at': now,
+            'modified_at': now,
+        } for i in range(count)]
+
+    def assert_inserted(self, count):
+        # Inserters don't maintain the counts, so we count the rows.
+        rows = self.successResultOf(self.pool.execute_fetchall(
+            self.pool._exact_counts_query()))
+        assert [tuple(r) for r in rows] == [('vanilla', False, count)]
+
+    def skip_unless_dialect(self, name):
+        if self.engine._engine.dialect.name != name:
+            raise SkipTest('This needs a %s database.' % (name,))
+
+    def test_bulk_inserter(self):
+        inserter = BulkInserter()
+        assert inserter.batch_size == BulkInserter.DEFAULT_BATCH_SIZE
+        assert self.successResultOf(inserter.insert(
+            self.pool, self.pool.unique_codes, self.mk_rows(10))) == 10
+        self.assert_inserted(10)
+
+    def test_bulk_inserter_conflict(self):
+        inserter = BulkInserter()
+        self.successResultOf(inserter.insert(
+            self.pool, self.pool.unique_codes, self.mk_rows(5)))
+        # We don't know how to skip conflicts, so the insert fails.
+        self.failureResultOf(inserter.insert(
+            self.pool, self.pool.unique_codes, self.mk_rows(10),
+            unique_column='unique_code'), IntegrityError)
+
+    def test_multi_values_inserter(self):
+        inserter = MultiValuesInserter(batch_size=10)
+        assert self.successResultOf(inserter.insert(
+            self.pool, self.pool.unique_codes, self.mk_rows(10))) == 10
+        self.assert_inserted(10)
+
+    def test_multi_values_inserter_max_params(self):
+        inserter = MultiValuesInserter(max_params=13)
+        statements = []
+        execute_query = self.pool.execute_query
+
+        def logging_execute_query(query, *args, **kw):
+            statements.append(query)
+            return execute_query(query, *args, **kw)
+        self.patch(self.pool, 'execute_query', logging_execute_query)
+
+        # Six columns and at most thirteen params means two rows per insert.
+        assert self.successResultOf(inserter.insert(
+            self.pool, self.pool.unique_codes, self.mk_rows(5))) == 5
+        assert len(statements) == 3
+        self.assert_inserted(5)
+
+    def assert_skips_conflicts(self, inserter):
+        assert self.successResultOf(inserter.insert(
+            self.pool, self.pool.unique_codes, self.mk_rows(5),
+            unique_column='unique_code')) == 5
+        # Only the rows that aren't already there are inserted.
+        assert self.successResultOf(inserter.insert(
+            self.pool, self.pool.unique_codes, self.mk_rows(8),
+            unique_column='unique_code')) == 3
+        self.assert_inserted(8)
+
+    def test_sqlite_inserter_skips_conflicts(self):
+        self.skip_unless_dialect('sqlite')
+        self.assert_skips_conflicts(SQLiteInserter())
+
+    def test_mysql_inserter_skips_conflicts(self):
+        self.skip_unless_dialect('mysql')
+        self.assert_skips_conflicts(MySQLInserter())
+
+    def test_postgres_copy_inserter_skips_conflicts(self):
+        self.skip_unless_dialect('postgresql')
+        self.assert_skips_conflicts(PostgresCopyInserter())
+
+    def test_get_bulk_inserter(self):
+        assert type(get_bulk_inserter(sqlite.dialect())) is SQLiteInserter
+        assert type(get_bulk_inserter(mysql.dialect())) is MySQLInserter
+        assert type(get_bulk_inserter(
+            postgresql.dialect())) is PostgresCopyInserter
+        assert type(get_bulk_inserter(
+            postgresql.dialect(), 5)) is PostgresCopyInserter
+        assert type(get_bulk_inserter(mssql.dialect())) is BulkInserter
+        # We don't know about this driver, but the dialect is good enough.
+        assert type(get_bulk_inserter(
+            mysqlconnector.dialect())) is MultiValuesInserter
+
+    def test_get_bulk_inserter_batch_size(self):
+        inserter = get_bulk_inserter(sqlite.dialect())
+        assert inserter.batch_size == SQLiteInserter.DEFAULT_BATCH_SIZE
+        inserter = get_bulk_inserter(sqlite.dialect(), 5)
+        assert inserter.batch_size == 5
+
+    def test_copy_text_row(self):
+        assert copy_text_row(
+            ['foo', u'b\xe1r', None, True, False, 7]
+        ) == 'foo\tb\xc3\xa1r\t\\N\tt\tf\t7\n'
+        assert copy_text_row(
+            ['tab\there', 'new\nline', 'cr\rhere', 'back\\slash']
+        ) == 'tab\\there\tnew\\nline\tcr\\rhere\tback\\\\slash\n'
+        assert copy_text_row(
+            [datetime(2014, 1, 2, 3, 4, 5, 6)]
+        ) == '2014-01-02 03:04:05.000006\n'
@@ -0,0 +1,91 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from unique_code_service.cache import ResponseCache
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResponseCache(self.clock, max_staleness=1.0)
+        self.fetches = []
+
+    def fetch(self):
+        d = Deferred()
+        self.fetches.append(d)
+        return d
+
+    def test_cached(self):
+        d = self.cache.get('testpool', self.fetch)
+        self.fetches[0].callback(['counts'])
+        assert self.successResultOf(d) == ['counts']
+        self.clock.advance(1.0)
+        assert self.successResultOf(
+            self.cache.get('testpool', self.fetch)) == ['counts']
+        assert len(self.fetches) == 1
+        # Other keys are cached separately.
+        self.assertNoResult(self.cache.get('otherpool', self.fetch))
+        assert len(self.fetches) == 2
+        assert self.cache.stats() == {'hits': 1, 'misses': 2, 'shared': 0}
+
+    def test_max_staleness(self):
+        self.cache.get('testpool', self.fetch)
+        self.clock.advance(0.5)
+        # Values are as old as the fetch that started before they arrived.
+        self.fetches[0].callback(['counts'])
+        self.clock.advance(0.6)
+        d = self.cache.get('testpool', self.fetch)
+        self.assertNoResult(d)
+        self.fetches[1].callback(['new counts'])
+        assert self.successResultOf(d) == ['new counts']
+
+    def test_shared_fetch(self):
+        ds = [self.cache.get('testpool', self.fetch) for _ in range(3)]
+        assert len(self.fetches) == 1
+        for d in ds:
+            self.assertNoResult(d)
+        self.fetches[0].callback(['counts'])
+        assert [self.successResultOf(d) for d in ds] == [['counts']] * 3
+        assert self.cache.stats() == {'hits': 0, 'misses': 1, 'shared': 2}
+
+    def test_failure_not_cached(self):
+        ds = [self.cache.get('testpool', self.fetch) for _ in range(2)]
+        self.fetches[0].errback(Exception("Database is down."))
+        for d in ds:
+            self.failureResultOf(d, Exception)
+        d = self.cache.get('testpool', self.fetch)
+        assert len(self.fetches) == 2
+        self.fetches[1].callback(['counts'])
+        assert self.successResultOf(d) == ['counts']
+
+    def test_invalidate(self):
+        self.cache.get('testpool', self.fetch)
+        self.fetches[0].callback(['counts'])
+        self.cache.invalidate('testpool')
+        d = self.cache.get('testpool', self.fetch)
+        assert len(self.fetches) == 2
+        self.fetches[1].callback(['new counts'])
+        assert self.successResultOf(d) == ['new counts']
+
+    def test_invalidate_while_fetching(self):
+        d0 = self.cache.get('testpool', self.fetch)
+        # This fetch may have missed the write that invalidated it.
+        self.cache.invalidate('testpool')
+        d1 = self.cache.get('testpool', self.fetch)
+        assert len(self.fetches) == 2
+        self.fetches[0].callback(['old counts'])
+        assert self.successResultOf(d0) == ['old counts']
+        self.assertNoResult(d1)
+        self.fetches[1].callback(['new counts'])
+        assert self.successResultOf(d1) == ['new counts']
+        assert self.successResultOf(
+            self.cache.get('testpool', self.fetch)) == ['new counts']
+
+    def test_no_caching(self):
+        self.cache = ResponseCache(self.clock, max_staleness=0)
+        ds = [self.cache.get('testpool', self.fetch) for _ in range(2)]
+        self.fetches[0].callback(['counts'])
+        assert [self.successResultOf(d) for d in ds] == [['counts']] * 2
+        self.assertNoResult(self.cache.get('testpool', self.fetch))
+        assert len(self.fetches) == 2
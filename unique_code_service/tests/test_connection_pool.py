@@ -0,0 +1,141 @@
+import os
+
+from aludel.database import get_engine
+from aludel.tests.doubles import FakeReactorThreads
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from unique_code_service.connection_pool import (
+    ConnectionPool, ConnectionPoolTimeout, ConnectionPoolClosed,
+)
+
+
+class TestConnectionPool(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self.clock = Clock()
+
+    def mk_pool(self, **kw):
+        pool = ConnectionPool(self.engine, self.clock, **kw)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_bad_sizes(self):
+        self.assertRaises(
+            ValueError, ConnectionPool, self.engine, self.clock, max_size=0)
+        self.assertRaises(
+            ValueError, ConnectionPool, self.engine, self.clock,
+            min_size=3, max_size=2)
+
+    def test_acquire_release_reuses_connection(self):
+        pool = self.mk_pool()
+        conn = self.successResultOf(pool.acquire())
+        assert pool.stats()['in_use'] == 1
+        self.successResultOf(pool.release(conn))
+        assert pool.stats()['in_use'] == 0
+        assert pool.stats()['idle'] == 1
+
+        conn2 = self.successResultOf(pool.acquire())
+        assert conn2 is conn
+        assert pool.stats()['size'] == 1
+        assert pool.stats()['acquired'] == 2
+        self.successResultOf(pool.release(conn2))
+
+    def test_acquire_waits_when_full(self):
+        pool = self.mk_pool(max_size=1)
+        conn = self.successResultOf(pool.acquire())
+        d = pool.acquire()
+        self.assertNoResult(d)
+        assert pool.stats()['waiting'] == 1
+
+        self.clock.advance(2)
+        self.successResultOf(pool.release(conn))
+        assert self.successResultOf(d) is conn
+        stats = pool.stats()
+        assert stats['waiting'] == 0
+        assert stats['in_use'] == 1
+        assert stats['wait_time_max'] == 2
+        assert stats['wait_time_total'] == 2
+        self.successResultOf(pool.release(conn))
+
+    def test_acquire_timeout(self):
+        pool = self.mk_pool(max_size=1, acquire_timeout=5)
+        conn = self.successResultOf(pool.acquire())
+        d = pool.acquire()
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, ConnectionPoolTimeout)
+        assert pool.stats()['timeouts'] == 1
+        assert pool.stats()['waiting'] == 0
+
+        # The connection goes back into the pool rather than to the waiter
+        # that gave up.
+        self.successResultOf(pool.release(conn))
+        assert pool.stats()['idle'] == 1
+
+    def test_release_in_transaction_discards(self):
+        pool = self.mk_pool()
+        conn = self.successResultOf(pool.acquire())
+        self.successResultOf(conn.begin())
+        self.successResultOf(pool.release(conn))
+        assert conn.closed
+        assert pool.stats()['size'] == 0
+
+    def test_release_closed_connection_discards(self):
+        pool = self.mk_pool(max_size=1)
+        conn = self.successResultOf(pool.acquire())
+        d = pool.acquire()
+        self.successResultOf(conn.close())
+        self.successResultOf(pool.release(conn))
+        # The waiter gets a fresh connection.
+        conn2 = self.successResultOf(d)
+        assert conn2 is not conn
+        assert not conn2.closed
+        self.successResultOf(pool.release(conn2))
+
+    def test_idle_connections_reaped(self):
+        pool = self.mk_pool(min_size=1, max_size=3, idle_timeout=10)
+        conns = [self.successResultOf(pool.acquire()) for _ in range(3)]
+        for conn in conns:
+            self.successResultOf(pool.release(conn))
+        assert pool.stats()['idle'] == 3
+
+        self.clock.advance(11)
+        conn = self.successResultOf(pool.acquire())
+        # Only one idle connection survives, and it has been checked.
+        assert conn is conns[-1]
+        assert [c.closed for c in conns] == [True, True, False]
+        assert pool.stats()['size'] == 1
+        self.successResultOf(pool.release(conn))
+
+    def test_stale_connection_replaced(self):
+        pool = self.mk_pool(min_size=1, idle_timeout=10)
+        conn = self.successResultOf(pool.acquire())
+        self.successResultOf(pool.release(conn))
+        self.clock.advance(11)
+
+        def broken_execute(*args, **kw):
+            raise Exception("Connection went away.")
+        self.patch(conn, 'execute', broken_execute)
+
+        conn2 = self.successResultOf(pool.acquire())
+        assert conn2 is not conn
+        assert conn.closed
+        assert pool.stats()['size'] == 1
+        self.successResultOf(pool.release(conn2))
+
+    def test_close(self):
+        pool = self.mk_pool(max_size=1)
+        conn = self.successResultOf(pool.acquire())
+        d = pool.acquire()
+        self.successResultOf(pool.close())
+        self.failureResultOf(d, ConnectionPoolClosed)
+        self.failureResultOf(pool.acquire(), ConnectionPoolClosed)
+        self.successResultOf(pool.release(conn))
+        assert conn.closed
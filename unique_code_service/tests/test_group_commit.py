@@ -0,0 +1,155 @@
+import os
+
+from aludel.database import get_engine, MetaData
+from aludel.tests.doubles import FakeReactorThreads
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from unique_code_service.group_commit import RedeemGroupCommitter
+from unique_code_service.models import (
+    UniqueCodePool, CannotRedeemUniqueCode, AuditMismatch)
+
+from .helpers import populate_pool, mk_audit_params
+
+
+class TestRedeemGroupCommitter(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self._drop_tables()
+        self.conn = self.successResultOf(self.engine.connect())
+        self.pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(self.pool.create_tables())
+        self.successResultOf(populate_pool(self.pool, ['vanilla'], range(5)))
+        self.clock = Clock()
+        self.batches = []
+        self.committer = self.mk_committer()
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        self._drop_tables()
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def mk_committer(self, max_batch_size=10):
+        return RedeemGroupCommitter(
+            self.clock, self.run_batch, interval=0.01,
+            max_batch_size=max_batch_size)
+
+    def run_batch(self, func):
+        self.batches.append(func)
+        return func(self.pool)
+
+    def redeem(self, request_id, candidate_code):
+        return self.committer.redeem(
+            candidate_code, mk_audit_params(request_id))
+
+    def audited_request_ids(self):
+        rows = self.successResultOf(self.pool.execute_fetchall(
+            self.pool.audit.select()))
+        return sorted(row['request_id'] for row in rows)
+
+    def used_codes(self):
+        rows = self.successResultOf(self.pool.execute_fetchall(
+            self.pool.unique_codes.select().where(
+                self.pool.unique_codes.c.used)))
+        return sorted(row['unique_code'] for row in rows)
+
+    def test_batch(self):
+        ds = [self.redeem('req-%s' % (i,), 'VANILLA%s' % (i,))
+              for i in range(3)]
+        ds.append(self.redeem('req-3', 'chocolate'))
+        for d in ds:
+            self.assertNoResult(d)
+        assert self.committer.stats()['waiting'] == 4
+
+        self.clock.advance(0.01)
+        assert len(self.batches) == 1
+        for i, d in enumerate(ds[:3]):
+            unique_code = self.successResultOf(d)
+            assert unique_code['unique_code'] == 'vanilla%s' % (i,)
+            assert unique_code['used']
+        self.failureResultOf(ds[3], CannotRedeemUniqueCode)
+        assert self.committer.stats() == {
+            'batches': 1, 'redeems': 4, 'waiting': 0}
+        assert self.audited_request_ids() == [
+            'req-0', 'req-1', 'req-2', 'req-3']
+        assert self.used_codes() == ['vanilla0', 'vanilla1', 'vanilla2']
+
+    def test_max_batch_size(self):
+        self.committer = self.mk_committer(max_batch_size=2)
+        d0 = self.redeem('req-0', 'vanilla0')
+        self.assertNoResult(d0)
+        d1 = self.redeem('req-1', 'vanilla1')
+        # A full batch doesn't wait.
+        self.successResultOf(d0)
+        self.successResultOf(d1)
+        assert len(self.batches) == 1
+        self.clock.advance(0.01)
+        assert len(self.batches) == 1
+
+    def test_repeated_request_id(self):
+        d0 = self.redeem('req-0', 'vanilla0')
+        d1 = self.redeem('req-0', 'vanilla0')
+        self.clock.advance(0.01)
+        unique_code = self.successResultOf(d0)
+        self.assertNoResult(d1)
+        # The repeat is replayed in the next batch.
+        self.clock.advance(0.01)
+        assert self.successResultOf(d1) == unique_code
+        assert len(self.batches) == 2
+        assert self.audited_request_ids() == ['req-0']
+
+    def test_audit_mismatch(self):
+        self.successResultOf(self.pool.redeem_unique_code(
+            'vanilla0', mk_audit_params('req-0')))
+        d0 = self.redeem('req-0', 'vanilla1')
+        d1 = self.redeem('req-1', 'vanilla2')
+        self.clock.advance(0.01)
+        # The mismatch doesn't stop the other redeem.
+        self.failureResultOf(d0, AuditMismatch)
+        assert self.successResultOf(d1)['unique_code'] == 'vanilla2'
+        assert self.used_codes() == ['vanilla0', 'vanilla2']
+
+    def test_crash_safety(self):
+        """No redeem is acknowledged before its audit row is committed.
+        """
+        acked = self.redeem('req-0', 'vanilla0')
+        self.clock.advance(0.01)
+        self.successResultOf(acked)
+
+        # The database goes away in the middle of a batch.
+        def crash(rows):
+            raise Exception("Connection lost.")
+        self.patch(self.pool, '_insert_audit', crash)
+        crashed = [self.redeem('req-1', 'vanilla1'),
+                   self.redeem('req-2', 'vanilla2')]
+        self.clock.advance(0.01)
+        for d in crashed:
+            self.failureResultOf(d)
+        # Then we die with redeems waiting.
+        lost = self.redeem('req-3', 'vanilla3')
+        self.assertNoResult(lost)
+
+        # Everything acknowledged is audited, and nothing else is claimed.
+        assert self.audited_request_ids() == ['req-0']
+        assert self.used_codes() == ['vanilla0']
+
+        # The redeems we never acknowledged can be retried.
+        self.pool = UniqueCodePool('testpool', self.conn)
+        self.committer = self.mk_committer()
+        retried = [self.redeem('req-%s' % (i,), 'vanilla%s' % (i,))
+                   for i in [0, 1, 2, 3]]
+        self.clock.advance(0.01)
+        assert [self.successResultOf(d)['unique_code'] for d in retried] == [
+            'vanilla0', 'vanilla1', 'vanilla2', 'vanilla3']
+        assert self.audited_request_ids() == [
+            'req-0', 'req-1', 'req-2', 'req-3']
@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta
+import errno
+import gzip
+import json
+import os
+from StringIO import StringIO
+
+from aludel.database import get_engine, MetaData
+from aludel.tests.doubles import FakeReactorThreads
+from sqlalchemy import inspect
+from twisted.python.usage import UsageError
+from twisted.trial.unittest import TestCase
+
+from unique_code_service import manage
+from unique_code_service.models import (
+    UniqueCodePool, NoUniqueCodePool, audit_bucket)
+
+from .helpers import populate_pool, mk_audit_params, mk_temp_dir
+
+
+class TestManage(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self._drop_tables()
+        self.conn = self.successResultOf(self.engine.connect())
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        self._drop_tables()
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def parse(self, *argv):
+        options = manage.Options()
+        options.parseOptions(argv)
+        return options
+
+    def test_options(self):
+        options = self.parse('-d', 'sqlite://', 'reconcile-counts', 'a', 'b')
+        assert options['database-connection-string'] == 'sqlite://'
+        assert options.subCommand == 'reconcile-counts'
+        assert options.subOptions['pools'] == ['a', 'b']
+
+    def test_archive_audit_options(self):
+        options = self.parse('-d', 'sqlite://', 'archive-audit', 'a')
+        assert options.subOptions['rotate-after'] == 30
+        assert options.subOptions['retain-for'] is None
+        self.assertRaises(
+            UsageError, self.parse, '-d', 'sqlite://', 'archive-audit',
+            '--retain-for', '365')
+
+    def test_options_missing(self):
+        self.assertRaises(UsageError, self.parse, 'reconcile-counts')
+        self.assertRaises(UsageError, self.parse, '-d', 'sqlite://')
+
+    def test_reconcile_counts(self):
+        for name in ['pool1', 'pool2']:
+            pool = UniqueCodePool(name, self.conn)
+            self.successResultOf(pool.create_tables())
+            populate_pool(pool, ['vanilla'], [0, 1])
+        counts = pool.unique_code_counts
+        self.successResultOf(pool.execute_query(
+            counts.update().values(count=5)))
+
+        out = StringIO()
+        options = self.parse('-d', 'sqlite://', 'reconcile-counts')
+        self.successResultOf(
+            manage.reconcile_counts(self.conn, options.subOptions, out))
+        assert out.getvalue() == (
+            'pool1: counts are correct\n'
+            'pool2: flavour=vanilla used=False count 5 -> 2\n'
+            'pool2: flavour=vanilla used=True count 5 -> 0\n')
+        rows = self.successResultOf(pool.count_unique_codes())
+        assert [tuple(r) for r in rows] == [('vanilla', False, 2)]
+
+    def test_reconcile_counts_missing_pool(self):
+        self.successResultOf(
+            UniqueCodePool('pool1', self.conn).create_tables())
+        options = self.parse('-d', 'sqlite://', 'reconcile-counts', 'pool2')
+        f = self.failureResultOf(
+            manage.reconcile_counts(self.conn, options.subOptions, StringIO()),
+            NoUniqueCodePool)
+        assert f.value.args == ('pool2',)
+
+    def test_upgrade(self):
+        pool = UniqueCodePool('pool1', self.conn)
+        self.successResultOf(pool.create_tables())
+        # NOTE: These are blocking operations!
+        pool.unique_code_counts.drop(self.engine._engine)
+        for index in pool.audit.indexes:
+            index.drop(self.engine._engine)
+
+        out = StringIO()
+        options = self.parse('-d', 'sqlite://', 'upgrade')
+        self.successResultOf(
+            manage.upgrade(self.conn, options.subOptions, out))
+        assert out.getvalue() == 'pool1: upgraded\n'
+        # NOTE: This is a blocking operation!
+        inspector = inspect(self.engine._engine)
+        assert pool.unique_code_counts.name in inspector.get_table_names()
+        assert sorted(i['name'] for i in inspector.get_indexes(
+            pool.audit.name)) == sorted(i.name for i in pool.audit.indexes)
+
+    def test_upgrade_duplicate_unique_codes(self):
+        pools = [UniqueCodePool('pool1', self.conn),
+                 UniqueCodePool('pool2', self.conn)]
+        for pool in pools:
+            self.successResultOf(pool.create_tables())
+            # NOTE: These are blocking operations!
+            for index in pool.unique_codes.indexes:
+                if index.unique:
+                    index.drop(self.engine._engine)
+        self.successResultOf(pools[1].execute_query(
+            pools[1].unique_codes.insert(), [
+                {'flavour': 'vanilla', 'unique_code': 'vanilla0'},
+                {'flavour': 'vanilla', 'unique_code': 'vanilla0'},
+            ]))
+
+        out = StringIO()
+        options = self.parse('-d', 'sqlite://', 'upgrade')
+        self.successResultOf(
+            manage.upgrade(self.conn, options.subOptions, out))
+        assert out.getvalue() == (
+            'pool1: upgraded\n'
+            'pool2: has duplicate unique codes, not upgraded\n')
+        # NOTE: This is a blocking operation!
+        inspector = inspect(self.engine._engine)
+        unique_indexes = [
+            [i['name'] for i in inspector.get_indexes(pool.unique_codes.name)
+             if i['unique']]
+            for pool in pools]
+        assert unique_indexes == [
+            ['ux_%s_unique_code' % (pools[0].unique_codes.name,)], []]
+
+    def test_archive_audit(self):
+        pool = UniqueCodePool('pool1', self.conn)
+        self.successResultOf(pool.create_tables())
+        for i, created_at in enumerate([
+                datetime(2015, 1, 10), datetime(2015, 1, 20),
+                datetime.utcnow() - timedelta(days=40), datetime.utcnow()]):
+            audit_row = pool._audit_row(mk_audit_params('req-%s' % (i,)), {
+                'candidate_code': 'vanilla%s' % (i,)}, {}, 'vanilla%s' % (i,))
+            audit_row['created_at'] = created_at
+            self.successResultOf(
+                pool.execute_query(pool.audit.insert().values(**audit_row)))
+        recent_bucket = audit_bucket(datetime.utcnow() - timedelta(days=40))
+
+        archive_dir = mk_temp_dir(self)
+        out = StringIO()
+        options = self.parse(
+            '-d', 'sqlite://', 'archive-audit', '--retain-for', '365',
+            '--archive-dir', archive_dir)
+        self.successResultOf(
+            manage.archive_audit(self.conn, options.subOptions, out))
+        path = os.path.join(archive_dir, 'pool1-audit-201501.jsonl.gz')
+        assert out.getvalue() == (
+            'pool1: moved 3 audit records into buckets\n'
+            'pool1: archived 2 audit records from 201501 to %s\n' % (path,))
+        assert os.listdir(archive_dir) == ['pool1-audit-201501.jsonl.gz']
+        archive = gzip.open(path)
+        rows = [json.loads(line) for line in archive]
+        archive.close()
+        assert [row['request_id'] for row in rows] == ['req-0', 'req-1']
+        assert rows[0]['created_at'] == '2015-01-10T00:00:00'
+        assert json.loads(rows[0]['request_data']) == {
+            'candidate_code': 'vanilla0'}
+
+        assert self.successResultOf(pool.get_audit_buckets()) == [
+            recent_bucket]
+        records = self.successResultOf(
+            pool.query_audit('transaction_id', 'tx-req-2'))[0]
+        assert [r['request_id'] for r in records] == ['req-2']
+
+    def test_archive_audit_not_stored(self):
+        pool = UniqueCodePool('pool1', self.conn)
+        self.successResultOf(pool.create_tables())
+        audit_row = pool._audit_row(mk_audit_params('req-0'), {
+            'candidate_code': 'vanilla0'}, {}, 'vanilla0')
+        audit_row['created_at'] = datetime(2015, 1, 10)
+        self.successResultOf(
+            pool.execute_query(pool.audit.insert().values(**audit_row)))
+
+        def full_disk(fd):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        self.patch(os, 'fsync', full_disk)
+        archive_dir = mk_temp_dir(self)
+        options = self.parse(
+            '-d', 'sqlite://', 'archive-audit', '--retain-for', '365',
+            '--archive-dir', archive_dir)
+        self.failureResultOf(
+            manage.archive_audit(self.conn, options.subOptions, StringIO()),
+            OSError)
+        # The file isn't complete, so the bucket is still there.
+        assert os.listdir(archive_dir) == ['pool1-audit-201501.jsonl.gz.tmp']
+        assert self.successResultOf(pool.get_audit_buckets()) == ['201501']
+        records = self.successResultOf(
+            pool.query_audit('transaction_id', 'tx-req-0'))[0]
+        assert [r['request_id'] for r in records] == ['req-0']
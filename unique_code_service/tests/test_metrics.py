@@ -0,0 +1,155 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.trial.unittest import TestCase
+
+from unique_code_service.metrics import (
+    Histogram, Metrics, NULL_TIMER, STAGE_METRIC, REQUEST_METRIC,
+    UNKNOWN_POOL)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        histogram = Histogram([1, 2, 4])
+        for value in [0.5, 1, 1.5, 3, 5, 6]:
+            histogram.observe(value)
+        assert histogram.counts == [2, 1, 1, 2]
+        assert histogram.count == 6
+        assert histogram.sum == 17.0
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = Metrics(clock=self.clock, buckets=[0.1, 1])
+
+    def test_stage_timer(self):
+        timer = self.metrics.timer('redeem', 'pool1')
+        with timer.stage('parse'):
+            self.clock.advance(0.05)
+        d = Deferred()
+        assert timer.time('claim', d) is d
+        self.clock.advance(0.5)
+        d.callback('result')
+        assert self.successResultOf(d) == 'result'
+        assert timer.finish('done') == 'done'
+
+        parse = self.metrics.stage_histogram('redeem', 'pool1', 'parse')
+        assert parse.counts == [1, 0, 0]
+        claim = self.metrics.stage_histogram('redeem', 'pool1', 'claim')
+        assert claim.counts == [0, 1, 0]
+        assert self.metrics.stage_histogram('redeem', 'pool1', 'x') is None
+        request = self.metrics.request_histogram('redeem', 'pool1')
+        assert request.counts == [0, 1, 0]
+        assert request.sum == 0.55
+
+    def test_stage_timer_failure(self):
+        timer = self.metrics.timer('redeem', 'pool1')
+        d = timer.time('claim', Deferred())
+        self.clock.advance(2)
+        d.errback(ValueError('bad'))
+        self.failureResultOf(d, ValueError)
+        claim = self.metrics.stage_histogram('redeem', 'pool1', 'claim')
+        assert claim.counts == [0, 0, 1]
+
+    def test_stage_timer_pool_known(self):
+        known = set(['pool1'])
+        for pool in ['pool1', 'pool2']:
+            timer = self.metrics.timer(
+                'redeem', pool, pool_known=lambda: pool in known)
+            with timer.stage('parse'):
+                self.clock.advance(0.05)
+            # We don't know which pool to record stages for until the end.
+            assert self.metrics.stage_histogram(
+                'redeem', pool, 'parse') is None
+            timer.finish()
+            # Stages after the end are recorded straight away.
+            with timer.stage('release'):
+                pass
+
+        assert self.metrics.stage_histogram(
+            'redeem', 'pool1', 'parse').count == 1
+        assert self.metrics.stage_histogram(
+            'redeem', 'pool1', 'release').count == 1
+        assert self.metrics.request_histogram('redeem', 'pool1').count == 1
+        assert self.metrics.stage_histogram(
+            'redeem', 'pool2', 'parse') is None
+        assert self.metrics.request_histogram('redeem', 'pool2') is None
+        assert self.metrics.stage_histogram(
+            'redeem', UNKNOWN_POOL, 'parse').count == 1
+        assert self.metrics.stage_histogram(
+            'redeem', UNKNOWN_POOL, 'release').count == 1
+        assert self.metrics.request_histogram(
+            'redeem', UNKNOWN_POOL).count == 1
+
+    def test_null_timer(self):
+        d = succeed('result')
+        assert NULL_TIMER.time('claim', d) is d
+        with NULL_TIMER.stage('parse'):
+            pass
+        assert NULL_TIMER.finish('done') == 'done'
+
+    def test_render(self):
+        timer = self.metrics.timer('redeem', 'pool"1')
+        with timer.stage('parse'):
+            self.clock.advance(0.5)
+        timer.finish()
+        self.metrics.add_gauge('things', 'Number of things.', lambda: 3)
+
+        labels = 'endpoint="redeem",pool="pool\\"1"'
+        assert self.metrics.render().splitlines() == [
+            '# HELP %s Time spent in each stage of handling a request.' % (
+                STAGE_METRIC,),
+            '# TYPE %s histogram' % (STAGE_METRIC,),
+            '%s_bucket{%s,stage="parse",le="0.1"} 0' % (STAGE_METRIC, labels),
+            '%s_bucket{%s,stage="parse",le="1.0"} 1' % (STAGE_METRIC, labels),
+            '%s_bucket{%s,stage="parse",le="+Inf"} 1' % (
+                STAGE_METRIC, labels),
+            '%s_sum{%s,stage="parse"} 0.5' % (STAGE_METRIC, labels),
+            '%s_count{%s,stage="parse"} 1' % (STAGE_METRIC, labels),
+            '# HELP %s Time spent handling a request.' % (REQUEST_METRIC,),
+            '# TYPE %s histogram' % (REQUEST_METRIC,),
+            '%s_bucket{%s,le="0.1"} 0' % (REQUEST_METRIC, labels),
+            '%s_bucket{%s,le="1.0"} 1' % (REQUEST_METRIC, labels),
+            '%s_bucket{%s,le="+Inf"} 1' % (REQUEST_METRIC, labels),
+            '%s_sum{%s} 0.5' % (REQUEST_METRIC, labels),
+            '%s_count{%s} 1' % (REQUEST_METRIC, labels),
+            '# HELP things Number of things.',
+            '# TYPE things gauge',
+            'things 3.0',
+        ]
+
+    def test_render_labelled_gauge(self):
+        values = {}
+        self.metrics.add_gauge(
+            'things', 'Number of things.', lambda: values,
+            label_names=('pool',))
+        # Gauges with no values aren't rendered at all.
+        assert self.metrics.render() == ''
+        values.update({('pool2',): 2, ('pool1',): 1})
+        assert self.metrics.render().splitlines() == [
+            '# HELP things Number of things.',
+            '# TYPE things gauge',
+            'things{pool="pool1"} 1.0',
+            'things{pool="pool2"} 2.0',
+        ]
+
+    def test_render_counter(self):
+        self.metrics.add_counter('things_total', 'Things seen.', lambda: 3)
+        assert self.metrics.render().splitlines() == [
+            '# HELP things_total Things seen.',
+            '# TYPE things_total counter',
+            'things_total 3.0',
+        ]
+
+    def test_render_empty(self):
+        assert self.metrics.render() == ''
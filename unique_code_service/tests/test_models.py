@@ -1,17 +1,36 @@
 from datetime import datetime, timedelta
+import json
 import os
+import re
 
 from aludel.database import get_engine, MetaData
 from aludel.tests.doubles import FakeReactorThreads
+from sqlalchemy import inspect
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql.compiler import SQLCompiler
+from sqlalchemy.sql.expression import Select, Update
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 
+from unique_code_service.bloom import UniqueCodeFilter
+from unique_code_service.bulk_insert import BulkInserter
 from unique_code_service.models import (
-    UniqueCodePool, CannotRedeemUniqueCode, NoUniqueCodePool, AuditMismatch,
+    UniqueCodePool, AuditRecord, CannotRedeemUniqueCode, CannotIssueUniqueCode,
+    IssueContention, NoUniqueCodePool, AuditMismatch, ImportConflict,
+    NoImportJob, ImportJobTakenOver, ImportInProgress, _Canonicaliser,
 )
 
 from .helpers import populate_pool, mk_audit_params
 
 
+def statement_of(query):
+    """Return the statement behind a query, which may have been compiled."""
+    return getattr(query, 'statement', query)
+
+
 class TestUniqueCodePool(TestCase):
     timeout = 5
 
@@ -56,6 +75,10 @@ class TestUniqueCodePool(TestCase):
     def assert_unique_code_counts(self, pool, expected_rows):
         rows = self.successResultOf(pool.count_unique_codes())
         assert sorted(tuple(r) for r in rows) == sorted(expected_rows)
+        # The maintained counts must match the unique codes.
+        rows = self.successResultOf(
+            pool.execute_fetchall(pool._exact_counts_query()))
+        assert sorted(tuple(r) for r in rows) == sorted(expected_rows)
 
     def test_import_fails_for_missing_pool(self):
         pool = UniqueCodePool('testpool', self.conn)
@@ -117,6 +140,216 @@ class TestUniqueCodePool(TestCase):
             AuditMismatch)
         self.assert_unique_code_counts(pool, expected_codes)
 
+    def test_import_unique_codes_in_batches(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+
+        consumed = []
+
+        def unique_code_dicts():
+            for i in range(10):
+                consumed.append(i)
+                yield {'flavour': 'vanilla', 'unique_code': 'v%s' % (i,)}
+
+        inserts = []
+
+        class LoggingInserter(BulkInserter):
+            def insert(self, collection, table, rows, **kw):
+                inserts.append((len(consumed), len(rows)))
+                return super(LoggingInserter, self).insert(
+                    collection, table, rows, **kw)
+        self.patch(pool, 'get_bulk_inserter', lambda: LoggingInserter(3))
+
+        self.successResultOf(
+            pool.import_unique_codes('req-0', 'md5-0', unique_code_dicts()))
+        # Rows are consumed lazily, one batch at a time.
+        assert inserts == [(3, 3), (6, 3), (9, 3), (10, 1)]
+        self.assert_unique_code_counts(pool, [('vanilla', False, 10)])
+
+    def test_import_unique_codes_summary(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0])
+        self.patch(pool, 'get_bulk_inserter', lambda: BulkInserter(2))
+        self.patch(pool, 'IMPORT_LOOKUP_SIZE', 1)
+        self.patch(pool, 'MAX_REJECTED_ROWS', 3)
+
+        summary = self.successResultOf(pool.import_unique_codes(
+            'req-0', 'md5-0', [
+                {'flavour': 'vanilla', 'unique_code': 'V-1'},
+                {'flavour': 'vanilla', 'unique_code': 'vanilla0'},
+                # This is a duplicate of a code in an earlier batch.
+                {'flavour': 'vanilla', 'unique_code': 'v1'},
+                {'flavour': 'vanilla', 'unique_code': '!!'},
+                {'flavour': 'vanilla', 'unique_code': None},
+                # These are duplicates within the batch.
+                {'flavour': 'chocolate', 'unique_code': 'c0'},
+                {'flavour': 'chocolate', 'unique_code': 'C0'},
+            ]))
+        assert summary == {
+            'inserted': 2,
+            'rejected': {'invalid': 2, 'duplicate': 3},
+            'rejected_rows': [
+                {'row': 2, 'unique_code': 'vanilla0', 'reason': 'duplicate'},
+                {'row': 3, 'unique_code': 'v1', 'reason': 'duplicate'},
+                {'row': 4, 'unique_code': '!!', 'reason': 'invalid'},
+            ],
+        }
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', False, 2),
+            ('chocolate', False, 1),
+        ])
+        rows = self.successResultOf(pool.execute_fetchall(
+            pool.unique_codes.select().order_by(pool.unique_codes.c.id)))
+        assert [r['unique_code'] for r in rows] == ['vanilla0', 'v1', 'c0']
+
+        # A repeated import has no summary.
+        assert self.successResultOf(pool.import_unique_codes(
+            'req-0', 'md5-0', [])) is None
+
+    def test_unique_codes_are_unique(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0])
+        self.failureResultOf(pool.execute_query(
+            pool.unique_codes.insert().values(
+                flavour='chocolate', unique_code='vanilla0')),
+            IntegrityError)
+
+    def test_import_unique_codes_conflict(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0])
+        # Pretend that a concurrent import added vanilla0 after we looked.
+        self.patch(pool, '_find_unique_codes', lambda codes: succeed(set()))
+
+        unique_code_dicts = [
+            {'flavour': 'vanilla', 'unique_code': 'vanilla0'},
+            {'flavour': 'vanilla', 'unique_code': 'vanilla1'},
+        ]
+        self.failureResultOf(pool.import_unique_codes(
+            'req-0', 'md5-0', unique_code_dicts), ImportConflict)
+        self.assert_unique_code_counts(pool, [('vanilla', False, 1)])
+
+        # Nothing was recorded, so the import can be tried again.
+        del pool._find_unique_codes
+        summary = self.successResultOf(pool.import_unique_codes(
+            'req-0', 'md5-0', unique_code_dicts))
+        assert summary['inserted'] == 1
+        self.assert_unique_code_counts(pool, [('vanilla', False, 2)])
+
+    def test_import_job(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.failureResultOf(pool.get_import_job('req-0'), NoImportJob)
+
+        job, run = self.successResultOf(
+            pool.start_import_job('req-0', 'md5-0'))
+        assert run
+        assert (job['status'], job['rows_processed']) == ('running', 0)
+        # A job that's already running isn't started again.
+        job, run = self.successResultOf(
+            pool.start_import_job('req-0', 'md5-0'))
+        assert not run
+        self.failureResultOf(
+            pool.start_import_job('req-0', 'md5-1'), AuditMismatch)
+
+        job = self.successResultOf(pool.import_job_batch('req-0', 0, [
+            {'flavour': 'vanilla', 'unique_code': 'v0'},
+            {'flavour': 'vanilla', 'unique_code': 'V0'},
+        ]))
+        assert job['rows_processed'] == 2
+        assert job['summary']['inserted'] == 1
+        job = self.successResultOf(pool.import_job_batch('req-0', 2, []))
+        assert job['status'] == 'done'
+        assert self.successResultOf(pool.get_import_job('req-0')) == job
+        self.assert_unique_code_counts(pool, [('vanilla', False, 1)])
+
+        job, run = self.successResultOf(
+            pool.start_import_job('req-0', 'md5-0'))
+        assert (job['status'], run) == ('done', False)
+        # The import is recorded like a synchronous one.
+        assert self.successResultOf(pool.import_unique_codes(
+            'req-0', 'md5-0', [])) is None
+
+    def test_import_job_resume(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(pool.start_import_job('req-0', 'md5-0'))
+        self.successResultOf(pool.import_job_batch('req-0', 0, [
+            {'flavour': 'vanilla', 'unique_code': 'v0'},
+        ]))
+        self.successResultOf(pool.fail_import_job('req-0', 'oops'))
+        job = self.successResultOf(pool.get_import_job('req-0'))
+        assert (job['status'], job['error']) == ('failed', 'oops')
+
+        job, run = self.successResultOf(
+            pool.start_import_job('req-0', 'md5-0'))
+        assert run
+        assert (job['status'], job['error']) == ('running', None)
+        assert job['rows_processed'] == 1
+
+    def test_import_job_and_sync_import(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(pool.start_import_job('req-0', 'md5-0'))
+        codes = [{'flavour': 'vanilla', 'unique_code': 'v0'}]
+        # A synchronous import can't take over an unfinished job.
+        self.failureResultOf(
+            pool.import_unique_codes('req-0', 'md5-1', codes), AuditMismatch)
+        self.failureResultOf(
+            pool.import_unique_codes('req-0', 'md5-0', codes),
+            ImportInProgress)
+        self.assert_unique_code_counts(pool, [])
+
+        # A synchronous import that started before the job finished it.
+        self.successResultOf(pool.execute_query(
+            pool.import_audit.insert().values(
+                request_id='req-0', content_md5='md5-0')))
+        job = self.successResultOf(pool.import_job_batch('req-0', 0, []))
+        assert job['status'] == 'done'
+
+        self.successResultOf(pool.start_import_job('req-1', 'md5-0'))
+        self.successResultOf(pool.execute_query(
+            pool.import_audit.insert().values(
+                request_id='req-1', content_md5='md5-1')))
+        self.failureResultOf(
+            pool.import_job_batch('req-1', 0, []), AuditMismatch)
+
+    def test_import_job_stale(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(pool.start_import_job('req-0', 'md5-0'))
+        self.patch(pool, 'IMPORT_JOB_STALE_AFTER', -1)
+        job, run = self.successResultOf(
+            pool.start_import_job('req-0', 'md5-0'))
+        assert run
+
+        # Whichever process gets a batch in first carries on with the job.
+        batch = [{'flavour': 'vanilla', 'unique_code': 'v0'}]
+        self.successResultOf(pool.import_job_batch('req-0', 0, batch))
+        self.failureResultOf(
+            pool.import_job_batch('req-0', 0, batch), ImportJobTakenOver)
+        self.assert_unique_code_counts(pool, [('vanilla', False, 1)])
+
+    def test_import_unique_codes_failure_rolls_back(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+
+        def unique_code_dicts():
+            yield {'flavour': 'vanilla', 'unique_code': 'v0'}
+            raise ValueError('bad csv')
+        self.patch(pool, 'get_bulk_inserter', lambda: BulkInserter(1))
+
+        self.failureResultOf(pool.import_unique_codes(
+            'req-0', 'md5-0', unique_code_dicts()), ValueError)
+        self.assert_unique_code_counts(pool, [])
+        # Nothing was recorded, so the import can be tried again.
+        self.successResultOf(pool.import_unique_codes('req-0', 'md5-0', [
+            {'flavour': 'vanilla', 'unique_code': 'v0'},
+        ]))
+        self.assert_unique_code_counts(pool, [('vanilla', False, 1)])
+
     def test_canonicalise_unique_code(self):
         assert 'foo' == UniqueCodePool.canonicalise_unique_code('foo')
         assert 'foo' == UniqueCodePool.canonicalise_unique_code('FOO')
@@ -127,6 +360,47 @@ class TestUniqueCodePool(TestCase):
         assert alnum_lower == UniqueCodePool.canonicalise_unique_code(
             ''.join(chr(i) for i in range(128)))
 
+    def test_canonicalise_unique_code_unicode(self):
+        canonicalise = UniqueCodePool.canonicalise_unique_code
+        assert canonicalise(u'F O:-o') == u'foo'
+        assert isinstance(canonicalise(u'foo'), unicode)
+        # Non-ASCII characters are stripped out after lowercasing, just like
+        # everything else.
+        assert canonicalise(u'f\xd6o-\u212a') == u'fok'
+        assert canonicalise(u'\u2603') == u''
+
+    def test_canonicalise_unique_code_all_bytes(self):
+        all_bytes = ''.join(chr(i) for i in range(256))
+        expected = ''.join(c for c in all_bytes.lower()
+                           if c in UniqueCodePool.UNIQUE_CODE_ALLOWED_CHARS)
+        assert UniqueCodePool.canonicalise_unique_code(all_bytes) == expected
+
+    def test_canonicalise_unique_code_allowed_chars(self):
+        class HexPool(UniqueCodePool):
+            UNIQUE_CODE_ALLOWED_CHARS = '0123456789abcdef'
+        assert HexPool.canonicalise_unique_code('DEAD-beef-CAFE') == (
+            'deadbeefcafe')
+        assert HexPool.canonicalise_unique_code('xyz-123') == '123'
+        assert UniqueCodePool.canonicalise_unique_code('xyz-123') == 'xyz123'
+
+    def test_canonicalise_unique_codes(self):
+        canonical_codes = UniqueCodePool.canonicalise_unique_codes(
+            iter(['FOO', u'b-a-r', 'Baz ']))
+        assert list(canonical_codes) == ['foo', u'bar', 'baz']
+        assert list(UniqueCodePool.canonicalise_unique_codes([])) == []
+
+    def test_canonicalise_unique_codes_awkward(self):
+        canonicalise = UniqueCodePool.canonicalise_unique_codes
+        # Newlines in codes, non-ASCII unicode and unjoinable mixtures all
+        # get the same results as canonicalising one at a time.
+        for unique_codes in [['f\no', 'B-ar'], [u'f\xf6o', u'Bar'],
+                             [u'foo', 'b\xffar']]:
+            expected = [UniqueCodePool.canonicalise_unique_code(c)
+                        for c in unique_codes]
+            assert list(canonicalise(unique_codes)) == expected
+        self.patch(_Canonicaliser, 'BATCH_SIZE', 2)
+        assert list(canonicalise('ABCDE')) == ['a', 'b', 'c', 'd', 'e']
+
     def test_redeem_valid_unique_code(self):
         pool = UniqueCodePool('testpool', self.conn)
         self.successResultOf(pool.create_tables())
@@ -164,6 +438,92 @@ class TestUniqueCodePool(TestCase):
         assert failure.value.reason == 'used'
         assert failure.value.unique_code == 'vanilla0'
 
+    def test_redeem_unique_code_lost_race(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0])
+        self.patch(pool, '_supports_returning', lambda: False)
+
+        # Simulate another redeemer claiming the code between our select and
+        # our update by handing back the row as it was before they did.
+        stale_code = self.successResultOf(pool._get_unique_code('vanilla0'))
+        self.successResultOf(
+            pool.redeem_unique_code('vanilla0', mk_audit_params('req-0')))
+        self.patch(pool, '_get_unique_code', lambda code: succeed(stale_code))
+
+        failure = self.failureResultOf(
+            pool.redeem_unique_code('vanilla0', mk_audit_params('req-1')),
+            CannotRedeemUniqueCode)
+        assert failure.value.reason == 'used'
+        assert failure.value.unique_code == 'vanilla0'
+        self.assert_unique_code_counts(pool, [('vanilla', True, 1)])
+
+    def test_redeem_unique_code_new_request_queries(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0])
+
+        queries = []
+        execute_query = pool.execute_query
+
+        def logging_execute_query(query, *args, **kw):
+            queries.append(query)
+            return execute_query(query, *args, **kw)
+        self.patch(pool, 'execute_query', logging_execute_query)
+
+        self.successResultOf(
+            pool.redeem_unique_code('vanilla0', mk_audit_params('req-0')))
+        # We don't look for a previous request before we try this one.
+        statements = [statement_of(q) for q in queries]
+        assert [q for q in statements if isinstance(q, Select) and
+                pool.audit in q.froms] == []
+
+    def test_redeem_unique_code_compiles_once(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1, 2])
+        self.successResultOf(
+            pool.redeem_unique_code('vanilla0', mk_audit_params('req-0')))
+
+        compiled = []
+        compiler_init = SQLCompiler.__init__
+
+        def logging_compiler_init(compiler, dialect, statement, **kw):
+            compiled.append(statement)
+            return compiler_init(compiler, dialect, statement, **kw)
+        self.patch(SQLCompiler, '__init__', logging_compiler_init)
+
+        self.successResultOf(
+            pool.redeem_unique_code('vanilla1', mk_audit_params('req-1')))
+        # Copies of the pool share its compiled statements.
+        other_pool = pool.bind(self.conn)
+        self.successResultOf(other_pool.redeem_unique_code(
+            'vanilla2', mk_audit_params('req-2')))
+        assert compiled == []
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', True, 3),
+        ])
+
+    def test_redeem_unique_code_replay_rolls_back(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        audit_params = mk_audit_params('req-0')
+        failure = self.failureResultOf(
+            pool.redeem_unique_code('vanilla0', audit_params),
+            CannotRedeemUniqueCode)
+        assert failure.value.reason == 'invalid'
+
+        # The code exists now, so repeating the request claims it before we
+        # find the earlier audit row. That claim must be undone.
+        populate_pool(pool, ['vanilla'], [0])
+        failure = self.failureResultOf(
+            pool.redeem_unique_code('vanilla0', audit_params),
+            CannotRedeemUniqueCode)
+        assert failure.value.reason == 'invalid'
+        self.assert_unique_code_counts(pool, [('vanilla', False, 1)])
+        rows = self.successResultOf(pool.query_by_request_id('req-0'))
+        assert len(rows) == 1
+
     def test_redeem_unique_code_idempotent(self):
         pool = UniqueCodePool('testpool', self.conn)
         self.successResultOf(pool.create_tables())
@@ -191,6 +551,41 @@ class TestUniqueCodePool(TestCase):
         self.failureResultOf(
             pool.redeem_unique_code('vanilla1', audit_params_2), AuditMismatch)
 
+    def test_redeem_without_unique_request_ids(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1])
+        # Pools created before we made indexes don't have this one.
+        self.successResultOf(self.conn.execute(
+            'DROP INDEX ix_%s_request_id' % (pool.audit.name,)))
+        pool = UniqueCodePool('testpool', self.conn)
+        assert not self.successResultOf(pool._has_unique_request_ids())
+
+        audit_params = mk_audit_params('req-0')
+        unique_code = self.successResultOf(
+            pool.redeem_unique_code('vanilla0', audit_params))
+        assert self.successResultOf(pool.redeem_unique_code(
+            'vanilla0', audit_params)) == unique_code
+        self.failureResultOf(
+            pool.redeem_unique_code('vanilla1', audit_params), AuditMismatch)
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', False, 1), ('vanilla', True, 1)])
+
+        # Duplicate request_ids may have got in before, and the first one
+        # is the one we repeat.
+        self.successResultOf(pool._audit_request(
+            audit_params, {'candidate_code': 'other'}, {}, 'other'))
+        assert self.successResultOf(pool.redeem_unique_code(
+            'vanilla0', audit_params)) == unique_code
+
+        # Upgrading the pool puts the index back.
+        self.successResultOf(pool.execute_query(pool.audit.delete().where(
+            pool.audit.c.unique_code == 'other')))
+        self.successResultOf(pool.create_tables())
+        assert self.successResultOf(pool._has_unique_request_ids())
+        self.failureResultOf(
+            pool.redeem_unique_code('vanilla1', audit_params), AuditMismatch)
+
     def test_redeem_invalid_unique_code_idempotent(self):
         pool = UniqueCodePool('testpool', self.conn)
         self.successResultOf(pool.create_tables())
@@ -212,6 +607,625 @@ class TestUniqueCodePool(TestCase):
         assert failure.value.reason == 'invalid'
         assert failure.value.unique_code == 'vanilla0'
 
+    def test_redeem_with_code_filter(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0])
+        pool.code_filter = UniqueCodeFilter(Clock())
+        self.successResultOf(
+            pool.code_filter.refresh(lambda func: func(pool)))
+        # Imports add their codes to the filter.
+        populate_pool(pool, ['vanilla'], [1])
+
+        def no_lookup(*args):
+            raise AssertionError("Unexpected lookup.")
+        self.patch(pool, '_redeem_unique_code', no_lookup)
+        self.patch(pool, '_lock_unique_codes', no_lookup)
+
+        f = self.failureResultOf(pool.redeem_unique_code(
+            'nothing', mk_audit_params('req-0')), CannotRedeemUniqueCode)
+        assert f.value.reason == 'invalid'
+        [result] = self.successResultOf(pool.redeem_unique_codes(
+            ['nothing'], mk_audit_params('req-1')))
+        assert result.reason == 'invalid'
+        assert pool.code_filter.skipped_lookups == 2
+        # The attempts are still audited.
+        [row] = self.successResultOf(pool.query_by_request_id('req-0'))
+        assert row['error']
+        [row] = self.successResultOf(pool.query_by_request_id('req-1/0'))
+        assert row['error']
+
+        del pool._redeem_unique_code
+        unique_code = self.successResultOf(
+            pool.redeem_unique_code('vanilla1', mk_audit_params('req-2')))
+        assert unique_code['unique_code'] == 'vanilla1'
+
+    def test_redeem_unique_codes(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla', 'chocolate'], [0, 1])
+        self.successResultOf(
+            pool.redeem_unique_code('chocolate1', mk_audit_params('req-0')))
+
+        results = self.successResultOf(pool.redeem_unique_codes(
+            ['vanilla0', 'Choc-olate0', 'chocolate1', 'banana0', 'vanilla0'],
+            mk_audit_params('req-1')))
+        [vanilla0, chocolate0, chocolate1, banana0, vanilla0_again] = results
+        assert vanilla0['unique_code'] == 'vanilla0'
+        assert vanilla0['flavour'] == 'vanilla'
+        assert chocolate0['unique_code'] == 'chocolate0'
+        assert chocolate0['flavour'] == 'chocolate'
+        assert isinstance(chocolate1, CannotRedeemUniqueCode)
+        assert (chocolate1.reason, chocolate1.unique_code) == (
+            'used', 'chocolate1')
+        assert isinstance(banana0, CannotRedeemUniqueCode)
+        assert (banana0.reason, banana0.unique_code) == ('invalid', 'banana0')
+        # The same code later in the batch has already been used.
+        assert isinstance(vanilla0_again, CannotRedeemUniqueCode)
+        assert vanilla0_again.reason == 'used'
+
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', False, 1),
+            ('vanilla', True, 1),
+            ('chocolate', True, 2),
+        ])
+
+        rows = self.successResultOf(pool.query_by_transaction_id('tx-req-1'))
+        assert sorted((r['request_id'], r['error']) for r in rows) == [
+            ('req-1', False),
+            ('req-1/0', False),
+            ('req-1/1', False),
+            ('req-1/2', True),
+            ('req-1/3', True),
+            ('req-1/4', True),
+        ]
+        # The batch's own audit record has all its codes.
+        [row] = self.successResultOf(pool.query_by_request_id('req-1'))
+        assert row['request_data'] == {'candidate_codes': [
+            'vanilla0', 'Choc-olate0', 'chocolate1', 'banana0', 'vanilla0']}
+        assert row['response_data'] == {'redeemed': 2, 'failed': 3}
+
+    def test_redeem_unique_codes_empty(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        results = self.successResultOf(
+            pool.redeem_unique_codes([], mk_audit_params('req-0')))
+        assert results == []
+        # Empty batches are audited like any other.
+        [row] = self.successResultOf(pool.query_by_request_id('req-0'))
+        assert row['request_data'] == {'candidate_codes': []}
+        assert self.successResultOf(
+            pool.redeem_unique_codes([], mk_audit_params('req-0'))) == []
+        self.failureResultOf(pool.redeem_unique_codes(
+            ['vanilla0'], mk_audit_params('req-0')), AuditMismatch)
+
+    def test_redeem_unique_codes_concurrent_retry(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0])
+        audit_params = mk_audit_params('req-0')
+        [result] = self.successResultOf(
+            pool.redeem_unique_codes(['vanilla0'], audit_params))
+        assert result['unique_code'] == 'vanilla0'
+
+        # A retry that looked before the first attempt had committed finds
+        # out about it when it tries to audit the same request_ids.
+        get_previous_requests = pool._get_previous_requests
+        lookups = []
+
+        def late_lookup(request_ids):
+            lookups.append(request_ids)
+            if len(lookups) == 1:
+                return succeed({})
+            return get_previous_requests(request_ids)
+        self.patch(pool, '_get_previous_requests', late_lookup)
+        [result] = self.successResultOf(
+            pool.redeem_unique_codes(['vanilla0'], audit_params))
+        assert result['unique_code'] == 'vanilla0'
+        assert len(lookups) == 2
+        self.assert_unique_code_counts(pool, [('vanilla', True, 1)])
+
+    def test_redeem_unique_codes_idempotent(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1])
+        audit_params = mk_audit_params('req-0')
+
+        results = self.successResultOf(pool.redeem_unique_codes(
+            ['vanilla0', 'vanilla7'], audit_params))
+        assert results[0]['unique_code'] == 'vanilla0'
+        assert results[1].reason == 'invalid'
+
+        # Again, with the same codes.
+        results = self.successResultOf(pool.redeem_unique_codes(
+            ['vanilla0', 'vanilla7'], audit_params))
+        assert results[0]['unique_code'] == 'vanilla0'
+        assert results[1].reason == 'invalid'
+
+        # Different codes for the same request is a mismatch, even if the
+        # codes we've seen before are the same.
+        self.failureResultOf(pool.redeem_unique_codes(
+            ['vanilla0', 'vanilla7', 'vanilla1'], audit_params),
+            AuditMismatch)
+        self.failureResultOf(pool.redeem_unique_codes(
+            ['vanilla1', 'vanilla7'], audit_params), AuditMismatch)
+        self.failureResultOf(pool.redeem_unique_codes(
+            ['vanilla0', 'vanilla7'], mk_audit_params('req-0', 'tx-other')),
+            AuditMismatch)
+        self.failureResultOf(pool.redeem_unique_code(
+            'vanilla1', mk_audit_params('req-0')), AuditMismatch)
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', False, 1),
+            ('vanilla', True, 1),
+        ])
+
+        # The items' request_ids can't clash with another request's.
+        unique_code = self.successResultOf(pool.redeem_unique_code(
+            'vanilla1', mk_audit_params('req-0:0')))
+        assert unique_code['unique_code'] == 'vanilla1'
+
+    def test_redeem_unique_codes_rolls_back(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1])
+
+        def broken_audit_row(*args, **kw):
+            raise Exception("Oops.")
+        self.patch(pool, '_audit_row', broken_audit_row)
+        self.failureResultOf(pool.redeem_unique_codes(
+            ['vanilla0', 'vanilla1'], mk_audit_params('req-0')), Exception)
+        self.assert_unique_code_counts(pool, [('vanilla', False, 2)])
+
+    def test_issue_unique_code(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla', 'chocolate'], [0, 1])
+
+        issued = set()
+        for i in range(2):
+            unique_code = self.successResultOf(pool.issue_unique_code(
+                'vanilla', mk_audit_params('req-%s' % (i,))))
+            assert unique_code['flavour'] == 'vanilla'
+            issued.add(unique_code['unique_code'])
+        assert issued == set(['vanilla0', 'vanilla1'])
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', True, 2),
+            ('chocolate', False, 2),
+        ])
+
+        failure = self.failureResultOf(
+            pool.issue_unique_code('vanilla', mk_audit_params('req-2')),
+            CannotIssueUniqueCode)
+        assert failure.value.reason == 'exhausted'
+        assert failure.value.flavour == 'vanilla'
+
+        # Issued codes can't be redeemed.
+        failure = self.failureResultOf(
+            pool.redeem_unique_code('vanilla0', mk_audit_params('req-3')),
+            CannotRedeemUniqueCode)
+        assert failure.value.reason == 'used'
+
+    def test_issue_unique_code_idempotent(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1])
+        audit_params = mk_audit_params('req-0')
+
+        unique_code = self.successResultOf(
+            pool.issue_unique_code('vanilla', audit_params))
+        unique_code_again = self.successResultOf(
+            pool.issue_unique_code('vanilla', audit_params))
+        assert unique_code_again == unique_code
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', True, 1),
+            ('vanilla', False, 1),
+        ])
+
+        self.failureResultOf(
+            pool.issue_unique_code('chocolate', audit_params), AuditMismatch)
+        self.failureResultOf(
+            pool.redeem_unique_code('vanilla1', audit_params), AuditMismatch)
+
+        # Failures are idempotent too.
+        failure = self.failureResultOf(
+            pool.issue_unique_code('chocolate', mk_audit_params('req-1')),
+            CannotIssueUniqueCode)
+        populate_pool(pool, ['chocolate'], [0])
+        failure = self.failureResultOf(
+            pool.issue_unique_code('chocolate', mk_audit_params('req-1')),
+            CannotIssueUniqueCode)
+        assert failure.value.reason == 'exhausted'
+        assert failure.value.flavour == 'chocolate'
+        # The code we claimed while repeating the request was given back.
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', True, 1),
+            ('vanilla', False, 1),
+            ('chocolate', False, 1),
+        ])
+
+    def test_issue_unique_code_contention(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1])
+        self.patch(pool, '_supports_skip_locked', lambda: False)
+
+        # Pretend that other issuers always claim our candidates first.
+        execute_query = pool.execute_query
+
+        def losing_execute_query(query, *args, **kw):
+            if isinstance(statement_of(query), Update):
+                return succeed(FakeResult(0))
+            return execute_query(query, *args, **kw)
+
+        class FakeResult(object):
+            def __init__(self, rowcount):
+                self.rowcount = rowcount
+        self.patch(pool, 'execute_query', losing_execute_query)
+
+        self.failureResultOf(
+            pool.issue_unique_code('vanilla', mk_audit_params('req-0')),
+            IssueContention)
+        # Nothing was audited, so we can try again.
+        self.patch(pool, 'execute_query', execute_query)
+        unique_code = self.successResultOf(
+            pool.issue_unique_code('vanilla', mk_audit_params('req-0')))
+        assert unique_code['flavour'] == 'vanilla'
+
+    def test_rebuild_counts(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla', 'chocolate'], [0, 1])
+        self.successResultOf(
+            pool.redeem_unique_code('vanilla0', mk_audit_params('req-0')))
+        assert self.successResultOf(pool.rebuild_counts()) == []
+
+        # Break the counts and then fix them.
+        counts = pool.unique_code_counts
+        self.successResultOf(pool.execute_query(
+            counts.update().where(counts.c.flavour == 'vanilla').values(
+                count=7)))
+        self.successResultOf(pool.execute_query(
+            counts.delete().where(counts.c.flavour == 'chocolate')))
+        self.successResultOf(pool.execute_query(counts.insert().values(
+            flavour='banana', used=False, count=3)))
+        assert self.successResultOf(pool.rebuild_counts()) == [
+            ('banana', False, 3, 0),
+            ('chocolate', False, 0, 2),
+            ('vanilla', False, 7, 1),
+            ('vanilla', True, 7, 1),
+        ]
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', False, 1),
+            ('vanilla', True, 1),
+            ('chocolate', False, 2),
+        ])
+
+        # The counts still get updated after a rebuild.
+        self.successResultOf(
+            pool.redeem_unique_code('chocolate0', mk_audit_params('req-1')))
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', False, 1),
+            ('vanilla', True, 1),
+            ('chocolate', False, 1),
+            ('chocolate', True, 1),
+        ])
+
+    def test_rebuild_counts_missing_table(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1])
+        # NOTE: This is a blocking operation!
+        pool.unique_code_counts.drop(self.engine._engine)
+
+        # Pools from before we had counts get the table when we create them
+        # again.
+        self.successResultOf(pool.create_tables())
+        assert self.successResultOf(pool.rebuild_counts()) == [
+            ('vanilla', False, 0, 2),
+        ]
+        self.assert_unique_code_counts(pool, [('vanilla', False, 2)])
+
+    def test_counts_without_flavour(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        # A short CSV row has no flavour.
+        self.successResultOf(pool.import_unique_codes('req-0', 'md5-0', [
+            {'unique_code': 'v0', 'flavour': 'vanilla'},
+            {'unique_code': 'n0', 'flavour': None},
+            {'unique_code': 'n1', 'flavour': None},
+        ]))
+        self.successResultOf(
+            pool.redeem_unique_code('n0', mk_audit_params('req-1')))
+        self.assert_unique_code_counts(pool, [
+            ('vanilla', False, 1), (None, False, 1), (None, True, 1)])
+        assert self.successResultOf(pool.total_unique_codes()) == 3
+        assert self.successResultOf(pool.rebuild_counts()) == []
+
+    def test_counts_missing_table(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1])
+        # NOTE: This is a blocking operation!
+        pool.unique_code_counts.drop(self.engine._engine)
+        pool = UniqueCodePool('testpool', self.conn)
+
+        # Until the pool is upgraded, we count the codes themselves.
+        self.successResultOf(
+            pool.redeem_unique_code('vanilla0', mk_audit_params('req-0')))
+        rows = self.successResultOf(pool.count_unique_codes())
+        assert sorted(tuple(r) for r in rows) == [
+            ('vanilla', False, 1), ('vanilla', True, 1)]
+        assert self.successResultOf(pool.total_unique_codes()) == 2
+
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(pool.rebuild_counts())
+        self.successResultOf(
+            pool.redeem_unique_code('vanilla1', mk_audit_params('req-1')))
+        self.assert_unique_code_counts(pool, [('vanilla', True, 2)])
+
+    def test_create_tables_creates_indexes(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        # Creating them again is harmless.
+        self.successResultOf(pool.create_tables())
+        # NOTE: This is a blocking operation!
+        inspector = inspect(self.engine._engine)
+        indexes = dict((i['name'], i) for i in inspector.get_indexes(
+            pool.audit.name))
+        page_index = indexes['ix_%s_user_id_page' % (pool.audit.name,)]
+        assert page_index['column_names'] == ['user_id', 'created_at', 'id']
+        request_id_index = indexes['ix_%s_request_id' % (pool.audit.name,)]
+        assert request_id_index['unique']
+
+    def test_long_pool_name_indexes(self):
+        # Forty characters.
+        pool = UniqueCodePool('summer_campaign_2015_for_returning_users', None)
+        tables = pool._metadata.sorted_tables + [
+            pool._audit_bucket_table('201501')]
+        indexes = [index for table in tables for index in table.indexes]
+        for dialect in [postgresql.dialect(), mysql.dialect()]:
+            names = set()
+            for index in indexes:
+                # PostgreSQL raises an error here if a name is too long.
+                sql = str(CreateIndex(index).compile(dialect=dialect))
+                name = re.search(r' INDEX (\S+) ON ', sql).group(1)[1:-1]
+                # MySQL's limit is 64, but it's only checked by the server.
+                assert len(name) <= 63
+                names.add(name)
+            assert len(names) == len(indexes)
+
+    def test_query_audit_pages(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        for i in range(5):
+            self.successResultOf(pool._audit_request(
+                mk_audit_params('req-%s' % (i,), 'tx-0'), i, i, 'vanilla0'))
+        self.successResultOf(pool._audit_request(
+            mk_audit_params('req-excl'), 'excl', 'excl', 'excl'))
+
+        pages = []
+        cursor = None
+        while True:
+            records, cursor = self.successResultOf(pool.query_audit(
+                'transaction_id', 'tx-0', limit=2, after=cursor))
+            pages.append([r['request_id'] for r in records])
+            if cursor is None:
+                break
+        assert pages == [['req-0', 'req-1'], ['req-2', 'req-3'], ['req-4']]
+
+        records, cursor = self.successResultOf(
+            pool.query_audit('transaction_id', 'tx-0'))
+        assert len(records) == 5
+        assert cursor is None
+
+        # A full last page doesn't need another one after it.
+        records, cursor = self.successResultOf(
+            pool.query_audit('unique_code', 'vanilla0', limit=5))
+        assert len(records) == 5
+        assert cursor is None
+
+        self.assertRaises(ValueError, pool.query_audit, 'flavour', 'vanilla')
+
+    def insert_audit(self, pool, request_id, created_at, transaction_id):
+        row = pool._audit_row(
+            mk_audit_params(request_id, transaction_id), {}, {}, 'vanilla0')
+        row['created_at'] = created_at
+        self.successResultOf(
+            pool.execute_query(pool.audit.insert().values(**row)))
+
+    def test_rotate_audit(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.patch(pool, 'AUDIT_ROTATE_BATCH_SIZE', 2)
+        for i, month in enumerate([1, 1, 1, 2, 3]):
+            self.insert_audit(
+                pool, 'req-%s' % (i,), datetime(2015, month, 10), 'tx-0')
+        self.insert_audit(pool, 'req-new', datetime.utcnow(), 'tx-0')
+
+        moved = self.successResultOf(pool.rotate_audit(datetime(2015, 3, 1)))
+        assert moved == 4
+        assert self.successResultOf(pool.get_audit_buckets()) == [
+            '201501', '201502']
+        rows = self.successResultOf(pool.execute_fetchall(
+            pool.audit.select().order_by(pool.audit.c.id)))
+        assert [row['request_id'] for row in rows] == ['req-4', 'req-new']
+        # NOTE: This is a blocking operation!
+        inspector = inspect(self.engine._engine)
+        bucket_name = pool._audit_bucket_table('201501').name
+        assert bucket_name in inspector.get_table_names()
+        assert 'ix_%s_user_id_page' % (bucket_name,) in [
+            i['name'] for i in inspector.get_indexes(bucket_name)]
+
+        # Queries span the buckets and the audit table, in order.
+        pages = []
+        cursor = None
+        while True:
+            records, cursor = self.successResultOf(pool.query_audit(
+                'transaction_id', 'tx-0', limit=2, after=cursor))
+            pages.append([r['request_id'] for r in records])
+            if cursor is None:
+                break
+        assert pages == [
+            ['req-0', 'req-1'], ['req-2', 'req-3'], ['req-4', 'req-new']]
+        [record] = self.successResultOf(pool.query_by_request_id('req-3'))
+        assert record['created_at'] == datetime(2015, 2, 10)
+
+        # Rotating again only moves what's new.
+        moved = self.successResultOf(pool.rotate_audit(datetime(2015, 4, 1)))
+        assert moved == 1
+        assert self.successResultOf(pool.get_audit_buckets()) == [
+            '201501', '201502', '201503']
+
+    def test_export_and_drop_audit_bucket(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.patch(pool, 'AUDIT_ARCHIVE_BATCH_SIZE', 2)
+        for i in range(3):
+            self.insert_audit(
+                pool, 'req-%s' % (i,), datetime(2015, 1, 10), 'tx-0')
+        self.insert_audit(pool, 'req-3', datetime(2015, 2, 10), 'tx-0')
+        self.successResultOf(pool.rotate_audit(datetime(2015, 3, 1)))
+
+        written = []
+        exported = self.successResultOf(
+            pool.export_audit_bucket('201501', written.append))
+        assert exported == 3
+        assert [[row['request_id'] for row in rows] for rows in written] == [
+            ['req-0', 'req-1'], ['req-2']]
+        assert written[0][0]['created_at'] == datetime(2015, 1, 10)
+        # Exporting a bucket leaves it alone.
+        assert self.successResultOf(pool.get_audit_buckets()) == [
+            '201501', '201502']
+
+        self.successResultOf(pool.drop_audit_bucket('201501'))
+        assert self.successResultOf(pool.get_audit_buckets()) == ['201502']
+        # NOTE: This is a blocking operation!
+        inspector = inspect(self.engine._engine)
+        assert pool._audit_bucket_table('201501').name not in (
+            inspector.get_table_names())
+        records = self.successResultOf(
+            pool.query_by_transaction_id('tx-0'))
+        assert [r['request_id'] for r in records] == ['req-3']
+
+    def test_audit_record_decodes_lazily(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        # Neither of these repeats the columns, so they're stored as JSON.
+        self.successResultOf(pool._audit_request(
+            mk_audit_params('req-0'), {'candidate_code': 'VANILLA0'},
+            {'reason': 'used'}, 'vanilla0', error=True))
+
+        [record] = self.successResultOf(pool.query_by_request_id('req-0'))
+        assert isinstance(record, AuditRecord)
+        assert json.loads(record.raw_request_data) == {
+            'candidate_code': 'VANILLA0'}
+        assert record._decoded == {}
+        assert record['response_data'] == {'reason': 'used'}
+        assert record._decoded.keys() == ['response_data']
+        # We only decode each field once.
+        assert record['response_data'] is record['response_data']
+
+        assert sorted(record.keys()) == sorted(AuditRecord.FIELDS)
+        self.assertRaises(KeyError, lambda: record['id'])
+
+    def test_audit_data_compact(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0, 1])
+        unique_code = self.successResultOf(pool.redeem_unique_code(
+            'vanilla0', mk_audit_params('req-0')))
+        self.failureResultOf(pool.redeem_unique_code(
+            'vanilla0', mk_audit_params('req-1')), CannotRedeemUniqueCode)
+        issued = self.successResultOf(pool.issue_unique_code(
+            'vanilla', mk_audit_params('req-2')))
+
+        rows = self.successResultOf(pool.execute_fetchall(
+            pool.audit.select().order_by(pool.audit.c.id)))
+        # Only what the columns don't tell us is stored.
+        assert [row['request_data'] for row in rows] == [
+            '~', '~', '{"flavour": "vanilla"}']
+        assert [row['response_data'][:1] for row in rows] == ['~'] * 3
+        assert [json.loads('{%s}' % (row['response_data'][1:],))
+                for row in rows] == [
+            {'flavour': 'vanilla', 'id': unique_code['id'],
+             'reason': 'redeemed'},
+            {'reason': 'used'},
+            {'flavour': 'vanilla', 'id': issued['id'], 'reason': 'issued'},
+        ]
+        records = [AuditRecord(row) for row in rows]
+        assert records[0]['request_data'] == {'candidate_code': 'vanilla0'}
+        assert records[0]['response_data'] == unique_code
+        assert [json.loads(r.raw_request_data) for r in records] == [
+            r['request_data'] for r in records]
+        assert [json.loads(r.raw_response_data) for r in records] == [
+            r['response_data'] for r in records]
+        assert records[1]['response_data'] == {
+            'reason': 'used', 'unique_code': 'vanilla0'}
+        assert records[2]['request_data'] == {'flavour': 'vanilla'}
+        assert records[2]['response_data'] == issued
+
+        # Repeated requests still get the same response.
+        assert self.successResultOf(pool.redeem_unique_code(
+            'vanilla0', mk_audit_params('req-0'))) == unique_code
+        self.failureResultOf(pool.redeem_unique_code(
+            'vanilla0', mk_audit_params('req-1')), CannotRedeemUniqueCode)
+
+    def test_audit_data_compact_differs(self):
+        """Data that doesn't match the columns is stored as JSON."""
+        pool = UniqueCodePool('testpool', self.conn)
+        for data in [{'candidate_code': 'VANILLA0'}, {'candidate_code': 1},
+                     {'used': 1}, {}, []]:
+            row = pool._audit_row(
+                mk_audit_params('req-0'), data, {}, 'vanilla0')
+            assert row['request_data'] == json.dumps(data)
+        row = pool._audit_row(
+            mk_audit_params('req-0'), {}, {'unique_code': 'vanilla0',
+                                           'used': 1}, 'vanilla0')
+        assert json.loads(row['response_data']) == {
+            'unique_code': 'vanilla0', 'used': 1}
+
+    def test_audit_data_json_rows(self):
+        """Rows stored before audit data was compact can still be read."""
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['vanilla'], [0])
+        row = pool._audit_row(
+            mk_audit_params('req-0'), {}, {}, 'vanilla0')
+        row.update({
+            'request_data': json.dumps({'candidate_code': 'vanilla0'}),
+            'response_data': json.dumps({
+                'id': 1, 'unique_code': 'vanilla0', 'flavour': 'vanilla',
+                'used': True, 'reason': 'redeemed'}),
+        })
+        self.successResultOf(pool._insert_audit([row]))
+
+        [record] = self.successResultOf(pool.query_by_request_id('req-0'))
+        assert record['request_data'] == {'candidate_code': 'vanilla0'}
+        assert record['response_data']['flavour'] == 'vanilla'
+        unique_code = self.successResultOf(pool.redeem_unique_code(
+            'vanilla0', mk_audit_params('req-0')))
+        assert unique_code == record['response_data']
+
+    def test_query_audit_pages_same_created_at(self):
+        pool = UniqueCodePool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        created_at = datetime.utcnow().replace(microsecond=0)
+        for i in range(3):
+            row = pool._audit_row(
+                mk_audit_params('req-%s' % (i,), 'tx-0'), i, i, 'vanilla0')
+            row['created_at'] = created_at
+            self.successResultOf(
+                pool.execute_query(pool.audit.insert().values(**row)))
+
+        records, cursor = self.successResultOf(
+            pool.query_audit('transaction_id', 'tx-0', limit=2))
+        assert [r['request_id'] for r in records] == ['req-0', 'req-1']
+        # Rows created at the same time are ordered by id.
+        records, cursor = self.successResultOf(pool.query_audit(
+            'transaction_id', 'tx-0', limit=2, after=cursor))
+        assert [r['request_id'] for r in records] == ['req-2']
+        assert cursor is None
+
     def test_query_by_request_id(self):
         pool = UniqueCodePool('testpool', self.conn)
         self.successResultOf(pool.create_tables())
@@ -0,0 +1,174 @@
+import os
+
+from aludel.database import get_engine, MetaData
+from aludel.tests.doubles import FakeReactorThreads
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from unique_code_service.models import UniqueCodePool, NoUniqueCodePool
+from unique_code_service.registry import UniqueCodePoolRegistry
+
+
+class TestUniqueCodePoolRegistry(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self._drop_tables()
+        self.conn = self.successResultOf(self.engine.connect())
+        self.clock = Clock()
+        self.registry = UniqueCodePoolRegistry(self.clock, ttl=10)
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        self._drop_tables()
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def count_metadata_queries(self, pool):
+        queries = []
+        get_metadata = pool._collection_metadata._get_metadata
+
+        def logging_get_metadata(name):
+            queries.append(name)
+            return get_metadata(name)
+        self.patch(
+            pool._collection_metadata, '_get_metadata', logging_get_metadata)
+        return queries
+
+    def test_get_pool(self):
+        pool = self.registry.get_pool('testpool', self.conn)
+        assert isinstance(pool, UniqueCodePool)
+        assert pool.name == 'testpool'
+        assert pool._conn is self.conn
+        assert pool._collection_metadata._conn is self.conn
+
+        # A second pool shares tables with the first.
+        pool2 = self.registry.get_pool('testpool', 'other conn')
+        assert pool2._conn == 'other conn'
+        assert pool2.unique_codes is pool.unique_codes
+        assert pool._conn is self.conn
+
+        # Different names get different pools.
+        pool3 = self.registry.get_pool('otherpool', self.conn)
+        assert pool3.unique_codes is not pool.unique_codes
+
+    def test_existence_cached(self):
+        pool = self.registry.get_pool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+
+        pool = self.registry.get_pool('testpool', self.conn)
+        queries = self.count_metadata_queries(pool)
+        self.successResultOf(pool.count_unique_codes())
+        self.successResultOf(pool.count_unique_codes())
+        assert queries == []
+
+    def test_missing_pool_cached(self):
+        # Make sure the metadata table exists.
+        self.successResultOf(
+            UniqueCodePool('otherpool', self.conn).create_tables())
+
+        pool = self.registry.get_pool('testpool', self.conn)
+        self.registry.check_exists('testpool')
+        self.failureResultOf(pool.count_unique_codes(), NoUniqueCodePool)
+
+        # Now we know it's missing.
+        f = self.assertRaises(
+            NoUniqueCodePool, self.registry.check_exists, 'testpool')
+        assert f.args == ('testpool',)
+        pool = self.registry.get_pool('testpool', self.conn)
+        queries = self.count_metadata_queries(pool)
+        self.failureResultOf(pool.count_unique_codes(), NoUniqueCodePool)
+        assert queries == []
+
+    def test_ttl(self):
+        pool = self.registry.get_pool('testpool', self.conn)
+        self.clock.advance(9)
+        assert self.registry.get_pool(
+            'testpool', self.conn).unique_codes is pool.unique_codes
+        self.clock.advance(1)
+        assert self.registry.get_pool(
+            'testpool', self.conn).unique_codes is not pool.unique_codes
+
+    def test_missing_pool_expires(self):
+        self.successResultOf(
+            UniqueCodePool('otherpool', self.conn).create_tables())
+        pool = self.registry.get_pool('testpool', self.conn)
+        self.failureResultOf(pool.count_unique_codes(), NoUniqueCodePool)
+        self.assertRaises(
+            NoUniqueCodePool, self.registry.check_exists, 'testpool')
+
+        # Somebody else creates the pool.
+        self.successResultOf(
+            UniqueCodePool('testpool', self.conn).create_tables())
+        self.assertRaises(
+            NoUniqueCodePool, self.registry.check_exists, 'testpool')
+
+        self.clock.advance(10)
+        self.registry.check_exists('testpool')
+        pool = self.registry.get_pool('testpool', self.conn)
+        assert self.successResultOf(pool.count_unique_codes()) == []
+
+    def test_invalidate(self):
+        pool_a = self.registry.get_pool('a', self.conn)
+        pool_b = self.registry.get_pool('b', self.conn)
+        self.registry.invalidate('a')
+        assert self.registry.get_pool(
+            'a', self.conn).unique_codes is not pool_a.unique_codes
+        assert self.registry.get_pool(
+            'b', self.conn).unique_codes is pool_b.unique_codes
+        self.registry.invalidate()
+        assert self.registry.get_pool(
+            'b', self.conn).unique_codes is not pool_b.unique_codes
+
+    def test_expired_templates_evicted(self):
+        for i in range(3):
+            self.registry.get_pool('pool%s' % (i,), self.conn)
+        self.clock.advance(5)
+        self.registry.get_pool('pool3', self.conn)
+        assert len(self.registry._templates) == 4
+        self.clock.advance(5)
+        # Looking up any pool throws away the ones that have expired.
+        self.registry.get_pool('pool3', self.conn)
+        assert sorted(self.registry._templates) == ['pool3']
+
+    def test_missing_pools_bounded(self):
+        self.patch(self.registry, 'MAX_MISSING', 2)
+        self.successResultOf(
+            UniqueCodePool('otherpool', self.conn).create_tables())
+        for i in range(3):
+            name = 'nopool%s' % (i,)
+            pool = self.registry.get_pool(name, self.conn)
+            self.failureResultOf(pool.count_unique_codes(), NoUniqueCodePool)
+            self.assertRaises(
+                NoUniqueCodePool, self.registry.check_exists, name)
+        # We only remember the most recently used missing pools.
+        assert self.registry._templates == {}
+        assert list(self.registry._missing) == ['nopool1', 'nopool2']
+        self.assertRaises(
+            NoUniqueCodePool, self.registry.check_exists, 'nopool1')
+        assert list(self.registry._missing) == ['nopool2', 'nopool1']
+        # A forgotten one has to be looked up again.
+        self.registry.check_exists('nopool0')
+
+    def test_missing_pools_swept(self):
+        self.patch(UniqueCodePoolRegistry, 'MIN_SWEEP_SIZE', 2)
+        self.registry = UniqueCodePoolRegistry(self.clock, ttl=10)
+        self.successResultOf(
+            UniqueCodePool('otherpool', self.conn).create_tables())
+        for i in range(3):
+            pool = self.registry.get_pool('nopool%s' % (i,), self.conn)
+            self.failureResultOf(pool.count_unique_codes(), NoUniqueCodePool)
+        # Missing pools that are never asked for again are moved out of
+        # the way once there are enough templates to look through.
+        self.registry.get_pool('testpool', self.conn)
+        assert sorted(self.registry._templates) == ['testpool']
+        assert sorted(self.registry._missing) == [
+            'nopool0', 'nopool1', 'nopool2']
@@ -0,0 +1,105 @@
+import os
+
+from aludel.database import get_engine
+from aludel.tests.doubles import FakeReactorThreads
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from unique_code_service import replica
+from unique_code_service.connection_pool import ConnectionPool
+from unique_code_service.replica import (
+    ReadReplica, replication_lag, postgresql_lag_query)
+
+
+class TestReadReplica(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self.clock = Clock()
+        self.conn_pool = ConnectionPool(self.engine, self.clock)
+        self.addCleanup(self.conn_pool.close)
+        self.replica = ReadReplica(self.conn_pool, self.clock, max_lag=5)
+        self.lags = []
+        self.patch(replica, 'replication_lag', self.fake_replication_lag)
+
+    def fake_replication_lag(self, conn, engine):
+        lag = self.lags.pop(0)
+        if isinstance(lag, Deferred):
+            return lag
+        if isinstance(lag, Exception):
+            return fail(lag)
+        return succeed(lag)
+
+    def test_replication_lag(self):
+        conn = self.successResultOf(self.engine.connect())
+        self.addCleanup(conn.close)
+        # The test database isn't replicating from anything.
+        assert self.successResultOf(replication_lag(conn, self.engine)) == 0
+
+    def test_postgresql_lag_query(self):
+        # Replaying everything we've received only means we're up to date if
+        # we're still receiving.
+        query = postgresql_lag_query((10, 4))
+        assert 'pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()' in query
+        assert "pg_stat_wal_receiver WHERE status = 'streaming'" in query
+        query = postgresql_lag_query((9, 6, 9))
+        assert 'pg_last_xlog_receive_location()' in query
+        assert 'pg_stat_wal_receiver' in query
+        # Older servers can't tell us, so we go by the replay timestamp.
+        query = postgresql_lag_query((9, 5, 14))
+        assert 'pg_stat_wal_receiver' not in query
+        assert 'pg_last_xact_replay_timestamp()' in query
+
+    def test_not_used_until_checked(self):
+        d = Deferred()
+        self.lags.append(d)
+        # The first read starts a check, but doesn't wait for it.
+        assert not self.replica.use()
+        assert not self.replica.use()
+        d.callback(1.0)
+        assert self.replica.use()
+        assert self.replica.lag == 1.0
+        assert self.replica.stats() == {
+            'lag': 1.0, 'fresh': 1, 'reads': 1, 'fallbacks': 2}
+
+    def test_staleness_bound(self):
+        self.lags.extend([1.0, 3.0])
+        assert self.replica.use()
+        # Until we check again, the replica may have fallen this far behind.
+        self.clock.advance(0.9)
+        assert self.replica.is_fresh()
+        assert not self.replica.needs_check()
+        self.clock.advance(0.1)
+        assert self.replica.needs_check()
+        self.clock.advance(3.5)
+        assert not self.replica.is_fresh()
+        # A check tells us how far behind it actually is.
+        assert self.replica.use()
+        assert self.replica.lag == 3.0
+        self.clock.advance(2.5)
+        assert not self.replica.is_fresh()
+
+    def test_too_far_behind(self):
+        self.lags.extend([6.0, None, 0.0])
+        assert not self.replica.use()
+        self.clock.advance(1)
+        # We can't tell how far behind it is.
+        assert not self.replica.use()
+        assert self.replica.stats()['lag'] == -1
+        self.clock.advance(1)
+        assert self.replica.use()
+
+    def test_check_failure(self):
+        self.lags.extend([0.0, Exception("Replica is down.")])
+        assert self.replica.use()
+        self.clock.advance(1)
+        assert not self.replica.use()
+        assert len(self.flushLoggedErrors()) == 1
+        assert self.replica.lag is None
+        assert self.replica.checking is None
+        assert self.conn_pool.stats()['in_use'] == 0
@@ -2,6 +2,7 @@ from twisted.python.usage import UsageError
 from twisted.trial.unittest import TestCase
 
 from unique_code_service import service
+from unique_code_service.workers import AppService, WorkerSupervisor
 
 
 class TestService(TestCase):
@@ -10,7 +11,10 @@ class TestService(TestCase):
             'database-connection-string': 'sqlite://',
             'port': '0',
         })
+        assert isinstance(svc, AppService)
         assert not svc.running
+        # The listening port is a child, so it stops before the app does.
+        assert len(list(svc)) == 1
 
     def test_make_service_bad_db_conn_str(self):
         self.assertRaises(Exception, service.makeService, {
@@ -22,7 +26,15 @@ class TestService(TestCase):
         opts = service.Options()
         opts.parseOptions(['-p', '1234', '-d', 'sqlite://'])
         assert set(opts.keys()) == set([
-            'port', 'database-connection-string'])
+            'port', 'database-connection-string', 'db-pool-min-size',
+            'db-pool-max-size', 'db-pool-acquire-timeout',
+            'db-pool-idle-timeout', 'pool-cache-ttl', 'workers',
+            'drain-timeout', 'import-spool-dir', 'bloom-filter',
+            'bloom-filter-error-rate', 'bloom-filter-max-bytes',
+            'bloom-filter-max-staleness', 'group-commit',
+            'group-commit-interval', 'group-commit-max-batch-size',
+            'read-database-connection-string', 'read-replica-max-lag',
+            'counts-cache-max-staleness'])
         assert opts['database-connection-string'] == 'sqlite://'
         assert opts['port'] == '1234'
 
@@ -30,10 +42,172 @@ class TestService(TestCase):
         opts = service.Options()
         opts.parseOptions(['-d', 'sqlite://'])
         assert set(opts.keys()) == set([
-            'port', 'database-connection-string'])
+            'port', 'database-connection-string', 'db-pool-min-size',
+            'db-pool-max-size', 'db-pool-acquire-timeout',
+            'db-pool-idle-timeout', 'pool-cache-ttl', 'workers',
+            'drain-timeout', 'import-spool-dir', 'bloom-filter',
+            'bloom-filter-error-rate', 'bloom-filter-max-bytes',
+            'bloom-filter-max-staleness', 'group-commit',
+            'group-commit-interval', 'group-commit-max-batch-size',
+            'read-database-connection-string', 'read-replica-max-lag',
+            'counts-cache-max-staleness'])
         assert opts['database-connection-string'] == 'sqlite://'
         assert opts['port'] == '8080'
 
+    def test_db_pool_options(self):
+        opts = service.Options()
+        opts.parseOptions([
+            '-d', 'sqlite://', '--db-pool-min-size', '2',
+            '--db-pool-max-size', '5', '--db-pool-acquire-timeout', '1.5',
+            '--db-pool-idle-timeout', '60'])
+        assert opts['db-pool-min-size'] == 2
+        assert opts['db-pool-max-size'] == 5
+        assert opts['db-pool-acquire-timeout'] == 1.5
+        assert opts['db-pool-idle-timeout'] == 60.0
+
+    def test_db_pool_default_options(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert opts['db-pool-min-size'] == 1
+        assert opts['db-pool-max-size'] == 10
+        assert opts['db-pool-acquire-timeout'] == 30.0
+        assert opts['db-pool-idle-timeout'] == 300.0
+
+    def test_pool_cache_ttl_option(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert opts['pool-cache-ttl'] == 60.0
+        opts.parseOptions(['-d', 'sqlite://', '--pool-cache-ttl', '5'])
+        assert opts['pool-cache-ttl'] == 5.0
+
+    def test_import_spool_dir_option(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert opts['import-spool-dir'] is None
+        assert '--import-spool-dir' not in service.worker_argv(opts)
+        opts.parseOptions(['-d', 'sqlite://', '--import-spool-dir', '/spool'])
+        assert opts['import-spool-dir'] == '/spool'
+        argv = service.worker_argv(opts)
+        assert argv[argv.index('--import-spool-dir') + 1] == '/spool'
+
+    def test_bloom_filter_options(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert not opts['bloom-filter']
+        assert opts['bloom-filter-error-rate'] == 0.01
+        assert '--bloom-filter' not in service.worker_argv(opts)
+        opts.parseOptions([
+            '-d', 'sqlite://', '--bloom-filter',
+            '--bloom-filter-error-rate', '0.001',
+            '--bloom-filter-max-bytes', '1024',
+            '--bloom-filter-max-staleness', '5'])
+        assert opts['bloom-filter']
+        assert opts['bloom-filter-max-bytes'] == 1024
+        worker_opts = service.WorkerOptions()
+        worker_opts.parseOptions(service.worker_argv(opts)[3:])
+        assert worker_opts['bloom-filter']
+        assert worker_opts['bloom-filter-error-rate'] == 0.001
+        assert worker_opts['bloom-filter-max-staleness'] == 5.0
+
+    def test_group_commit_options(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert not opts['group-commit']
+        assert opts['group-commit-interval'] == 0.005
+        assert opts['group-commit-max-batch-size'] == 100
+        assert '--group-commit' not in service.worker_argv(opts)
+        opts.parseOptions([
+            '-d', 'sqlite://', '--group-commit',
+            '--group-commit-interval', '0.01',
+            '--group-commit-max-batch-size', '50'])
+        worker_opts = service.WorkerOptions()
+        worker_opts.parseOptions(service.worker_argv(opts)[3:])
+        assert worker_opts['group-commit']
+        assert worker_opts['group-commit-interval'] == 0.01
+        assert worker_opts['group-commit-max-batch-size'] == 50
+        self.assertRaises(UsageError, opts.parseOptions, [
+            '-d', 'sqlite://', '--group-commit-max-batch-size', '501'])
+
+    def test_read_replica_options(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert opts['read-database-connection-string'] is None
+        assert opts['read-replica-max-lag'] == 5.0
+        assert '--read-database-connection-string' not in (
+            service.worker_argv(opts))
+        assert service.make_app(opts).read_replica is None
+        opts.parseOptions([
+            '-d', 'sqlite://', '--read-database-connection-string',
+            'sqlite:///replica.db', '--read-replica-max-lag', '10'])
+        worker_opts = service.WorkerOptions()
+        worker_opts.parseOptions(service.worker_argv(opts)[3:])
+        assert worker_opts['read-database-connection-string'] == (
+            'sqlite:///replica.db')
+        assert worker_opts['read-replica-max-lag'] == 10.0
+        app = service.make_app(worker_opts)
+        assert app.read_replica.max_lag == 10.0
+        assert app.read_replica.conn_pool is not app.conn_pool
+
+    def test_counts_cache_options(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert opts['counts-cache-max-staleness'] == 1.0
+        opts.parseOptions(
+            ['-d', 'sqlite://', '--counts-cache-max-staleness', '0.5'])
+        worker_opts = service.WorkerOptions()
+        worker_opts.parseOptions(service.worker_argv(opts)[3:])
+        assert worker_opts['counts-cache-max-staleness'] == 0.5
+        app = service.make_app(worker_opts)
+        assert app.counts_cache.max_staleness == 0.5
+        self.assertRaises(UsageError, opts.parseOptions, [
+            '-d', 'sqlite://', '--counts-cache-max-staleness', '-1'])
+
     def test_db_conn_str_required(self):
         opts = service.Options()
         self.assertRaises(UsageError, opts.parseOptions, [])
+
+    def test_workers_options(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert opts['workers'] == 1
+        assert opts['drain-timeout'] == 30.0
+        opts.parseOptions(['-d', 'sqlite://', '-w', '4', '--drain-timeout',
+                           '5'])
+        assert opts['workers'] == 4
+        assert opts['drain-timeout'] == 5.0
+
+    def test_workers_options_bad(self):
+        opts = service.Options()
+        self.assertRaises(
+            UsageError, opts.parseOptions, ['-d', 'sqlite://', '-w', '0'])
+        self.assertRaises(
+            UsageError, opts.parseOptions,
+            ['-d', 'sqlite://', '-w', '2', '-p', 'unix:/tmp/sock'])
+
+    def test_make_service_workers(self):
+        svc = service.makeService({
+            'database-connection-string': 'sqlite://',
+            'port': '0',
+            'workers': 3,
+            'drain-timeout': 5.0,
+        })
+        assert isinstance(svc, WorkerSupervisor)
+        assert not svc.running
+        assert svc.workers == 3
+        assert svc.drain_timeout == 5.0
+        assert svc.worker_argv[1:] == [
+            '-m', 'unique_code_service.service', '--fd', '3',
+            '--database-connection-string', 'sqlite://',
+            '--drain-timeout', '5.0']
+
+    def test_worker_options(self):
+        opts = service.WorkerOptions()
+        opts.parseOptions(service.worker_argv({
+            'database-connection-string': 'sqlite://',
+            'db-pool-max-size': 5,
+        })[3:])
+        assert opts['fd'] == 3
+        assert opts['db-pool-max-size'] == 5
+        self.assertRaises(
+            UsageError, service.WorkerOptions().parseOptions,
+            ['-d', 'sqlite://'])
@@ -0,0 +1,259 @@
+import os
+import socket
+
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.task import Clock, deferLater
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from unique_code_service.workers import (
+    AppService, WorkerSupervisor, Worker, WORKER_LISTEN_FD)
+
+
+class FakeProcessTransport(object):
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.signals = []
+
+    def signalProcess(self, signal_name):
+        self.signals.append(signal_name)
+
+    def end(self, exception):
+        self.protocol.processEnded(Failure(exception))
+
+
+class FakeProcessReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env, childFDs):
+        transport = FakeProcessTransport(protocol)
+        protocol.makeConnection(transport)
+        self.spawned.append((protocol, executable, args, env, childFDs))
+        return transport
+
+
+class TestWorkerSupervisor(TestCase):
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+
+    def mk_supervisor(self, workers=2):
+        supervisor = WorkerSupervisor(
+            ['python', 'worker'], 0, workers, self.reactor,
+            interface='127.0.0.1', drain_timeout=10, restart_delay=1,
+            env={})
+        supervisor.startService()
+        self.addCleanup(self._stop, supervisor)
+        return supervisor
+
+    def _stop(self, supervisor):
+        if supervisor.running:
+            d = supervisor.stopService()
+            for protocol in supervisor.processes.values():
+                protocol.transport.end(ProcessDone(0))
+            self.successResultOf(d)
+
+    def test_start(self):
+        supervisor = self.mk_supervisor()
+        assert sorted(supervisor.processes) == [0, 1]
+        fileno = supervisor.socket.fileno()
+        for _, executable, args, env, child_fds in self.reactor.spawned:
+            assert executable == 'python'
+            assert args == ['python', 'worker']
+            assert child_fds == {
+                0: 'w', 1: 'r', 2: 'r', WORKER_LISTEN_FD: fileno}
+
+    def test_restart_dead_worker(self):
+        supervisor = self.mk_supervisor()
+        dead = supervisor.processes[0]
+        dead.transport.end(ProcessTerminated(signal=9))
+        assert sorted(supervisor.processes) == [1]
+        self.reactor.advance(1)
+        assert sorted(supervisor.processes) == [0, 1]
+        assert supervisor.processes[0] is not dead
+        assert len(self.reactor.spawned) == 3
+
+    def test_stop(self):
+        supervisor = self.mk_supervisor()
+        protocols = supervisor.processes.values()
+        d = supervisor.stopService()
+        for protocol in protocols:
+            assert protocol.transport.signals == ['TERM']
+        protocols[0].transport.end(ProcessDone(0))
+        self.assertNoResult(d)
+        protocols[1].transport.end(ProcessDone(0))
+        self.successResultOf(d)
+        assert supervisor.socket is None
+        assert supervisor.processes == {}
+        # Stopped workers aren't restarted.
+        self.reactor.advance(1)
+        assert len(self.reactor.spawned) == 2
+
+    def test_stop_pending_restart(self):
+        supervisor = self.mk_supervisor(workers=1)
+        supervisor.processes[0].transport.end(ProcessTerminated(signal=9))
+        self.successResultOf(supervisor.stopService())
+        self.reactor.advance(1)
+        assert len(self.reactor.spawned) == 1
+
+    def test_stop_kills_slow_workers(self):
+        supervisor = self.mk_supervisor(workers=1)
+        protocol = supervisor.processes[0]
+        d = supervisor.stopService()
+        self.reactor.advance(14)
+        assert protocol.transport.signals == ['TERM']
+        self.reactor.advance(1)
+        assert protocol.transport.signals == ['TERM', 'KILL']
+        protocol.transport.end(ProcessTerminated(signal=9))
+        self.successResultOf(d)
+
+    def test_worker_output_logged(self):
+        supervisor = self.mk_supervisor(workers=1)
+        logged = []
+        log.addObserver(logged.append)
+        self.addCleanup(log.removeObserver, logged.append)
+        protocol = supervisor.processes[0]
+        protocol.childDataReceived(1, 'hello\nwor')
+        protocol.childDataReceived(2, 'oops\n')
+        protocol.childDataReceived(1, 'ld\n')
+        assert [' '.join(e['message']) for e in logged] == [
+            'worker 0: hello', 'worker 0: oops', 'worker 0: world']
+
+
+class SlowResource(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+        self.received = Deferred()
+
+    def render_GET(self, request):
+        self.requests.append(request)
+        self.received.callback(request)
+        return NOT_DONE_YET
+
+
+class FakeConnectionPool(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+        return succeed(None)
+
+
+class FakeApp(object):
+    def __init__(self, resource):
+        self.app = self
+        self._resource = resource
+        self.conn_pool = FakeConnectionPool()
+        self.import_jobs = succeed(None)
+
+    def resource(self):
+        return self._resource
+
+    def stop_import_jobs(self):
+        return self.import_jobs
+
+    def close(self):
+        return self.conn_pool.close()
+
+
+class TestWorker(TestCase):
+    timeout = 5
+
+    def mk_worker(self, drain_timeout=5):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        sock.setblocking(False)
+        self.addCleanup(sock.close)
+        self.url = 'http://127.0.0.1:%s/' % (sock.getsockname()[1],)
+        self.resource = SlowResource()
+        self.app = FakeApp(self.resource)
+        worker = Worker(
+            os.dup(sock.fileno()), self.app, reactor, drain_timeout)
+        worker.drain_interval = 0.01
+        worker.startService()
+        return worker
+
+    @inlineCallbacks
+    def test_drain(self):
+        worker = self.mk_worker()
+        response_d = Agent(reactor).request('GET', self.url)
+        request = yield self.resource.received
+
+        stopped_d = worker.stopService()
+        self.assertNoResult(stopped_d)
+        assert not self.app.conn_pool.closed
+
+        request.write('done')
+        request.finish()
+        response = yield response_d
+        body = yield readBody(response)
+        assert body == 'done'
+        yield stopped_d
+        assert worker.factory.protocols == {}
+        assert self.app.conn_pool.closed
+
+    @inlineCallbacks
+    def test_drain_import_jobs(self):
+        worker = self.mk_worker()
+        self.app.import_jobs = Deferred()
+        stopped_d = worker.stopService()
+        yield deferLater(reactor, 0.05, lambda: None)
+        self.assertNoResult(stopped_d)
+        assert not self.app.conn_pool.closed
+        self.app.import_jobs.callback(None)
+        yield stopped_d
+        assert self.app.conn_pool.closed
+
+    @inlineCallbacks
+    def test_drain_timeout(self):
+        worker = self.mk_worker(drain_timeout=0.1)
+        response_d = Agent(reactor).request('GET', self.url)
+        yield self.resource.received
+        yield worker.stopService()
+        assert self.app.conn_pool.closed
+        yield self.assertFailure(response_d, Exception)
+
+
+class TestAppService(TestCase):
+    def mk_service(self):
+        self.clock = Clock()
+        self.app = FakeApp(None)
+        svc = AppService(self.app, self.clock, drain_timeout=1)
+        self.child = Service()
+        self.child.setServiceParent(svc)
+        svc.startService()
+        return svc
+
+    def test_stop(self):
+        svc = self.mk_service()
+        self.app.import_jobs = Deferred()
+        d = svc.stopService()
+        assert not self.child.running
+        # We wait for the import jobs to stop before closing connections.
+        self.clock.advance(0.1)
+        self.assertNoResult(d)
+        assert not self.app.conn_pool.closed
+        self.app.import_jobs.callback(None)
+        self.clock.advance(0.1)
+        self.successResultOf(d)
+        assert self.app.conn_pool.closed
+
+    def test_stop_timeout(self):
+        svc = self.mk_service()
+        self.app.import_jobs = Deferred()
+        d = svc.stopService()
+        self.clock.pump([0.1] * 11)
+        self.successResultOf(d)
+        assert self.app.conn_pool.closed
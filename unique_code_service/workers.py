@@ -0,0 +1,266 @@
+"""Serve requests from several worker processes sharing one listening socket.
+
+A single process only ever uses one CPU core, and parsing JSON and CSV and
+compiling queries keeps it busy. :class:`WorkerSupervisor` runs in the
+parent process: it opens the listening socket, starts the workers with the
+socket inherited as an extra file descriptor, restarts any that die and
+stops them all on shutdown. :class:`Worker` runs in each worker process: it
+accepts connections on the inherited socket and, when it is stopped, stops
+accepting new connections and waits for the requests it has already
+accepted to finish. A single process without workers uses
+:class:`AppService`, which stops its import jobs the same way.
+"""
+
+import os
+import socket
+import sys
+
+from twisted.application.service import MultiService, Service
+from twisted.internet.defer import Deferred, inlineCallbacks, gatherResults
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import deferLater
+from twisted.protocols.policies import WrappingFactory
+from twisted.python import log
+from twisted.web import server
+
+
+# File descriptor the listening socket has in worker processes.
+WORKER_LISTEN_FD = 3
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+    """Logs what a worker writes and tells the supervisor when it ends."""
+
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.ended = Deferred()
+        self._buffers = {1: '', 2: ''}
+
+    def childDataReceived(self, fd, data):
+        lines = (self._buffers.get(fd, '') + data).split('\n')
+        self._buffers[fd] = lines.pop()
+        for line in lines:
+            log.msg('worker %s: %s' % (self.worker_id, line.rstrip('\r')))
+
+    def processEnded(self, reason):
+        for fd in sorted(self._buffers):
+            if self._buffers[fd]:
+                self.childDataReceived(fd, '\n')
+        self.supervisor.worker_ended(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerSupervisor(Service):
+    """Runs ``workers`` copies of ``worker_argv`` that share a socket.
+
+    :param list worker_argv:
+        Command line for a worker process. The listening socket is passed
+        to it as file descriptor :data:`WORKER_LISTEN_FD`.
+    :param int port: TCP port to listen on.
+    :param int workers: Number of worker processes to run.
+    :param reactor:
+        Something that provides ``spawnProcess()``, ``seconds()`` and
+        ``callLater()``.
+    :param float drain_timeout:
+        Seconds to give workers to finish their requests on shutdown before
+        they are killed.
+    :param float restart_delay:
+        Seconds to wait before replacing a worker that has died, so that a
+        worker that can't start doesn't use all our CPU restarting.
+    """
+
+    def __init__(self, worker_argv, port, workers, reactor, interface='',
+                 drain_timeout=30, restart_delay=1, env=None):
+        self.worker_argv = worker_argv
+        self.port = port
+        self.interface = interface
+        self.workers = workers
+        self.reactor = reactor
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        if env is None:
+            # Make sure the workers can import everything we can.
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.env = env
+        self.socket = None
+        self.processes = {}
+        self._restarts = {}
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.interface, self.port))
+        sock.listen(socket.SOMAXCONN)
+        # The workers accept connections without blocking, so the socket
+        # needs to be non-blocking when they get it.
+        sock.setblocking(False)
+        return sock
+
+    def startService(self):
+        Service.startService(self)
+        self.socket = self._listen()
+        log.msg('Listening on port %s with %s workers.' % (
+            self.socket.getsockname()[1], self.workers))
+        for worker_id in range(self.workers):
+            self.start_worker(worker_id)
+
+    def start_worker(self, worker_id):
+        self._restarts.pop(worker_id, None)
+        protocol = WorkerProcessProtocol(self, worker_id)
+        self.reactor.spawnProcess(
+            protocol, self.worker_argv[0], self.worker_argv, env=self.env,
+            childFDs={
+                0: 'w', 1: 'r', 2: 'r',
+                WORKER_LISTEN_FD: self.socket.fileno(),
+            })
+        self.processes[worker_id] = protocol
+
+    def worker_ended(self, protocol, reason):
+        if self.processes.get(protocol.worker_id) is not protocol:
+            return
+        del self.processes[protocol.worker_id]
+        if not self.running:
+            return
+        log.msg('Worker %s died (%s), restarting it in %ss.' % (
+            protocol.worker_id, reason.getErrorMessage(),
+            self.restart_delay))
+        self._restarts[protocol.worker_id] = self.reactor.callLater(
+            self.restart_delay, self.start_worker, protocol.worker_id)
+
+    def stopService(self):
+        Service.stopService(self)
+        for delayed_call in self._restarts.values():
+            delayed_call.cancel()
+        self._restarts.clear()
+
+        ds = []
+        for protocol in self.processes.values():
+            _signal(protocol, 'TERM')
+            ds.append(protocol.ended)
+        kill_call = self.reactor.callLater(
+            self.drain_timeout + 5, self._kill_workers)
+
+        def finish(_):
+            if kill_call.active():
+                kill_call.cancel()
+            self.socket.close()
+            self.socket = None
+        return gatherResults(ds).addCallback(finish)
+
+    def _kill_workers(self):
+        for protocol in self.processes.values():
+            log.msg('Worker %s took too long to stop, killing it.' % (
+                protocol.worker_id,))
+            _signal(protocol, 'KILL')
+
+
+def _signal(protocol, signal_name):
+    try:
+        protocol.transport.signalProcess(signal_name)
+    except Exception:
+        # The process may already be gone.
+        log.err(None, 'Error signalling worker %s.' % (protocol.worker_id,))
+
+
+class Worker(Service):
+    """Serves ``app`` on a listening socket inherited from our parent.
+
+    :param int fd: The listening socket's file descriptor.
+    :param app: The :class:`UniqueCodeServiceApp` to serve.
+    :param reactor: Something that provides ``adoptStreamPort()``,
+        ``seconds()`` and ``callLater()``.
+    :param float drain_timeout:
+        Seconds to wait for requests in progress to finish when stopping.
+    """
+
+    # Seconds between checks for finished requests while draining.
+    drain_interval = 0.1
+
+    def __init__(self, fd, app, reactor, drain_timeout=30):
+        self.fd = fd
+        self.app = app
+        self.reactor = reactor
+        self.drain_timeout = drain_timeout
+        # This keeps track of open connections so that we can drain them.
+        self.factory = WrappingFactory(server.Site(app.app.resource()))
+        self.port = None
+
+    def startService(self):
+        Service.startService(self)
+        self.port = self.reactor.adoptStreamPort(
+            self.fd, socket.AF_INET, self.factory)
+        # The port has its own copy of the socket now.
+        os.close(self.fd)
+
+    def _close_idle_connections(self):
+        for wrapper in list(self.factory.protocols):
+            if not wrapper.wrappedProtocol.requests:
+                wrapper.transport.loseConnection()
+
+    @inlineCallbacks
+    def stopService(self):
+        Service.stopService(self)
+        yield self.port.stopListening()
+        deadline = self.reactor.seconds() + self.drain_timeout
+        # Import jobs stop after their current batch, and can be resumed
+        # straight away by another worker.
+        jobs = self.app.stop_import_jobs()
+        self._close_idle_connections()
+        while (self.factory.protocols or not jobs.called) and (
+                self.reactor.seconds() < deadline):
+            yield deferLater(self.reactor, self.drain_interval, lambda: None)
+            # Keep-alive connections become idle when their last request is
+            # done, so we check them again.
+            self._close_idle_connections()
+        for wrapper in list(self.factory.protocols):
+            wrapper.transport.abortConnection()
+        yield self.app.close()
+
+
+class AppService(MultiService):
+    """Serves ``app`` in a single process with its child services, such as
+    the one listening for connections.
+
+    When it's stopped, the children stop first, and then the app's import
+    jobs are stopped and its database connections closed, as
+    :class:`Worker` does.
+
+    :param app: The :class:`UniqueCodeServiceApp` to serve.
+    :param reactor: Something that provides ``seconds()`` and
+        ``callLater()``.
+    :param float drain_timeout:
+        Seconds to wait for import jobs to stop.
+    """
+
+    # Seconds between checks for stopped import jobs.
+    drain_interval = 0.1
+
+    def __init__(self, app, reactor, drain_timeout=30):
+        MultiService.__init__(self)
+        self.app = app
+        self.reactor = reactor
+        self.drain_timeout = drain_timeout
+
+    @inlineCallbacks
+    def stopService(self):
+        yield MultiService.stopService(self)
+        deadline = self.reactor.seconds() + self.drain_timeout
+        jobs = self.app.stop_import_jobs()
+        while not jobs.called and self.reactor.seconds() < deadline:
+            yield deferLater(self.reactor, self.drain_interval, lambda: None)
+        yield self.app.close()
+
+
+def run_worker(reactor, fd, app, drain_timeout):
+    """Run a worker process until the supervisor tells it to stop."""
+    observer = log.FileLogObserver(sys.stdout)
+    # The supervisor adds its own timestamps to what we log.
+    observer.formatTime = lambda when: '-'
+    log.startLoggingWithObserver(observer.emit, setStdout=False)
+    worker = Worker(fd, app, reactor, drain_timeout)
+    worker.startService()
+    # The reactor stops when we get SIGTERM, but this lets the worker drain
+    # before it does.
+    reactor.addSystemEventTrigger('before', 'shutdown', worker.stopService)
+    reactor.run()